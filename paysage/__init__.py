@@ -5,3 +5,7 @@ from . import fit
 from . import optimizers
 from . import metrics
 from . import models
+from . import parallel
+from . import partition
+from . import anneal
+from . import generate
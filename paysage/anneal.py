@@ -0,0 +1,418 @@
+"""
+Annealing of many chains at once through a schedule of inverse temperatures.
+
+Simulated annealing searches for low energy configurations of a model.
+All of the chains are advanced together by Model.markov_chain with a
+tensor of inverse temperatures (one per chain) that follows a schedule.
+At the end of the schedule the chains are moved to a fixed point of
+Model.deterministic_iteration, and the distinct fixed points (modes)
+are returned sorted by energy.
+
+Population annealing samples from a model. A population of
+configurations starts from the independent layers at beta = 0; at each
+inverse temperature the population is reweighted by the change in the
+joint energy, resampled, and updated with Monte Carlo steps. The mean
+weights also give an estimate of the log partition function.
+
+Kirkpatrick, Scott, C. Daniel Gelatt, and Mario P. Vecchi.
+"Optimization by simulated annealing."
+Science 220.4598 (1983): 671-680.
+
+Machta, Jonathan.
+"Population annealing with weighted averages: A Monte Carlo method
+for rough free-energy landscapes."
+Physical Review E 82.2 (2010): 026704.
+
+"""
+import math
+from collections import namedtuple
+import numpy
+
+from . import backends as be
+from . import parallel
+from . import partition
+from .models.model import State
+
+# ----- SCHEDULES ----- #
+
+def linear_schedule(num_steps, beta_start=0.1, beta_end=1.0):
+    """
+    Inverse temperatures spaced evenly from beta_start to beta_end.
+
+    Args:
+        num_steps (int): the number of annealing steps
+        beta_start (float): the first inverse temperature
+        beta_end (float): the last inverse temperature
+
+    Returns:
+        numpy array (num_steps + 1,)
+
+    """
+    return beta_start + (beta_end - beta_start) \
+           * partition.linear_schedule(num_steps)
+
+def geometric_schedule(num_steps, beta_start=0.1, beta_end=1.0):
+    """
+    Inverse temperatures with a constant ratio from beta_start to beta_end.
+
+    Args:
+        num_steps (int): the number of annealing steps
+        beta_start (float > 0): the first inverse temperature
+        beta_end (float > 0): the last inverse temperature
+
+    Returns:
+        numpy array (num_steps + 1,)
+
+    """
+    return numpy.geomspace(beta_start, beta_end, num_steps + 1)
+
+# ----- ANNEALING ----- #
+
+Modes = namedtuple("Modes", ["state", "energy", "counts"])
+
+def unique_modes(model, state):
+    """
+    Find the distinct configurations in a state.
+
+    Notes:
+        The rows are deduplicated by hashing their bytes
+        (numpy.unique on a structured view of each row).
+
+    Args:
+        model: a model object
+        state (State): the configurations (e.g., fixed points)
+
+    Returns:
+        Modes: the distinct configurations sorted by increasing energy,
+            their energies, and the number of rows equal to each
+
+    """
+    units = [numpy.ascontiguousarray(be.to_numpy_array(u))
+             for u in state.units]
+    rows = numpy.hstack(units)
+    keys = rows.view(numpy.dtype((numpy.void, rows.dtype.itemsize
+                                  * rows.shape[1]))).ravel()
+    _, index, counts = numpy.unique(keys, return_index=True,
+                                    return_counts=True)
+    modes = State([be.float_tensor(u[index]) for u in units])
+    energy = be.to_numpy_array(model.joint_energy(modes))
+    order = numpy.argsort(energy, kind='stable')
+    return Modes(State([u[order] for u in modes.units]),
+                 energy[order], counts[order])
+
+
+class Annealer(object):
+    """
+    Simulated annealing of many chains at once.
+
+    Notes:
+        As in the layers, the inverse temperature multiplies the
+        contribution of the weights to the energy (not the biases).
+
+    Example usage:
+    '''
+    annealer = Annealer(rbm, geometric_schedule(200, 0.1, 5.0))
+    modes = annealer.run(10000)
+    best = modes.state.units[0][0]
+    '''
+
+    """
+    def __init__(self, model, schedule=None, steps_per_beta=1,
+                 max_iterations=100):
+        """
+        Create an annealer.
+
+        Args:
+            model: a model object
+            schedule (optional): the inverse temperatures of each stage,
+                either an array (num_stages,) shared by all chains or an
+                array (num_stages, num_chains) with a schedule for each
+                chain. Defaults to geometric_schedule(100).
+            steps_per_beta (int; optional): Monte Carlo steps per stage
+            max_iterations (int; optional): the maximum number of
+                deterministic iterations used to reach a fixed point
+
+        Returns:
+            Annealer
+
+        """
+        self.model = model
+        if schedule is None:
+            schedule = geometric_schedule(100)
+        self.schedule = numpy.asarray(schedule, dtype=numpy.float32)
+        if self.schedule.ndim == 1:
+            self.schedule = self.schedule[:, numpy.newaxis]
+        self.steps_per_beta = steps_per_beta
+        self.max_iterations = max_iterations
+
+    def anneal(self, state):
+        """
+        Run the annealing schedule.
+
+        Notes:
+            Modifies the state in place.
+
+        Args:
+            state (State): the initial state of the chains
+
+        Returns:
+            State
+
+        """
+        num_chains = be.shape(state.units[0])[0]
+        for betas in self.schedule:
+            beta = be.float_tensor(numpy.broadcast_to(
+                betas[:, numpy.newaxis], (num_chains, 1)))
+            self.model.markov_chain(self.steps_per_beta, state, beta,
+                                    out=state)
+        return state
+
+    def descend(self, state):
+        """
+        Move the chains to a fixed point of the deterministic updates.
+
+        Notes:
+            Modifies the state in place.
+            Stops after max_iterations even if some chains still change.
+
+        Args:
+            state (State): the state of the chains
+
+        Returns:
+            State
+
+        """
+        previous = State.from_state(state)
+        for _ in range(self.max_iterations):
+            self.model.deterministic_iteration(1, state, out=state)
+            if all(be.allclose(u, p) for u, p in zip(state.units,
+                                                      previous.units)):
+                break
+            previous.copy_from(state)
+        return state
+
+    def run(self, num_chains_or_state):
+        """
+        Search for low energy configurations.
+
+        Args:
+            num_chains_or_state (int or State): the number of chains
+                (started from random configurations), or their initial state
+
+        Returns:
+            Modes: the distinct fixed points sorted by increasing energy
+
+        """
+        if isinstance(num_chains_or_state, State):
+            state = State.from_state(num_chains_or_state)
+        else:
+            state = State.from_model(num_chains_or_state, self.model)
+        state = self.descend(self.anneal(state))
+        return unique_modes(self.model, state)
+
+
+# ----- POPULATION ANNEALING ----- #
+
+def systematic_resample(log_weights, num_samples):
+    """
+    Choose the rows of a weighted population by systematic resampling.
+
+    A single uniform offset u is drawn, and row i is chosen once for every
+    point (u + k) / num_samples that falls into its share of the
+    cumulative normalized weights, so each row is chosen the floor or the
+    ceiling of num_samples times its normalized weight.
+
+    Args:
+        log_weights (numpy array (population_size,)): unnormalized
+            log weights of the rows
+        num_samples (int): the number of rows to choose
+
+    Returns:
+        numpy array (num_samples,): the indices of the chosen rows
+
+    """
+    weights = numpy.exp(log_weights - numpy.max(log_weights))
+    cumulative = numpy.cumsum(weights)
+    cumulative /= cumulative[-1]
+    offset = float(be.to_numpy_array(be.rand((1,)))[0])
+    points = (offset + numpy.arange(num_samples)) / num_samples
+    index = numpy.searchsorted(cumulative, points, side='right')
+    return numpy.minimum(index, len(weights) - 1)
+
+def population_annealing(model, schedule, population_size, steps_per_beta=1):
+    """
+    Anneal a population from beta = 0 through a schedule.
+
+    log Z_k - log Z_(k-1) is estimated by the log of the mean weight
+    w = exp(E_(beta_(k-1))(x) - E_(beta_k)(x)) over the population,
+    where E is the joint energy.
+
+    Args:
+        model: a model object
+        schedule (array (num_steps + 1,)): increasing inverse temperatures
+            from 0
+        population_size (int): the number of configurations
+        steps_per_beta (int; optional): Monte Carlo steps at each
+            inverse temperature after resampling
+
+    Returns:
+        State: the population at the last inverse temperature
+        float: the estimate of the log partition function at the
+            last inverse temperature
+
+    """
+    ones = be.ones((population_size, 1))
+    beta = 0 * ones
+    # at beta = 0 a single step samples the layers exactly
+    state = model.markov_chain(1, State.from_model(population_size, model),
+                               beta)
+    log_Z = partition.base_log_partition_function(model)
+    for k in range(1, len(schedule)):
+        new_beta = float(schedule[k]) * ones
+        log_weights = be.to_numpy_array(
+            model.joint_energy(state, beta)
+            - model.joint_energy(state, new_beta)).astype(numpy.float64)
+        shift = numpy.max(log_weights)
+        log_Z += float(shift) \
+                 + math.log(numpy.mean(numpy.exp(log_weights - shift)))
+        index = be.long_tensor(systematic_resample(log_weights,
+                                                   population_size))
+        state = State([be.index_select(u, index) for u in state.units])
+        beta = new_beta
+        model.markov_chain(steps_per_beta, state, beta, out=state)
+    return state, log_Z
+
+
+class PopulationAnnealer(object):
+    """
+    Population annealing sampler and estimator of the log partition function.
+
+    Notes:
+        With workers, the population is split into independent
+        populations (one per worker). They are combined by weighted
+        averaging: the estimate of Z is the size weighted mean of their
+        estimates, and the combined population is resampled with each row
+        weighted by the estimate of Z of its population.
+
+    Example usage:
+    '''
+    with PopulationAnnealer(rbm, population_size=10000) as annealer:
+        samples = annealer.run()
+        log_Z = annealer.log_Z
+    '''
+
+    """
+    def __init__(self, model, population_size=1000, schedule=None,
+                 steps_per_beta=1, num_workers=0):
+        """
+        Create a population annealer.
+
+        Args:
+            model: a model object
+            population_size (int; optional): the number of configurations
+            schedule (array; optional): increasing inverse temperatures
+                from 0 (defaults to partition.linear_schedule(100))
+            steps_per_beta (int; optional): Monte Carlo steps at each
+                inverse temperature
+            num_workers (int; optional): if positive, the population is
+                split across a pool of worker processes
+
+        Returns:
+            PopulationAnnealer
+
+        """
+        self.model = model
+        self.population_size = population_size
+        self.schedule = partition.linear_schedule(100) if schedule is None \
+                        else numpy.asarray(schedule, dtype=numpy.float64)
+        assert self.schedule[0] == 0, "The schedule must start at beta = 0"
+        self.steps_per_beta = steps_per_beta
+        self.num_workers = num_workers
+        self.pool = None
+
+        self.state = None
+        self.log_Z = None
+
+    def run(self):
+        """
+        Anneal the population through the schedule.
+
+        Notes:
+            Sets the state and log_Z attributes.
+
+        Args:
+            None
+
+        Returns:
+            State: the population at the last inverse temperature
+
+        """
+        if not self.num_workers:
+            self.state, self.log_Z = population_annealing(
+                self.model, self.schedule, self.population_size,
+                self.steps_per_beta)
+            return self.state
+
+        if self.pool is None:
+            self.pool = parallel.ModelPool(self.model, self.num_workers)
+        sizes = [stop - start for start, stop
+                 in self.pool._partition(self.population_size)]
+        results = self.pool.map(population_annealing,
+                                [(self.schedule, n, self.steps_per_beta)
+                                 for n in sizes])
+        log_Z = numpy.array([r[1] for r in results], dtype=numpy.float64)
+        shift = numpy.max(log_Z)
+        self.log_Z = float(shift) + math.log(
+            numpy.dot(sizes, numpy.exp(log_Z - shift)) / sum(sizes))
+
+        log_weights = numpy.concatenate([numpy.full(n, z) for n, z
+                                         in zip(sizes, log_Z)])
+        index = be.long_tensor(systematic_resample(log_weights,
+                                                   self.population_size))
+        units = [be.vstack([r[0].units[i] for r in results])
+                 for i in range(self.model.num_layers)]
+        self.state = State([be.index_select(u, index) for u in units])
+        return self.state
+
+    def log_likelihood(self, batch, mode='validate'):
+        """
+        Compute the average log-likelihood of the samples in a Batch.
+
+        Notes:
+            Calls run() first if log_Z has not been estimated yet.
+            The schedule must end at beta = 1.
+
+        Args:
+            batch: a batch object
+            mode (str): the part of the batch to use ('train' or 'validate')
+
+        Returns:
+            float
+
+        """
+        assert self.schedule[-1] == 1, "The schedule must end at beta = 1"
+        if self.log_Z is None:
+            self.run()
+        return partition.average_log_likelihood(self.model, batch,
+                                                self.log_Z, mode)
+
+    def close(self):
+        """
+        Shut down the process pool, if there is one.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
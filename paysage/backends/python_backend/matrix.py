@@ -31,6 +31,19 @@ def float_tensor(tensor: T.Tensor) -> T.Tensor:
     """
     return numpy.array(tensor, dtype=numpy.float32)
 
+def long_tensor(tensor: T.Tensor) -> T.Tensor:
+    """
+    Cast tensor to a long (int64) tensor, e.g., to index another tensor.
+
+    Args:
+        tensor: A tensor.
+
+    Returns:
+        tensor: Tensor converted to int64.
+
+    """
+    return numpy.array(tensor, dtype=numpy.int64)
+
 def to_numpy_array(tensor: T.Tensor) -> T.Tensor:
     """
     Return tensor as a numpy array.
@@ -326,6 +339,95 @@ def dtype(tensor: T.Tensor) -> type:
     """
     return tensor.dtype
 
+def cast_tensor(tensor: T.Tensor, precision: str) -> T.Tensor:
+    """
+    Convert a tensor to the given precision.
+
+    Notes:
+        Returns the tensor itself if it already has the precision.
+
+    Args:
+        tensor: A tensor.
+        precision: 'float32', 'float16', 'uint8', or 'int8'.
+
+    Returns:
+        tensor: The converted tensor.
+
+    """
+    return tensor.astype(precision, copy=False)
+
+def copy_inplace(x: T.Tensor, y: T.Tensor) -> None:
+    """
+    Copy the elements of a tensor (y) into a tensor with the same shape (x).
+
+    x <- y
+
+    Note:
+        Modifies x in place.
+
+    Args:
+        x: A tensor.
+        y: A tensor.
+
+    Returns:
+        None
+
+    """
+    numpy.copyto(x, y, casting='unsafe')
+
+def index_select(x: T.Tensor, index: T.Tensor, axis: int = 0) -> T.Tensor:
+    """
+    Select the entries of a tensor at the given indices along an axis.
+
+    Args:
+        x: A tensor.
+        index: A tensor of integer indices.
+        axis (optional): The axis to select along.
+
+    Returns:
+        tensor: The selected entries.
+
+    """
+    return numpy.take(x, index, axis=axis)
+
+def index_copy_inplace(x: T.Tensor, index: T.Tensor, y: T.Tensor,
+                       axis: int = 0) -> None:
+    """
+    Copy the elements of a tensor (y) into the entries of
+    a tensor (x) at the given indices along an axis.
+
+    x[..., index, ...] <- y
+
+    Note:
+        Modifies x in place.
+
+    Args:
+        x: A tensor.
+        index: A tensor of integer indices.
+        y: A tensor.
+        axis (optional): The axis to copy along.
+
+    Returns:
+        None
+
+    """
+    slices = [slice(None)] * x.ndim
+    slices[axis] = index
+    x[tuple(slices)] = y
+
+def flatnonzero(x: T.Tensor) -> T.Tensor:
+    """
+    Return the indices of the nonzero elements of the flattened tensor.
+
+    Args:
+        x: A tensor.
+
+    Returns:
+        tensor (int64): The indices of the nonzero elements.
+
+    """
+    return numpy.flatnonzero(x)
+
 def mix_inplace(w: T.Scalar, x: T.Tensor, y: T.Tensor) -> None:
     """
     Compute a weighted average of two matrices (x and y) and store the results in x.
@@ -1013,6 +1115,169 @@ def batch_outer(vis: T.Tensor, hid: T.Tensor) -> T.Tensor:
     """
     return numpy.dot(vis.T, hid)
 
+def batch_matmul(a: T.Tensor, b: T.Tensor) -> T.Tensor:
+    """
+    Multiply stacks of matrices.
+
+    If a is a K x L x N tensor and b is a K x N x M tensor, then
+    batch_matmul(a, b)[k] = a[k] b[k] is a K x L x M tensor.
+    A 2D tensor is multiplied with every matrix of the other stack.
+
+    Args:
+        a: A tensor.
+        b: A tensor.
+
+    Returns:
+        tensor: A stack of matrices.
+
+    """
+    return numpy.matmul(a, b)
+
+def batch_transpose(a: T.Tensor) -> T.Tensor:
+    """
+    Transpose each matrix in a stack of matrices
+    (i.e., swap the last two axes).
+
+    Args:
+        a: A tensor.
+
+    Returns:
+        tensor: A view of the stack of transposed matrices.
+
+    """
+    return numpy.swapaxes(a, -2, -1)
+
+def _conv2d_output_shape(image_shape, kernel_shape, stride):
+    """
+    The height and width of the output of a valid 2D convolution.
+
+    Args:
+        image_shape: (channels, height, width) of the images.
+        kernel_shape: (height, width) of the filters.
+        stride: The step between patches.
+
+    Returns:
+        tuple (int, int)
+
+    """
+    return tuple((n - k) // stride + 1
+                 for n, k in zip(image_shape[1:], kernel_shape))
+
+def _image_patches(x: T.Tensor, image_shape, kernel_shape, stride):
+    """
+    Extract the patches of a batch of flattened images (im2col).
+
+    Args:
+        x: A tensor (num_samples, channels * height * width).
+        image_shape: (channels, height, width) of the images.
+        kernel_shape: (height, width) of the patches.
+        stride: The step between patches.
+
+    Returns:
+        tensor (num_samples, num_patches, channels * kernel_size):
+            the patches, in row major order.
+
+    """
+    images = x.reshape((len(x),) + tuple(image_shape))
+    out_height, out_width = _conv2d_output_shape(image_shape, kernel_shape,
+                                                 stride)
+    num_samples, channels = images.shape[:2]
+    sample_step, channel_step, row_step, column_step = images.strides
+    # a read only view (N, C, Ho, Wo, kh, kw) of the windows
+    windows = numpy.lib.stride_tricks.as_strided(
+        images,
+        shape=(num_samples, channels, out_height, out_width)
+              + tuple(kernel_shape),
+        strides=(sample_step, channel_step, stride * row_step,
+                 stride * column_step, row_step, column_step),
+        writeable=False)
+    # (N, C, Ho, Wo, kh, kw) -> (N, Ho * Wo, C * kh * kw), a copy
+    return windows.transpose(0, 2, 3, 1, 4, 5).reshape(
+        len(x), out_height * out_width, -1)
+
+def conv2d(x: T.Tensor, filters: T.Tensor, image_shape, kernel_shape,
+           stride: int=1) -> T.Tensor:
+    """
+    Compute the valid 2D convolution (cross-correlation) of a batch of
+    flattened images with a bank of filters.
+
+    The images are flattened in (channel, row, column) order, and the
+    filters are the columns of a (channels * kernel_height * kernel_width)
+    x num_filters matrix. The result is flattened in
+    (filter, row, column) order.
+
+    Args:
+        x: A tensor (num_samples, channels * height * width).
+        filters: A tensor (channels * kernel_size, num_filters).
+        image_shape: (channels, height, width) of the images.
+        kernel_shape: (height, width) of the filters.
+        stride (optional): The step between patches.
+
+    Returns:
+        tensor (num_samples, num_filters * out_height * out_width)
+
+    """
+    patches = _image_patches(x, image_shape, kernel_shape, stride)
+    return numpy.matmul(patches, filters).transpose(0, 2, 1).reshape(
+        len(x), -1).astype(numpy.float32)
+
+def conv2d_transpose(y: T.Tensor, filters: T.Tensor, image_shape,
+                     kernel_shape, stride: int=1) -> T.Tensor:
+    """
+    Multiply a batch of flattened filter responses by the transpose of
+    the convolution in conv2d (i.e., scatter each response back onto
+    its patch and sum the overlaps).
+
+    Args:
+        y: A tensor (num_samples, num_filters * out_height * out_width).
+        filters: A tensor (channels * kernel_size, num_filters).
+        image_shape: (channels, height, width) of the images.
+        kernel_shape: (height, width) of the filters.
+        stride (optional): The step between patches.
+
+    Returns:
+        tensor (num_samples, channels * height * width)
+
+    """
+    channels = image_shape[0]
+    kernel_height, kernel_width = kernel_shape
+    out_height, out_width = _conv2d_output_shape(image_shape, kernel_shape,
+                                                 stride)
+    responses = y.reshape(len(y), filters.shape[1], out_height * out_width)
+    patches = numpy.matmul(numpy.swapaxes(responses, 1, 2),
+                           numpy.transpose(filters)).reshape(
+        len(y), out_height, out_width, channels, kernel_height, kernel_width)
+    images = numpy.zeros((len(y),) + tuple(image_shape), dtype=numpy.float32)
+    for i in range(kernel_height):
+        for j in range(kernel_width):
+            images[:, :, i:i + stride * (out_height - 1) + 1:stride,
+                         j:j + stride * (out_width - 1) + 1:stride] \
+                += patches[:, :, :, :, i, j].transpose(0, 3, 1, 2)
+    return images.reshape(len(y), -1)
+
+def conv2d_filter_outer(x: T.Tensor, y: T.Tensor, image_shape, kernel_shape,
+                        stride: int=1) -> T.Tensor:
+    """
+    Sum the outer products of the patches of a batch of flattened images
+    with the corresponding filter responses. This is batch_outer for the
+    weight sharing convolution in conv2d.
+
+    Args:
+        x: A tensor (num_samples, channels * height * width).
+        y: A tensor (num_samples, num_filters * out_height * out_width).
+        image_shape: (channels, height, width) of the images.
+        kernel_shape: (height, width) of the filters.
+        stride (optional): The step between patches.
+
+    Returns:
+        tensor (channels * kernel_size, num_filters)
+
+    """
+    patches = _image_patches(x, image_shape, kernel_shape, stride)
+    responses = y.reshape(len(y), -1, patches.shape[1])
+    return numpy.tensordot(patches, responses,
+                           axes=([0, 1], [0, 2])).astype(numpy.float32)
+
 def repeat(tensor: T.Tensor, n: int) -> T.Tensor:
     """
     Repeat tensor n times along the first axis.
@@ -248,7 +248,9 @@ def softplus(x: T.Tensor) -> T.Tensor:
         tensor: Elementwise softplus.
 
     """
-    return numpy.logaddexp(0, x)
+    # softplus(x) = max(x, 0) + log(1 + exp(-|x|)) is stable,
+    # and much faster than numpy.logaddexp
+    return numpy.log1p(numpy.exp(-numpy.abs(x))) + numpy.maximum(x, 0)
 
 def cos(x: T.Tensor) -> T.Tensor:
     """
@@ -1,15 +1,221 @@
-from .matrix import float_tensor
+from concurrent.futures import ThreadPoolExecutor
+import numpy
 import numpy.random as random
 from . import typedef as T
 
 DEFAULT_SEED = 137
 
+class RandomStream(object):
+    """
+    An independent stream of random numbers.
+
+    The stream is driven by a counter-based (Philox) bit generator,
+    so a stream can be split into any number of statistically independent
+    child streams (e.g., one for each worker process or chain) without
+    sharing any state. The numbers drawn from a stream depend only on its
+    seed and on the sequence of draws from that stream, not on the order
+    in which the streams are used.
+
+    """
+    def __init__(self, seed=DEFAULT_SEED):
+        """
+        Create a random stream.
+
+        Args:
+            seed (int or numpy.random.SeedSequence): the root seed
+
+        Returns:
+            RandomStream
+
+        """
+        if not isinstance(seed, random.SeedSequence):
+            seed = random.SeedSequence(int(seed))
+        self.seed_sequence = seed
+        self.generator = random.Generator(random.Philox(seed))
+
+    def spawn(self, n: int) -> T.List:
+        """
+        Create independent child streams.
+
+        Notes:
+            Successive calls return different children.
+
+        Args:
+            n: The number of child streams.
+
+        Returns:
+            List[RandomStream]
+
+        """
+        return [RandomStream(s) for s in self.seed_sequence.spawn(int(n))]
+
+    def rand(self, shape: T.Tuple[int], out: T.Tensor = None) -> T.Tensor:
+        """
+        Generate a tensor of the specified shape filled with uniform random
+        numbers between 0 and 1.
+
+        Notes:
+            The numbers are generated directly in single precision.
+
+        Args:
+            shape: Desired shape of the random tensor.
+            out (optional): A float32 tensor to write the numbers into.
+
+        Returns:
+            tensor: Random numbers between 0 and 1.
+
+        """
+        return self.generator.random(tuple(shape), dtype=numpy.float32,
+                                     out=out)
+
+    def randn(self, shape: T.Tuple[int], out: T.Tensor = None) -> T.Tensor:
+        """
+        Generate a tensor of the specified shape filled with random numbers
+        drawn from a standard normal distribution (mean = 0, variance = 1).
+
+        Notes:
+            The numbers are generated directly in single precision.
+
+        Args:
+            shape: Desired shape of the random tensor.
+            out (optional): A float32 tensor to write the numbers into.
+
+        Returns:
+            tensor: Random numbers from a standard normal distribution.
+
+        """
+        return self.generator.standard_normal(tuple(shape),
+                                              dtype=numpy.float32, out=out)
+
+    def randperm(self, n: int) -> T.Tensor:
+        """
+        Generate a random permutation of the integers 0, ..., n-1.
+
+        Args:
+            n: The number of integers.
+
+        Returns:
+            tensor (int64): A random permutation.
+
+        """
+        return self.generator.permutation(int(n))
+
+    def bits(self, shape: T.Tuple[int]) -> T.Tensor:
+        """
+        Generate a tensor of the specified shape filled with random
+        non-zero 64-bit integers (e.g., to seed other generators).
+
+        Args:
+            shape: Desired shape of the random tensor.
+
+        Returns:
+            tensor (uint64): Random integers.
+
+        """
+        return self.generator.integers(1, 2**64, size=tuple(shape),
+                                       dtype=numpy.uint64, endpoint=False)
+
+class UniformBuffer(object):
+    """
+    Uniform random numbers written into reusable buffers.
+
+    Can be used in place of rand (e.g., layer.rand = UniformBuffer()).
+    With background=True the next block of numbers is generated by a
+    thread while the caller works on the current one (e.g., while the
+    field on a layer is computed), because the numpy generators release
+    the GIL.
+
+    Notes:
+        The returned tensor is overwritten by the next call,
+        so it must be used (or copied) before then.
+
+    """
+    def __init__(self, stream: RandomStream = None, background: bool = False):
+        """
+        Create a uniform buffer.
+        The buffers are allocated on the first call.
+
+        Args:
+            stream (optional): The random stream to draw from.
+                Defaults to the current stream of the module, or, with
+                background=True, to a child of the current stream
+                spawned on the first call, so the numbers do not depend
+                on the timing of the thread.
+            background (optional): Whether to refill the buffers
+                from a background thread.
+
+        Returns:
+            UniformBuffer
+
+        """
+        self.stream = stream
+        self.background = background
+        self.executor = ThreadPoolExecutor(1) if background else None
+        self.buffers = None
+        self.current = 0
+        self.pending = None
+
+    def __call__(self, shape: T.Tuple[int]) -> T.Tensor:
+        """
+        Get a tensor of uniform random numbers between 0 and 1.
+
+        Args:
+            shape: Desired shape of the random tensor.
+
+        Returns:
+            tensor: Random numbers between 0 and 1.
+
+        """
+        shape = tuple(shape)
+        if self.stream is None and self.background:
+            self.stream = spawn_streams(1)[0]
+        stream = self.stream if self.stream is not None else _stream
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+        if self.buffers is None or self.buffers[0].shape != shape:
+            self.buffers = [numpy.empty(shape, dtype=numpy.float32)
+                            for _ in range(2 if self.background else 1)]
+            self.current = 0
+            stream.rand(shape, out=self.buffers[0])
+        elif not self.background:
+            stream.rand(shape, out=self.buffers[0])
+
+        r = self.buffers[self.current]
+        if self.background:
+            self.current = 1 - self.current
+            self.pending = self.executor.submit(stream.rand, shape,
+                                                self.buffers[self.current])
+        return r
+
+    def close(self) -> None:
+        """
+        Stop the background thread.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.pending = None
+            self.background = False
+            self.buffers = None
+
+# the stream used by the module level functions
+_stream = RandomStream(DEFAULT_SEED)
+
 def set_seed(n: int = DEFAULT_SEED) -> None:
     """
     Set the seed of the random number generator.
 
     Notes:
         Default seed is 137.
+        Also seeds the global numpy random state.
 
     Args:
         n: Random seed.
@@ -18,32 +224,90 @@ def set_seed(n: int = DEFAULT_SEED) -> None:
         None
 
     """
+    global _stream
     random.seed(int(n))
+    _stream = RandomStream(n)
+
+def get_stream() -> RandomStream:
+    """
+    Get the random stream used by rand and randn.
+
+    Args:
+        None
+
+    Returns:
+        RandomStream
+
+    """
+    return _stream
+
+def set_stream(stream: RandomStream) -> None:
+    """
+    Set the random stream used by rand and randn
+    (e.g., to a child stream in a worker process).
+
+    Args:
+        stream: A random stream.
+
+    Returns:
+        None
+
+    """
+    global _stream
+    _stream = stream
+
+def spawn_streams(n: int) -> T.List[RandomStream]:
+    """
+    Create independent child streams of the current random stream.
+
+    Args:
+        n: The number of child streams.
+
+    Returns:
+        List[RandomStream]
+
+    """
+    return _stream.spawn(n)
+
+def randperm(n: int) -> T.Tensor:
+    """
+    Generate a random permutation of the integers 0, ..., n-1.
+
+    Args:
+        n: The number of integers.
+
+    Returns:
+        tensor (int64): A random permutation.
+
+    """
+    return _stream.randperm(n)
 
-def rand(shape: T.Tuple[int]) -> T.Tensor:
+def rand(shape: T.Tuple[int], out: T.Tensor = None) -> T.Tensor:
     """
     Generate a tensor of the specified shape filled with uniform random numbers
     between 0 and 1.
 
     Args:
         shape: Desired shape of the random tensor.
+        out (optional): A float32 tensor to write the numbers into.
 
     Returns:
         tensor: Random numbers between 0 and 1.
 
     """
-    return float_tensor(random.rand(*shape))
+    return _stream.rand(shape, out)
 
-def randn(shape: T.Tuple[int]) -> T.Tensor:
+def randn(shape: T.Tuple[int], out: T.Tensor = None) -> T.Tensor:
     """
     Generate a tensor of the specified shape filled with random numbers
     drawn from a standard normal distribution (mean = 0, variance = 1).
 
     Args:
         shape: Desired shape of the random tensor.
+        out (optional): A float32 tensor to write the numbers into.
 
     Returns:
         tensor: Random numbers between from a standard normal distribution.
 
     """
-    return float_tensor(random.randn(*shape))
+    return _stream.randn(shape, out)
@@ -1,4 +1,4 @@
-from typing import Iterable, Tuple, Union, Dict
+from typing import Iterable, List, Tuple, Union, Dict
 from numpy import ndarray
 from numpy import float32
 
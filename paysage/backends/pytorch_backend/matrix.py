@@ -34,6 +34,24 @@ def float_tensor(tensor: T.Tensor) -> T.FloatTensor:
         # tensor is a torch object
         return tensor.float()
 
+def long_tensor(tensor: T.Tensor) -> T.LongTensor:
+    """
+    Cast tensor to a long (int64) tensor, e.g., to index another tensor.
+
+    Args:
+        tensor: A tensor.
+
+    Returns:
+        tensor: Tensor converted to int64.
+
+    """
+    try:
+        # tensor is a numpy object
+        return torch.LongTensor(tensor.astype(numpy.int64))
+    except Exception:
+        # tensor is a torch object
+        return tensor.long()
+
 def to_numpy_array(tensor: T.Tensor) -> T.NumpyTensor:
     """
     Return tensor as a numpy array.
@@ -336,6 +354,101 @@ def dtype(tensor: T.FloatTensor) -> type:
     """
     return tensor.type()
 
+_precisions = {
+    'float32': 'torch.FloatTensor',
+    'float16': 'torch.HalfTensor',
+    'uint8': 'torch.ByteTensor',
+    'int8': 'torch.CharTensor'
+}
+
+def cast_tensor(tensor: T.Tensor, precision: str) -> T.Tensor:
+    """
+    Convert a tensor to the given precision.
+
+    Notes:
+        Returns the tensor itself if it already has the precision.
+
+    Args:
+        tensor: A tensor.
+        precision: 'float32', 'float16', 'uint8', or 'int8'.
+
+    Returns:
+        tensor: The converted tensor.
+
+    """
+    return tensor.type(_precisions[precision])
+
+def copy_inplace(x: T.FloatTensor, y: T.FloatTensor) -> None:
+    """
+    Copy the elements of a tensor (y) into a tensor with the same shape (x).
+
+    x <- y
+
+    Note:
+        Modifies x in place.
+
+    Args:
+        x: A tensor.
+        y: A tensor.
+
+    Returns:
+        None
+
+    """
+    x.copy_(y)
+
+def index_select(x: T.FloatTensor, index: T.LongTensor,
+                 axis: int = 0) -> T.FloatTensor:
+    """
+    Select the entries of a tensor at the given indices along an axis.
+
+    Args:
+        x: A tensor.
+        index: A tensor of integer indices.
+        axis (optional): The axis to select along.
+
+    Returns:
+        tensor: The selected entries.
+
+    """
+    return x.index_select(axis, index)
+
+def index_copy_inplace(x: T.FloatTensor, index: T.LongTensor,
+                       y: T.FloatTensor, axis: int = 0) -> None:
+    """
+    Copy the elements of a tensor (y) into the entries of
+    a tensor (x) at the given indices along an axis.
+
+    x[..., index, ...] <- y
+
+    Note:
+        Modifies x in place.
+
+    Args:
+        x: A tensor.
+        index: A tensor of integer indices.
+        y: A tensor.
+        axis (optional): The axis to copy along.
+
+    Returns:
+        None
+
+    """
+    x.index_copy_(axis, index, y)
+
+def flatnonzero(x: T.Tensor) -> T.LongTensor:
+    """
+    Return the indices of the nonzero elements of the flattened tensor.
+
+    Args:
+        x: A tensor.
+
+    Returns:
+        tensor (int64): The indices of the nonzero elements.
+
+    """
+    return torch.nonzero(x.contiguous().view(-1)).view(-1)
+
 def mix_inplace(w: T.Scalar,
                 x: T.FloatTensor,
                 y: T.FloatTensor) -> None:
@@ -1123,6 +1236,117 @@ def batch_outer(vis: T.FloatTensor, hid: T.FloatTensor) -> T.FloatTensor:
     """
     return dot(transpose(vis), hid)
 
+def batch_matmul(a: T.FloatTensor, b: T.FloatTensor) -> T.FloatTensor:
+    """
+    Multiply stacks of matrices.
+
+    If a is a K x L x N tensor and b is a K x N x M tensor, then
+    batch_matmul(a, b)[k] = a[k] b[k] is a K x L x M tensor.
+    A 2D tensor is multiplied with every matrix of the other stack.
+
+    Args:
+        a: A tensor.
+        b: A tensor.
+
+    Returns:
+        tensor: A stack of matrices.
+
+    """
+    return torch.matmul(a, b)
+
+def batch_transpose(a: T.FloatTensor) -> T.FloatTensor:
+    """
+    Transpose each matrix in a stack of matrices
+    (i.e., swap the last two axes).
+
+    Args:
+        a: A tensor.
+
+    Returns:
+        tensor: A view of the stack of transposed matrices.
+
+    """
+    return a.transpose(-2, -1)
+
+def conv2d(x: T.FloatTensor, filters: T.FloatTensor, image_shape,
+           kernel_shape, stride: int=1) -> T.FloatTensor:
+    """
+    Compute the valid 2D convolution (cross-correlation) of a batch of
+    flattened images with a bank of filters.
+
+    The images are flattened in (channel, row, column) order, and the
+    filters are the columns of a (channels * kernel_height * kernel_width)
+    x num_filters matrix. The result is flattened in
+    (filter, row, column) order.
+
+    Args:
+        x: A tensor (num_samples, channels * height * width).
+        filters: A tensor (channels * kernel_size, num_filters).
+        image_shape: (channels, height, width) of the images.
+        kernel_shape: (height, width) of the filters.
+        stride (optional): The step between patches.
+
+    Returns:
+        tensor (num_samples, num_filters * out_height * out_width)
+
+    """
+    kernels = filters.t().contiguous().view(
+        filters.size(1), image_shape[0], *kernel_shape)
+    images = x.contiguous().view(x.size(0), *image_shape)
+    return torch.nn.functional.conv2d(images, kernels, stride=stride).view(
+        x.size(0), -1)
+
+def conv2d_transpose(y: T.FloatTensor, filters: T.FloatTensor, image_shape,
+                     kernel_shape, stride: int=1) -> T.FloatTensor:
+    """
+    Multiply a batch of flattened filter responses by the transpose of
+    the convolution in conv2d (i.e., scatter each response back onto
+    its patch and sum the overlaps).
+
+    Args:
+        y: A tensor (num_samples, num_filters * out_height * out_width).
+        filters: A tensor (channels * kernel_size, num_filters).
+        image_shape: (channels, height, width) of the images.
+        kernel_shape: (height, width) of the filters.
+        stride (optional): The step between patches.
+
+    Returns:
+        tensor (num_samples, channels * height * width)
+
+    """
+    num_filters = filters.size(1)
+    patches = torch.matmul(
+        y.contiguous().view(y.size(0), num_filters, -1).transpose(1, 2),
+        filters.t())
+    return torch.nn.functional.fold(
+        patches.transpose(1, 2), tuple(image_shape[1:]),
+        tuple(kernel_shape), stride=stride).view(y.size(0), -1)
+
+def conv2d_filter_outer(x: T.FloatTensor, y: T.FloatTensor, image_shape,
+                        kernel_shape, stride: int=1) -> T.FloatTensor:
+    """
+    Sum the outer products of the patches of a batch of flattened images
+    with the corresponding filter responses. This is batch_outer for the
+    weight sharing convolution in conv2d.
+
+    Args:
+        x: A tensor (num_samples, channels * height * width).
+        y: A tensor (num_samples, num_filters * out_height * out_width).
+        image_shape: (channels, height, width) of the images.
+        kernel_shape: (height, width) of the filters.
+        stride (optional): The step between patches.
+
+    Returns:
+        tensor (channels * kernel_size, num_filters)
+
+    """
+    # (N, C * kh * kw, num_patches)
+    patches = torch.nn.functional.unfold(
+        x.contiguous().view(x.size(0), *image_shape),
+        tuple(kernel_shape), stride=stride)
+    responses = y.contiguous().view(y.size(0), -1, patches.size(2))
+    return torch.matmul(patches, responses.transpose(1, 2)).sum(0)
+
 def repeat(tensor: T.FloatTensor, n: int) -> T.FloatTensor:
     """
     Repeat tensor n times along specified axis.
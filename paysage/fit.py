@@ -1,19 +1,265 @@
 import time, math
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+from . import anneal
 from . import backends as be
 from . import metrics as M
+from . import parallel
+from . import partition
 from paysage.models.model import State
 
 
+class ChainDiagnostics(object):
+    """
+    Streaming mixing diagnostics of a set of Markov chains.
+
+    The energy of each chain is recorded after every update of the chains.
+    Only the last max_lag energies are stored, together with running sums
+    of the energies, their squares, and their lagged products, so the memory
+    does not grow with the length of the run. From these the diagnostics
+    compute the autocorrelation function of the energy, the integrated
+    autocorrelation time, the effective sample size, and the fraction of
+    units in each layer that change per update.
+
+    Sokal, Alan.
+    "Monte Carlo methods in statistical mechanics: foundations and new
+    algorithms."
+    Functional integration. Springer US, 1997. 131-192.
+
+    """
+    def __init__(self, max_lag=20):
+        """
+        Create a chain diagnostics object.
+
+        Args:
+            max_lag (int): the largest lag of the autocorrelation function
+
+        Returns:
+            ChainDiagnostics
+
+        """
+        self.max_lag = max_lag
+        self.reset()
+
+    def reset(self):
+        """
+        Discard the recorded statistics.
+
+        Notes:
+            Modifies the statistics attributes in place.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        self.count = 0
+        self.history = None
+        self.energy_sum = None
+        self.energy_square_sum = None
+        self.lag_sum = None
+        self.previous = None
+        self.flip_sum = None
+        self.flip_count = 0
+
+    def add_sample(self, energy, units):
+        """
+        Record the energies and units of the chains after an update.
+
+        Notes:
+            Modifies the statistics attributes in place.
+            Resets the statistics if the number of chains changes.
+
+        Args:
+            energy (array (num_chains,)): the energy of each chain
+            units (List[array (num_chains, num_units)]): the units of
+                each layer
+
+        Returns:
+            None
+
+        """
+        energy = numpy.asarray(energy, dtype=numpy.float64)
+        if self.history is not None and \
+            self.history.shape[1] != len(energy):
+            self.reset()
+        if self.history is None:
+            num_chains = len(energy)
+            self.history = numpy.zeros((self.max_lag, num_chains))
+            self.energy_sum = numpy.zeros(num_chains)
+            self.energy_square_sum = numpy.zeros(num_chains)
+            self.lag_sum = numpy.zeros((self.max_lag, num_chains))
+            self.flip_sum = numpy.zeros(len(units))
+
+        # products with the energies 1, ..., max_lag updates ago
+        n = self.count
+        lags = min(n, self.max_lag)
+        rows = (n - numpy.arange(1, lags + 1)) % self.max_lag
+        self.lag_sum[:lags] += self.history[rows] * energy
+        self.history[n % self.max_lag] = energy
+        self.energy_sum += energy
+        self.energy_square_sum += energy * energy
+        self.count += 1
+
+        if self.previous is not None:
+            self.flip_sum += [numpy.mean(u != p)
+                              for u, p in zip(units, self.previous)]
+            self.flip_count += 1
+        self.previous = [numpy.array(u) for u in units]
+
+    def update(self, model, state):
+        """
+        Record the state of the chains after an update.
+
+        Args:
+            model: a model object
+            state (State): the current state of the chains
+
+        Returns:
+            None
+
+        """
+        self.add_sample(be.to_numpy_array(model.joint_energy(state)),
+                        [be.to_numpy_array(u) for u in state.units])
+
+    def autocorrelation(self):
+        """
+        Compute the autocorrelation function of the energy,
+        averaged over the chains.
+
+        Args:
+            None
+
+        Returns:
+            numpy array (max_lag,): the autocorrelation at lags 1, 2, ...
+                (nan for lags that have not been observed)
+
+        """
+        rho = numpy.full(self.max_lag, numpy.nan)
+        if self.count < 2:
+            return rho
+        n = self.count
+        mean = self.energy_sum / n
+        variance = numpy.mean(self.energy_square_sum / n - mean * mean)
+        if variance <= 0:
+            rho[:min(n - 1, self.max_lag)] = 1
+            return rho
+        for k in range(1, min(n - 1, self.max_lag) + 1):
+            covariance = self.lag_sum[k-1] / (n - k) - mean * mean
+            rho[k-1] = numpy.mean(covariance) / variance
+        return rho
+
+    def integrated_autocorrelation_time(self):
+        """
+        Compute the integrated autocorrelation time of the energy,
+        tau = 1 + 2 sum_k rho_k, in units of chain updates.
+
+        Notes:
+            The sum is truncated at the first non-positive autocorrelation.
+
+        Args:
+            None
+
+        Returns:
+            float
+
+        """
+        rho = self.autocorrelation()
+        if numpy.isnan(rho[0]):
+            return float('nan')
+        tau = 1.0
+        for r in rho:
+            if numpy.isnan(r) or r <= 0:
+                break
+            tau += 2 * r
+        return float(tau)
+
+    def effective_sample_size(self):
+        """
+        Compute the effective number of independent samples
+        recorded from all of the chains.
+
+        Args:
+            None
+
+        Returns:
+            float
+
+        """
+        num_chains = 0 if self.history is None else self.history.shape[1]
+        return num_chains * self.count / self.integrated_autocorrelation_time()
+
+    def flip_rates(self):
+        """
+        Compute the average fraction of the units of each layer
+        that change per update.
+
+        Args:
+            None
+
+        Returns:
+            List[float]
+
+        """
+        if not self.flip_count:
+            return []
+        return list(self.flip_sum / self.flip_count)
+
+    def summary(self):
+        """
+        Get the diagnostics in a dictionary.
+
+        Notes:
+            The hidden flip rate is averaged over the hidden layers.
+
+        Args:
+            None
+
+        Returns:
+            OrderedDict
+
+        """
+        rates = self.flip_rates()
+        return OrderedDict([
+            ('IntegratedAutocorrelationTime',
+             self.integrated_autocorrelation_time()),
+            ('EffectiveSampleSize', self.effective_sample_size()),
+            ('VisibleFlipRate', rates[0] if rates else float('nan')),
+            ('HiddenFlipRate',
+             float(numpy.mean(rates[1:])) if len(rates) > 1 else float('nan'))
+        ])
+
+
 class Sampler(object):
     """Base class for the sequential Monte Carlo samplers"""
-    def __init__(self, model, method='stochastic', **kwargs):
+    def __init__(self, model, method='stochastic', num_workers=0,
+                 inplace=False, diagnostics=None, **kwargs):
         """
         Create a sampler.
 
+        Notes:
+            Stochastic updates of Bernoulli-Bernoulli RBMs can use a
+            compiled Gibbs kernel by setting model.use_fused_sampler = True
+            (off by default; see paysage.models.fused_gibbs).
+
         Args:
             model: a model object
             method (str; optional): how to update the particles
+            num_workers (int; optional): if positive, the negative phase
+                particles are split across a pool of worker processes.
+                The negative state is then a view of double-buffered
+                shared memory that is overwritten two updates later,
+                copy it (State.from_state) to keep it. Close the pool
+                with close() or by using the sampler as a context manager.
+            inplace (bool; optional): if True, the negative phase particles
+                are updated in two preallocated States owned by the sampler
+                instead of being copied at every step. As with workers, the
+                negative state is overwritten two updates later.
+            diagnostics (ChainDiagnostics; optional): if provided, records
+                the mixing of the negative phase chains after every update
             kwargs (optional)
 
         Returns:
@@ -26,13 +272,87 @@ class Sampler(object):
 
         self.method = method
         if self.method == 'stochastic':
-            self.updater = self.model.markov_chain
+            self.updater_name = 'markov_chain'
         elif self.method == 'mean_field':
-            self.updater = self.model.mean_field_iteration
+            self.updater_name = 'mean_field_iteration'
         elif self.method == 'deterministic':
-            self.updater = self.model.deterministic_iteration
+            self.updater_name = 'deterministic_iteration'
         else:
             raise ValueError("Unknown method {}".format(self.method))
+        self.updater = getattr(self.model, self.updater_name)
+
+        self.num_workers = num_workers
+        self.pool = None
+
+        self.inplace = inplace
+        self.buffers = None
+
+        self.diagnostics = diagnostics
+
+    def _buffer(self, state):
+        """
+        Get the preallocated State to write the next negative state into.
+
+        Notes:
+            Allocates the buffers on the first call or if the shapes change.
+
+        Args:
+            state (State): the current state of each layer
+
+        Returns:
+            State
+
+        """
+        shapes = [be.shape(u) for u in state.units]
+        if self.buffers is None or \
+            [be.shape(u) for u in self.buffers[0].units] != shapes:
+            self.buffers = [State.from_state(state), State.from_state(state)]
+        return self.buffers[1] if state is self.buffers[0] \
+                                else self.buffers[0]
+
+    def _advance(self, steps, state, beta=None):
+        """
+        Advance the negative phase particles.
+        Uses the process pool if the sampler has workers.
+
+        Args:
+            steps (int): the number of Monte Carlo steps
+            state (State): the current state of each layer
+            beta (optional, tensor (batch_size, 1)): Inverse temperatures
+
+        Returns:
+            new state
+
+        """
+        if not self.num_workers:
+            if self.inplace:
+                return self.updater(steps, state, beta,
+                                    out=self._buffer(state))
+            return self.updater(steps, state, beta)
+        if self.pool is None:
+            self.pool = parallel.ModelPool(self.model, self.num_workers)
+        return self.pool.advance(self.updater_name, steps, state, beta)
+
+    def close(self):
+        """
+        Shut down the process pool of the sampler, if there is one.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def set_positive_state(self, state):
         """
@@ -81,38 +401,605 @@ class Sampler(object):
         Create a sampler from a batch object.
 
         Args:
-            model: a Model object
-            batch: a Batch object
-            method (str; optional): how to update the particles
-            kwargs (optional)
+            model: a Model object
+            batch: a Batch object
+            method (str; optional): how to update the particles
+            kwargs (optional)
+
+        Returns:
+            sampler
+
+        """
+        tmp = cls(model, method=method, **kwargs)
+        vdata = batch.get('train')
+        tmp.set_positive_state(State.from_visible(vdata, model))
+        tmp.set_negative_state(State.from_visible(vdata, model))
+        batch.reset_generator('all')
+        return tmp
+
+
+class SequentialMC(Sampler):
+    """Basic sequential Monte Carlo sampler"""
+    def __init__(self, model, method='stochastic', num_workers=0,
+                 inplace=False, diagnostics=None):
+        """
+        Create a sequential Monte Carlo sampler.
+
+        Args:
+            model: a model object
+            method (str; optional): how to update the particles
+            num_workers (int; optional): number of worker processes
+                for the negative phase (0 runs in this process).
+                See Sampler for the lifetime of the negative state.
+            inplace (bool; optional): update the negative phase particles
+                in preallocated States (see Sampler)
+            diagnostics (ChainDiagnostics; optional): records the mixing
+                of the negative phase chains
+
+        Returns:
+            SequentialMC
+
+        """
+        super().__init__(model, method=method, num_workers=num_workers,
+                         inplace=inplace, diagnostics=diagnostics)
+
+    def update_positive_state(self, steps):
+        """
+        Update the positive state of the particles.
+
+        Notes:
+            Modifies the state attribute in place.
+
+        Args:
+            steps (int): the number of Monte Carlo steps
+
+        Returns:
+            None
+
+        """
+        if not self.pos_state:
+            raise AttributeError(
+                  'You must call the initialize(self, array_or_shape)'
+                  +' method to set the initial state of the Markov Chain')
+        self.pos_state = self.updater(steps, self.pos_state)
+
+    def update_negative_state(self, steps):
+        """
+        Update the negative state of the particles.
+
+        Notes:
+            Modifies the state attribute in place.
+
+        Args:
+            steps (int): the number of Monte Carlo steps
+
+        Returns:
+            None
+
+        """
+        if not self.neg_state:
+            raise AttributeError(
+                  'You must call the initialize(self, array_or_shape)'
+                  +' method to set the initial state of the Markov Chain')
+        self.neg_state = self._advance(steps, self.neg_state)
+        if self.diagnostics is not None:
+            self.diagnostics.update(self.model, self.neg_state)
+
+class DrivenSequentialMC(Sampler):
+    """An accelerated sequential Monte Carlo sampler"""
+    def __init__(self, model, beta_momentum=0.9, beta_std=0.2,
+                 method='stochastic', num_workers=0, inplace=False,
+                 diagnostics=None):
+        """
+        Create a sequential Monte Carlo sampler.
+
+        Args:
+            model: a model object
+            beta_momentum (float in [0,1]): autoregressive coefficient of beta
+            beta_std (float > 0): the standard deviation of beta
+            method (str; optional): how to update the particles
+            num_workers (int; optional): number of worker processes
+                for the negative phase (0 runs in this process).
+                See Sampler for the lifetime of the negative state.
+            inplace (bool; optional): update the negative phase particles
+                in preallocated States (see Sampler)
+            diagnostics (ChainDiagnostics; optional): records the mixing
+                of the negative phase chains
+
+        Returns:
+            SequentialMC
+
+        """
+        super().__init__(model, method=method, num_workers=num_workers,
+                         inplace=inplace, diagnostics=diagnostics)
+        self.beta_momentum = beta_momentum
+        self.beta_std = beta_std
+        self.beta = None
+        self.has_beta = False
+
+    def _update_beta(self):
+        """
+        Update beta with an AR(1) process.
+
+        AR(1) process: X_t = momentum * X_(t-1) + loc + scale * noise
+        E[X] = loc / (1 - momentum)
+             -> loc = E[X] * (1 - momentum)
+        Var[X] = scale ** 2 / (1 - momentum**2)
+               -> scale = sqrt(Var[X] * (1 - momentum**2))
+
+        Notes:
+            Modifies the folling attributes in place:
+                has_beta, beta_shape, beta_loc, beta_scale, beta
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if not self.has_beta:
+            self.has_beta = True
+            if self.pos_state:
+                self.beta_shape = (be.shape(self.pos_state.units[0])[0], 1)
+            else:
+                self.beta_shape = (be.shape(self.neg_state.units[0])[0], 1)
+            self.beta_loc = (1-self.beta_momentum) * be.ones(self.beta_shape)
+            self.beta_scale = self.beta_std * math.sqrt(1-self.beta_momentum**2)
+            self.beta = be.ones(self.beta_shape)
+
+        self.beta *= self.beta_momentum
+        self.beta += self.beta_loc
+        self.beta += self.beta_scale * be.randn(self.beta_shape)
+
+    def update_positive_state(self, steps):
+        """
+        Update the state of the particles.
+
+        Notes:
+            Modifies the state attribute in place.
+            Calls _update_beta() method.
+
+        Args:
+            steps (int): the number of Monte Carlo steps
+
+        Returns:
+            None
+
+        """
+        if not self.pos_state:
+            raise AttributeError(
+                  'You must call the initialize(self, array_or_shape)'
+                  +' method to set the initial state of the Markov Chain')
+        self.pos_state = self.updater(steps, self.pos_state, self.beta)
+
+    def update_negative_state(self, steps):
+        """
+        Update the negative state of the particles.
+
+        Notes:
+            Modifies the state attribute in place.
+            Calls _update_beta() method.
+
+        Args:
+            steps (int): the number of Monte Carlo steps
+
+        Returns:
+            None
+
+        """
+        if not self.neg_state:
+            raise AttributeError(
+                  'You must call the initialize(self, array_or_shape)'
+                  +' method to set the initial state of the Markov Chain')
+        self._update_beta()
+        self.neg_state = self._advance(steps, self.neg_state, self.beta)
+        if self.diagnostics is not None:
+            self.diagnostics.update(self.model, self.neg_state)
+
+
+class ParticleBank(Sampler):
+    """
+    Persistent sampler that keeps a large bank of fantasy particles
+    and advances a subset of them at each update.
+
+    The number of particles is independent of the minibatch size, so many
+    chains can be kept for better mixing while the work per gradient step
+    is set by the number of active particles. The selected subset is the
+    negative state used for the gradient.
+
+    Example usage:
+    '''
+    sampler = ParticleBank(rbm, num_particles=100000, num_active=100)
+    sampler.set_negative_state(State.from_visible(vdata, rbm))
+    '''
+
+    """
+    def __init__(self, model, num_particles, num_active=None,
+                 selection='random', filename=None, method='stochastic',
+                 num_workers=0):
+        """
+        Create a particle bank sampler.
+
+        Args:
+            model: a model object
+            num_particles (int): the number of particles in the bank
+            num_active (int; optional): the number of particles advanced at
+                each update (defaults to the size of the positive state)
+            selection (str; optional): how to choose the active particles,
+                'random' (without replacement) or 'round_robin'
+            filename (str; optional): if provided, the bank is stored in
+                memory-mapped files with this prefix (python backend only)
+            method (str; optional): how to update the particles
+            num_workers (int; optional): number of worker processes
+                for the negative phase (0 runs in this process)
+
+        Returns:
+            ParticleBank
+
+        """
+        super().__init__(model, method=method, num_workers=num_workers)
+        if selection not in ['random', 'round_robin']:
+            raise ValueError("Unknown selection {}".format(selection))
+        if filename is not None and be.config['backend'] != 'python':
+            raise NotImplementedError(
+                "Memory-mapped particle banks require the python backend")
+        self.num_particles = num_particles
+        self.num_active = num_active
+        self.selection = selection
+        self.filename = filename
+        self.bank = None
+        self.position = 0
+        self.index = None
+
+    def _allocate(self, shapes):
+        """
+        Allocate the storage of the bank.
+
+        Notes:
+            The particles of each layer are stored in the precision
+            of the layer.
+
+        Args:
+            shapes (List[tuple]): the shape of each layer of the bank
+
+        Returns:
+            List[tensor]
+
+        """
+        precisions = [ly.precision for ly in self.model.layers]
+        if self.filename is None:
+            return [be.cast_tensor(be.zeros(shape), precision)
+                    for shape, precision in zip(shapes, precisions)]
+        return [numpy.memmap('{}_{}.dat'.format(self.filename, i),
+                             dtype=precision, mode='w+', shape=shape)
+                for i, (shape, precision)
+                in enumerate(zip(shapes, precisions))]
+
+    def set_negative_state(self, state):
+        """
+        Fill the bank of particles.
+
+        Notes:
+            Modifies the bank attribute in place.
+            If the state has a different number of rows than the bank,
+            the visible units are drawn from its rows (each row is used
+            equally often, up to one, in a random order) and the hidden
+            units are random.
+
+        Args:
+            state (State): the initial state of the particles
+
+        Returns:
+            None
+
+        """
+        num_samples = be.shape(state.units[0])[0]
+        if num_samples != self.num_particles:
+            index = be.randperm(self.num_particles) % num_samples
+            vis = be.index_select(state.units[0], index)
+            state = State.from_visible(vis, self.model)
+        shapes = [(self.num_particles, be.shape(u)[1]) for u in state.units]
+        self.bank = State(self._allocate(shapes))
+        for b, u in zip(self.bank.units, state.units):
+            be.copy_inplace(b, u)
+        self.neg_state = None
+        self.position = 0
+
+    def _select(self, num_active):
+        """
+        Choose the indices of the active particles.
+
+        Args:
+            num_active (int): the number of particles to select
+
+        Returns:
+            tensor (num_active,): long tensor of indices
+
+        """
+        if self.selection == 'random':
+            return be.randperm(self.num_particles)[:num_active]
+        index = (self.position + numpy.arange(num_active)) % self.num_particles
+        self.position = (self.position + num_active) % self.num_particles
+        return be.long_tensor(index)
+
+    def update_positive_state(self, steps):
+        """
+        Update the positive state of the particles.
+
+        Notes:
+            Modifies the state attribute in place.
+
+        Args:
+            steps (int): the number of Monte Carlo steps
+
+        Returns:
+            None
+
+        """
+        if not self.pos_state:
+            raise AttributeError(
+                  'You must call the initialize(self, array_or_shape)'
+                  +' method to set the initial state of the Markov Chain')
+        self.pos_state = self.updater(steps, self.pos_state)
+
+    def update_negative_state(self, steps):
+        """
+        Advance a subset of the particles and store them in the bank.
+
+        Notes:
+            Modifies the bank and the negative state in place.
+
+        Args:
+            steps (int): the number of Monte Carlo steps
+
+        Returns:
+            None
+
+        """
+        if self.bank is None:
+            raise AttributeError(
+                  'You must call the set_negative_state(self, state)'
+                  +' method to fill the bank of particles')
+        num_active = self.num_active
+        if num_active is None:
+            num_active = be.shape(self.pos_state.units[0])[0] \
+                         if self.pos_state else self.num_particles
+        self.index = self._select(min(num_active, self.num_particles))
+        state = State([be.index_select(u, self.index)
+                       for u in self.bank.units])
+        self.neg_state = self._advance(steps, state)
+        for b, u in zip(self.bank.units, self.neg_state.units):
+            be.index_copy_inplace(b, self.index, u)
+
+    def close(self):
+        """
+        Shut down the process pool and flush a memory-mapped bank.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        super().close()
+        if self.filename is not None and self.bank is not None:
+            for b in self.bank.units:
+                b.flush()
+
+
+class ParallelTempering(Sampler):
+    """
+    Parallel tempering (replica exchange) sampler.
+
+    Earl, David J., and Michael W. Deem.
+    "Parallel tempering: Theory, applications, and new perspectives."
+    Physical Chemistry Chemical Physics 7.23 (2005): 3910-3916.
+
+    """
+    def __init__(self, model, num_replicas=5, beta_min=0.2,
+                 swap_momentum=0.9, adapt_rate=0.1, steps_per_swap=1,
+                 method='stochastic', num_workers=0):
+        """
+        Create a parallel tempering sampler.
+
+        Notes:
+            All of the replicas are stored in a single stacked State,
+            with the rows of replica r at [r * num_chains, (r+1) * num_chains).
+            Replica 0 is the cold chain at beta = 1.
+
+            Each round of replica exchanges evaluates the joint energy of
+            all replicas twice. With num_workers > 0 every block of
+            steps_per_swap Monte Carlo steps is also a round trip to the
+            process pool, so use larger blocks when sampling with workers.
+
+        Args:
+            model: a model object
+            num_replicas (int >= 2): the number of temperatures in the ladder
+            beta_min (float in (0,1)): the inverse temperature of the
+                hottest replica
+            swap_momentum (float in [0,1]): autoregressive coefficient of
+                the running average of the swap acceptance rates
+            adapt_rate (float >= 0): how strongly to adjust the ladder
+                towards equal swap rates (0 keeps the ladder fixed)
+            steps_per_swap (int >= 1): the number of Monte Carlo steps
+                between rounds of replica exchanges
+            method (str; optional): how to update the particles
+            num_workers (int; optional): number of worker processes
+                for the replicas (0 runs in this process)
+
+        Returns:
+            ParallelTempering
+
+        """
+        super().__init__(model, method=method, num_workers=num_workers)
+        assert num_replicas >= 2, "Parallel tempering requires 2+ replicas"
+        self.num_replicas = num_replicas
+        self.beta_min = beta_min
+        self.swap_momentum = swap_momentum
+        self.adapt_rate = adapt_rate
+        self.steps_per_swap = steps_per_swap
+
+        # geometric ladder from 1 down to beta_min
+        self.betas = [beta_min ** (r / (num_replicas - 1))
+                      for r in range(num_replicas)]
+        self.swap_rates = [0.5 for _ in range(num_replicas - 1)]
+
+        self.num_chains = None
+        self.replica_state = None
+        self.beta = None
+        self.parity = 0
+
+    def _build_beta(self, betas):
+        """
+        Expand a ladder of inverse temperatures onto the stacked replicas.
+
+        Args:
+            betas (List[float]): an inverse temperature for each replica
+
+        Returns:
+            tensor (num_replicas * num_chains, 1)
+
+        """
+        column = be.ones((self.num_chains, 1))
+        return be.vstack([b * column for b in betas])
+
+    def _replica(self, tensor, r):
+        """
+        Get the rows of a stacked tensor that belong to replica r.
+
+        Args:
+            tensor: a stacked tensor (num_replicas * num_chains, ...)
+            r (int): the index of the replica
+
+        Returns:
+            tensor (num_chains, ...)
+
+        """
+        return tensor[r * self.num_chains: (r + 1) * self.num_chains]
+
+    def _cold_state(self):
+        """
+        Get the cold (beta = 1) replica from the stacked state.
+
+        Args:
+            None
+
+        Returns:
+            State
+
+        """
+        return State([self._replica(u, 0) for u in self.replica_state.units])
+
+    def set_negative_state(self, state):
+        """
+        Set up the initial states for each of the Markov Chains.
+        Every replica is initialized from the same state.
+
+        Notes:
+            Modifies the state attributes in place.
+
+        Args:
+            state (State): the initial state of the cold replica
+
+        Returns:
+            None
+
+        """
+        self.num_chains = be.shape(state.units[0])[0]
+        self.replica_state = State([be.vstack([u] * self.num_replicas)
+                                    for u in state.units])
+        self.beta = self._build_beta(self.betas)
+        self.neg_state = self._cold_state()
+
+    def _swap(self):
+        """
+        Attempt to exchange the configurations of neighboring replicas.
+        Alternates between the (even, odd) and (odd, even) neighbor pairs.
+
+        The acceptance probability of exchanging replicas r and r+1 is
+        min(1, exp(E_r(x_r) + E_{r+1}(x_{r+1}) - E_r(x_{r+1}) - E_{r+1}(x_r)))
+        where E_r is the joint energy at inverse temperature beta_r.
+
+        Notes:
+            Modifies the units of replica_state and the swap_rates
+            attribute in place.
+
+        Args:
+            None
 
         Returns:
-            sampler
+            None
 
         """
-        tmp = cls(model, method=method, **kwargs)
-        vdata = batch.get('train')
-        tmp.set_positive_state(State.from_visible(vdata, model))
-        tmp.set_negative_state(State.from_visible(vdata, model))
-        batch.reset_generator('all')
-        return tmp
+        pairs = list(range(self.parity, self.num_replicas - 1, 2))
+        self.parity = 1 - self.parity
+        if not pairs:
+            return
+
+        # the energy of each replica at its own and at its partner's beta
+        swapped_betas = list(self.betas)
+        for r in pairs:
+            swapped_betas[r] = self.betas[r+1]
+            swapped_betas[r+1] = self.betas[r]
+        own_energy = self.model.joint_energy(self.replica_state, self.beta)
+        swap_energy = self.model.joint_energy(self.replica_state,
+                                              self._build_beta(swapped_betas))
+
+        for r in pairs:
+            delta = (self._replica(swap_energy, r)
+                   + self._replica(swap_energy, r+1)
+                   - self._replica(own_energy, r)
+                   - self._replica(own_energy, r+1))
+            prob = be.exp(be.clip(-delta, a_max=0.0))
+            accept = be.float_tensor(be.rand(be.shape(prob)) < prob)
+
+            self.swap_rates[r] = (self.swap_momentum * self.swap_rates[r]
+                + (1 - self.swap_momentum) * float(be.mean(accept)))
+
+            accept = be.unsqueeze(accept, 1)
+            lo = slice(r * self.num_chains, (r + 1) * self.num_chains)
+            hi = slice((r + 1) * self.num_chains, (r + 2) * self.num_chains)
+            for u in self.replica_state.units:
+                lower, upper = u[lo], u[hi]
+                mask = be.broadcast(accept, lower)
+                new_lower = (1 - mask) * lower + mask * upper
+                new_upper = (1 - mask) * upper + mask * lower
+                u[lo] = new_lower
+                u[hi] = new_upper
+
+    def _adapt_ladder(self):
+        """
+        Adjust the inverse temperatures towards equal swap rates.
 
+        The gaps between neighboring inverse temperatures are rescaled by
+        exp(adapt_rate * (swap_rate - mean_swap_rate)) and renormalized,
+        so the endpoints beta = 1 and beta = beta_min are fixed.
 
-class SequentialMC(Sampler):
-    """Basic sequential Monte Carlo sampler"""
-    def __init__(self, model, method='stochastic'):
-        """
-        Create a sequential Monte Carlo sampler.
+        Notes:
+            Modifies the betas and beta attributes in place.
 
         Args:
-            model: a model object
-            method (str; optional): how to update the particles
+            None
 
         Returns:
-            SequentialMC
+            None
 
         """
-        super().__init__(model, method=method)
+        if not self.adapt_rate:
+            return
+        mean_rate = sum(self.swap_rates) / len(self.swap_rates)
+        gaps = [(self.betas[r] - self.betas[r+1])
+                * math.exp(self.adapt_rate * (self.swap_rates[r] - mean_rate))
+                for r in range(self.num_replicas - 1)]
+        norm = (1 - self.beta_min) / sum(gaps)
+        betas = [1.0]
+        for g in gaps[:-1]:
+            betas.append(betas[-1] - norm * g)
+        betas.append(self.beta_min)
+        self.betas = betas
+        self.beta = self._build_beta(self.betas)
 
     def update_positive_state(self, steps):
         """
@@ -120,6 +1007,7 @@ class SequentialMC(Sampler):
 
         Notes:
             Modifies the state attribute in place.
+            The positive phase is not tempered.
 
         Args:
             steps (int): the number of Monte Carlo steps
@@ -137,9 +1025,13 @@ class SequentialMC(Sampler):
     def update_negative_state(self, steps):
         """
         Update the negative state of the particles.
+        Each Monte Carlo step updates all of the replicas at once,
+        and every steps_per_swap steps are followed by a round of
+        replica exchanges.
 
         Notes:
-            Modifies the state attribute in place.
+            Modifies the state attributes in place.
+            Adapts the temperature ladder.
 
         Args:
             steps (int): the number of Monte Carlo steps
@@ -152,44 +1044,51 @@ class SequentialMC(Sampler):
             raise AttributeError(
                   'You must call the initialize(self, array_or_shape)'
                   +' method to set the initial state of the Markov Chain')
-        self.neg_state = self.updater(steps, self.neg_state)
+        while steps > 0:
+            block = min(steps, self.steps_per_swap)
+            self.replica_state = self._advance(block, self.replica_state,
+                                               self.beta)
+            self._swap()
+            steps -= block
+        self._adapt_ladder()
+        self.neg_state = self._cold_state()
 
-class DrivenSequentialMC(Sampler):
-    """An accelerated sequential Monte Carlo sampler"""
-    def __init__(self, model, beta_momentum=0.9, beta_std=0.2,
-                 method='stochastic'):
+
+class PopulationAnnealing(Sampler):
+    """
+    Population annealing sampler.
+
+    Each update of the negative phase anneals a new population from
+    beta = 0 to beta = 1 (see anneal.PopulationAnnealer), so the samples
+    do not depend on the previous negative state. This avoids the
+    persistent chains getting stuck in one mode of a rough landscape.
+
+    """
+    def __init__(self, model, schedule=None, num_workers=0):
         """
-        Create a sequential Monte Carlo sampler.
+        Create a population annealing sampler.
 
         Args:
             model: a model object
-            beta_momentum (float in [0,1]): autoregressive coefficient of beta
-            beta_std (float > 0): the standard deviation of beta
-            method (str; optional): how to update the particles
+            schedule (array; optional): increasing inverse temperatures
+                from 0 to 1 (defaults to partition.linear_schedule(100))
+            num_workers (int; optional): if positive, the population is
+                split across a pool of worker processes
 
         Returns:
-            SequentialMC
+            PopulationAnnealing
 
         """
-        super().__init__(model, method=method)
-        self.beta_momentum = beta_momentum
-        self.beta_std = beta_std
-        self.beta = None
-        self.has_beta = False
-
-    def _update_beta(self):
+        super().__init__(model, method='stochastic')
+        self.annealer = anneal.PopulationAnnealer(model, schedule=schedule,
+                                                  num_workers=num_workers)
+        assert self.annealer.schedule[-1] == 1, \
+        "The schedule must end at beta = 1"
+        self.log_Z = None
+
+    def close(self):
         """
-        Update beta with an AR(1) process.
-
-        AR(1) process: X_t = momentum * X_(t-1) + loc + scale * noise
-        E[X] = loc / (1 - momentum)
-             -> loc = E[X] * (1 - momentum)
-        Var[X] = scale ** 2 / (1 - momentum**2)
-               -> scale = sqrt(Var[X] * (1 - momentum**2))
-
-        Notes:
-            Modifies the folling attributes in place:
-                has_beta, beta_shape, beta_loc, beta_scale, beta
+        Shut down the process pool of the annealer, if there is one.
 
         Args:
             None
@@ -198,27 +1097,14 @@ class DrivenSequentialMC(Sampler):
             None
 
         """
-        if not self.has_beta:
-            self.has_beta = True
-            if self.pos_state:
-                self.beta_shape = (be.shape(self.pos_state.units[0])[0], 1)
-            else:
-                self.beta_shape = (be.shape(self.neg_state.units[0])[0], 1)
-            self.beta_loc = (1-self.beta_momentum) * be.ones(self.beta_shape)
-            self.beta_scale = self.beta_std * math.sqrt(1-self.beta_momentum**2)
-            self.beta = be.ones(self.beta_shape)
-
-        self.beta *= self.beta_momentum
-        self.beta += self.beta_loc
-        self.beta += self.beta_scale * be.randn(self.beta_shape)
+        self.annealer.close()
 
     def update_positive_state(self, steps):
         """
-        Update the state of the particles.
+        Update the positive state of the particles.
 
         Notes:
             Modifies the state attribute in place.
-            Calls _update_beta() method.
 
         Args:
             steps (int): the number of Monte Carlo steps
@@ -231,18 +1117,20 @@ class DrivenSequentialMC(Sampler):
             raise AttributeError(
                   'You must call the initialize(self, array_or_shape)'
                   +' method to set the initial state of the Markov Chain')
-        self.pos_state = self.updater(steps, self.pos_state, self.beta)
+        self.pos_state = self.updater(steps, self.pos_state)
 
     def update_negative_state(self, steps):
         """
-        Update the negative state of the particles.
+        Anneal a new population with the size of the negative state.
 
         Notes:
             Modifies the state attribute in place.
-            Calls _update_beta() method.
+            Sets the log_Z attribute to the estimate of the
+            log partition function from the annealing.
 
         Args:
             steps (int): the number of Monte Carlo steps
+                at each inverse temperature
 
         Returns:
             None
@@ -252,8 +1140,122 @@ class DrivenSequentialMC(Sampler):
             raise AttributeError(
                   'You must call the initialize(self, array_or_shape)'
                   +' method to set the initial state of the Markov Chain')
-        self._update_beta()
-        self.neg_state = self.updater(steps, self.neg_state, self.beta)
+        self.annealer.population_size = be.shape(self.neg_state.units[0])[0]
+        self.annealer.steps_per_beta = steps
+        self.neg_state = self.annealer.run()
+        self.log_Z = self.annealer.log_Z
+
+
+class AdaptiveSteps(object):
+    """
+    Adapt the number of Monte Carlo steps per gradient update
+    to the mixing of the persistent negative phase chains.
+
+    After each update of the chains the controller measures, across chains,
+    the correlation between the energies before and after the update and
+    the fraction of visible units that changed. The number of steps is
+    increased while the chains are too correlated (or too few units flip)
+    and decreased when they mix faster than needed.
+
+    Example usage:
+    '''
+    mcsteps = AdaptiveSteps(steps=1, max_steps=50)
+    trainer = SGD(rbm, data, opt, epochs, method=pcd, sampler=sampler,
+                  mcsteps=mcsteps)
+    '''
+
+    """
+    def __init__(self, steps=1, min_steps=1, max_steps=100,
+                 target_autocorrelation=0.5, min_flip_rate=0.05,
+                 factor=1.5, momentum=0.9):
+        """
+        Create an adaptive step controller.
+
+        Args:
+            steps (int): the initial number of steps
+            min_steps (int): the smallest number of steps
+            max_steps (int): the largest number of steps
+            target_autocorrelation (float in (0, 1)): the largest acceptable
+                correlation of the chain energies across one update
+            min_flip_rate (float in [0, 1]): the smallest acceptable
+                fraction of visible units that change in one update
+            factor (float > 1): the step count is multiplied or
+                divided by this factor
+            momentum (float in [0, 1)): smoothing of the measured statistics
+
+        Returns:
+            AdaptiveSteps
+
+        """
+        self.steps = steps
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.target_autocorrelation = target_autocorrelation
+        self.min_flip_rate = min_flip_rate
+        self.factor = factor
+        self.momentum = momentum
+
+        self.autocorrelation = None
+        self.flip_rate = None
+        self.energy = None
+        self.visible = None
+
+    def _smooth(self, average, value):
+        """
+        Update an exponential moving average.
+
+        Args:
+            average (float or None): the current average
+            value (float): the new value
+
+        Returns:
+            float
+
+        """
+        if average is None:
+            return value
+        return self.momentum * average + (1 - self.momentum) * value
+
+    def update(self, model, state):
+        """
+        Measure the mixing of the chains and adapt the number of steps.
+
+        Notes:
+            Modifies the steps and statistics attributes in place.
+            The first call only records the state.
+
+        Args:
+            model: a model object
+            state (State): the negative phase particles after an update
+
+        Returns:
+            None
+
+        """
+        energy = be.to_numpy_array(model.joint_energy(state)) \
+                   .astype('float64')
+        visible = be.to_numpy_array(state.units[0]).copy()
+
+        if self.energy is not None and self.energy.shape == energy.shape:
+            de = self.energy - self.energy.mean()
+            dc = energy - energy.mean()
+            norm = math.sqrt(float((de * de).sum() * (dc * dc).sum()))
+            correlation = float((de * dc).sum()) / norm if norm > 0 else 1.0
+            flips = float((visible != self.visible).mean())
+            self.autocorrelation = self._smooth(self.autocorrelation,
+                                                correlation)
+            self.flip_rate = self._smooth(self.flip_rate, flips)
+
+            if (self.autocorrelation > self.target_autocorrelation
+                or self.flip_rate < self.min_flip_rate):
+                self.steps = min(self.max_steps,
+                                 int(math.ceil(self.steps * self.factor)))
+            elif self.autocorrelation < self.target_autocorrelation / 2:
+                self.steps = max(self.min_steps,
+                                 int(math.floor(self.steps / self.factor)))
+
+        self.energy = energy
+        self.visible = visible
 
 
 class ProgressMonitor(object):
@@ -262,13 +1264,20 @@ class ProgressMonitor(object):
     validation set.
 
     """
-    def __init__(self, batch, metrics=['ReconstructionError']):
+    def __init__(self, batch, metrics=['ReconstructionError'], sampler=None,
+                 max_tile_rows=None):
         """
         Create a progress monitor.
 
         Args:
             batch (int): the
             metrics (list[str]): list of metrics to compute
+            sampler (Sampler; optional): a training sampler whose chain
+                diagnostics are reported along with the metrics
+            max_tile_rows (int; optional): if provided, validation
+                minibatches with more rows are split into tiles of this
+                many rows, and each tile updates the metrics like a
+                minibatch. Bounds the memory used to score large batches.
 
         Returns:
             ProgressMonitor
@@ -277,8 +1286,26 @@ class ProgressMonitor(object):
         self.batch = batch
         self.update_steps = 10
         self.metrics = [M.__getattribute__(m)() for m in metrics]
+        self.sampler = sampler
+        self.max_tile_rows = max_tile_rows
         self.memory = []
 
+    def _tiles(self, v_data):
+        """
+        Split a validation minibatch into tiles of rows.
+
+        Args:
+            v_data (tensor (num_samples, num_visible))
+
+        Returns:
+            iterator over tensors (at most max_tile_rows, num_visible)
+
+        """
+        num_rows = be.shape(v_data)[0]
+        size = self.max_tile_rows or num_rows
+        for start in range(0, num_rows, size):
+            yield v_data[start:start + size]
+
     def check_progress(self, model, store=False, show=False):
         """
         Compute the metrics from a model on the validaiton set.
@@ -299,34 +1326,37 @@ class ProgressMonitor(object):
 
         while True:
             try:
-                v_data = self.batch.get(mode='validate')
+                batch_data = self.batch.get(mode='validate')
             except StopIteration:
                 break
 
-            # set up the positive state
-            data_state = State.from_visible(v_data, model)
-            sampler.set_positive_state(data_state)
-            # set up the negative state
-            random_samples = model.random(v_data)
-            model_state = State.from_visible(random_samples, model)
-            sampler.set_negative_state(model_state)
-
-            # update the states
-            sampler.update_positive_state(1)
-            sampler.update_negative_state(self.update_steps)
-
-            metric_state = M.MetricState(minibatch=data_state,
-                                         reconstructions=sampler.pos_state,
-                                         random_samples=model_state,
-                                         samples=sampler.neg_state,
-                                         amodel=model)
-
-            # update metrics
-            for m in self.metrics:
-                m.update(metric_state)
+            for v_data in self._tiles(batch_data):
+                # set up the positive state
+                data_state = State.from_visible(v_data, model)
+                sampler.set_positive_state(data_state)
+                # set up the negative state
+                random_samples = model.random(v_data)
+                model_state = State.from_visible(random_samples, model)
+                sampler.set_negative_state(model_state)
+
+                # update the states
+                sampler.update_positive_state(1)
+                sampler.update_negative_state(self.update_steps)
+
+                metric_state = M.MetricState(minibatch=data_state,
+                                             reconstructions=sampler.pos_state,
+                                             random_samples=model_state,
+                                             samples=sampler.neg_state,
+                                             amodel=model)
+
+                # update metrics
+                for m in self.metrics:
+                    m.update(metric_state)
 
         # compute metric dictionary
         metdict = OrderedDict([(m.name, m.value()) for m in self.metrics])
+        if self.sampler is not None and self.sampler.diagnostics is not None:
+            metdict.update(self.sampler.diagnostics.summary())
         if show:
             for m in metdict:
                 print("-{0}: {1:.6f}".format(m, metdict[m]))
@@ -413,6 +1443,223 @@ def persistent_contrastive_divergence(vdata, model, sampler, steps=1):
 # alias
 pcd = persistent_contrastive_divergence
 
+class FastPersistentContrastiveDivergence(object):
+    """
+    FPCD-k algorithm for approximate maximum likelihood inference.
+
+    The negative phase is sampled with the sum of the weights and a set of
+    fast weights. The fast weights follow the gradient with a large
+    learning rate and decay quickly, which pushes the persistent chains
+    out of the modes they have already visited.
+
+    Tieleman, Tijmen, and Geoffrey Hinton.
+    "Using fast weights to improve persistent contrastive divergence."
+    Proceedings of the 26th Annual International Conference on Machine
+    Learning. ACM, 2009.
+
+    Example usage:
+    '''
+    trainer = SGD(rbm, data, opt, epochs, method=fpcd(fast_stepsize=0.01),
+                  sampler=sampler, mcsteps=1)
+    '''
+
+    """
+    def __init__(self, fast_stepsize=0.01, fast_decay=0.95):
+        """
+        Create an FPCD gradient method.
+
+        Notes:
+            Each training run needs its own instance, because the
+            instance holds the fast weights.
+
+        Args:
+            fast_stepsize (float): the learning rate of the fast weights
+            fast_decay (float in [0, 1)): the fast weights are multiplied by
+                this factor at every update
+
+        Returns:
+            FastPersistentContrastiveDivergence
+
+        """
+        self.fast_stepsize = fast_stepsize
+        self.fast_decay = fast_decay
+        self.fast_weights = None
+
+    def _shift_weights(self, model, sign):
+        """
+        Add the fast weights to (or subtract them from) the weights.
+
+        Notes:
+            Modifies the weights of the model in place.
+
+        Args:
+            model: a model object
+            sign (float): +1 to add the fast weights, -1 to remove them
+
+        Returns:
+            None
+
+        """
+        for w, fast in zip(model.weights, self.fast_weights):
+            w.params.matrix[:] += sign * fast
+
+    def __call__(self, vdata, model, sampler, steps=1):
+        """
+        Compute an approximation to the likelihood gradient.
+
+        Notes:
+            Modifies the state of the sampler and the fast weights.
+
+        Args:
+            vdata (tensor): observed visible units
+            model: a model object
+            sampler: a sampler object
+            steps (int): the number of Monte Carlo steps
+
+        Returns:
+            gradient
+
+        """
+        if self.fast_weights is None:
+            self.fast_weights = [be.zeros_like(w.params.matrix)
+                                 for w in model.weights]
+
+        data_state = State.from_visible(vdata, model)
+        sampler.set_positive_state(data_state)
+
+        # sample the negative phase with the fast weights added in place
+        self._shift_weights(model, 1)
+        try:
+            sampler.update_negative_state(steps)
+        finally:
+            self._shift_weights(model, -1)
+
+        grad = model.gradient(*sampler.get_states())
+
+        # the fast weights descend the gradient and decay
+        for fast, g in zip(self.fast_weights, grad.weights):
+            fast *= self.fast_decay
+            fast -= self.fast_stepsize * g.matrix
+        return grad
+
+# alias
+fpcd = FastPersistentContrastiveDivergence
+
+class PipelinedPersistentContrastiveDivergence(object):
+    """
+    PCD-k with the negative phase of the next update computed on a
+    worker thread while the gradient of the current update is computed.
+
+    The two phases only read the parameters of the model, and the matrix
+    products and elementwise expressions release the GIL, so they run in
+    parallel on a multicore machine.
+
+    Notes:
+        The persistent chains used for the gradient at step t were
+        advanced with the parameters of step t - 1 (the update of step
+        t - 1 is applied after they are advanced). This delay of one
+        update is small compared to the mixing time of the chains for
+        the usual learning rates.
+
+        The first update runs the two phases one after the other, so the
+        lazily built state of the model (update plans, fused sampler
+        buffers, layer thread pool) exists before they run concurrently.
+
+    Example usage:
+    '''
+    trainer = SGD(rbm, data, opt, epochs, method=ppcd(),
+                  sampler=sampler, mcsteps=1)
+    trainer.train()
+    '''
+
+    """
+    def __init__(self):
+        """
+        Create a pipelined PCD gradient method.
+
+        Notes:
+            Each training run needs its own instance, because the
+            instance holds the worker thread.
+
+        Args:
+            None
+
+        Returns:
+            PipelinedPersistentContrastiveDivergence
+
+        """
+        self.executor = None
+        self.sampler = None
+
+    def __call__(self, vdata, model, sampler, steps=1):
+        """
+        Compute an approximation to the likelihood gradient.
+
+        Notes:
+            Modifies the state of the sampler.
+            Returns after the chains for the next update are advanced,
+            so the parameters can be updated safely.
+
+        Args:
+            vdata (tensor): observed visible units
+            model: a model object
+            sampler: a sampler object
+            steps (int): the number of Monte Carlo steps
+
+        Returns:
+            gradient
+
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(1)
+
+        data_state = State.from_visible(vdata, model)
+        sampler.set_positive_state(data_state)
+        if sampler is not self.sampler:
+            # the first update is not pipelined: the model builds its update
+            # plans, fused sampler and thread pools lazily, so they are all
+            # created here by one thread before the two phases overlap
+            sampler.update_negative_state(steps)
+            self.sampler = sampler
+            model_state = sampler.neg_state
+            grad = model.gradient(data_state, model_state)
+            sampler.update_negative_state(steps)
+            return grad
+
+        # the negative state is replaced (not overwritten) by the update
+        model_state = sampler.neg_state
+        pending = self.executor.submit(sampler.update_negative_state, steps)
+        try:
+            grad = model.gradient(data_state, model_state)
+        finally:
+            pending.result()
+        return grad
+
+    def close(self):
+        """
+        Stop the worker thread.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.sampler = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# alias
+ppcd = PipelinedPersistentContrastiveDivergence
+
 def tap(vdata, model, sampler=None, steps=None):
     """
     Compute the gradient using the Thouless-Anderson-Palmer (TAP)
@@ -438,6 +1685,78 @@ def tap(vdata, model, sampler=None, steps=None):
     return model.gradient(data_state, None)
 
 
+class ExactGradient(object):
+    """
+    Exact gradient of the log-likelihood, computed by enumerating the
+    states of a small Bernoulli hidden layer.
+    See partition.ExactPartition.
+
+    Example usage:
+    '''
+    trainer = SGD(rbm, data, opt, epochs, method=exact(num_threads=4))
+    '''
+
+    """
+    def __init__(self, block_bits=10, num_threads=1):
+        """
+        Create an exact gradient method.
+
+        Notes:
+            The enumeration engine (and its thread pool) is created for
+            the first model and reused by the following updates.
+
+        Args:
+            block_bits (int): the hidden states are enumerated in blocks
+                of 2^block_bits states
+            num_threads (int): the number of threads that process blocks
+
+        Returns:
+            ExactGradient
+
+        """
+        self.block_bits = block_bits
+        self.num_threads = num_threads
+        self.engine = None
+
+    def __call__(self, vdata, model, sampler=None, steps=None):
+        """
+        Compute the exact gradient of the log-likelihood.
+
+        Args:
+            vdata (tensor): observed visible units
+            model: a model object
+            sampler (default to None): not required
+            steps (default to None): not required
+
+        Returns:
+            gradient
+
+        """
+        if self.engine is None or self.engine.model is not model:
+            self.close()
+            self.engine = partition.ExactPartition(model, self.block_bits,
+                                                   self.num_threads)
+        data_state = State.from_visible(vdata, model)
+        return self.engine.gradient(data_state)
+
+    def close(self):
+        """
+        Shut down the thread pool of the enumeration engine, if there is one.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.engine is not None:
+            self.engine.close()
+
+# alias
+exact = ExactGradient
+
+
 class StochasticGradientDescent(object):
     """Stochastic gradient descent with minibatches"""
     def __init__(self, model, batch, optimizer, epochs, method=pcd,
@@ -451,9 +1770,13 @@ class StochasticGradientDescent(object):
             optimizer: an optimizer object
             epochs (int): the number of epochs
             method (optional): the method used to approximate the likelihood
-                               gradient [cd, pcd, ortap]
+                               gradient [cd, pcd, fpcd(), ppcd(), tap, or exact()]
             sampler (optional): a sampler object
-            mcsteps (int, optional): the number of Monte Carlo steps per gradient
+            mcsteps (int or AdaptiveSteps, optional): the number of Monte
+                Carlo steps per gradient. An AdaptiveSteps controller
+                adapts the number to the mixing of persistent chains.
+                Set model.use_fused_sampler = True to run the steps of
+                Bernoulli-Bernoulli RBMs in a compiled kernel.
             monitor (optional): a progress monitor
 
         Returns:
@@ -475,6 +1798,28 @@ class StochasticGradientDescent(object):
 
         Notes:
             Updates the model parameters in place.
+            Shuts down the process pool of the sampler
+            (and the worker thread of a pipelined method) when done.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        try:
+            self._train()
+        finally:
+            if isinstance(self.sampler, Sampler):
+                self.sampler.close()
+            if hasattr(self.grad_approx, 'close'):
+                self.grad_approx.close()
+        return None
+
+    def _train(self):
+        """
+        Run the epochs of training.
 
         Args:
             None
@@ -492,10 +1837,18 @@ class StochasticGradientDescent(object):
                 except StopIteration:
                     break
 
+                if isinstance(self.mcsteps, AdaptiveSteps):
+                    steps = self.mcsteps.steps
+                else:
+                    steps = self.mcsteps
+
                 self.optimizer.update(self.model,
-                self.grad_approx(v_data, self.model, self.sampler, self.mcsteps),
+                self.grad_approx(v_data, self.model, self.sampler, steps),
                 epoch)
 
+                if isinstance(self.mcsteps, AdaptiveSteps):
+                    self.mcsteps.update(self.model, self.sampler.neg_state)
+
                 t += 1
 
             # end of epoch processing
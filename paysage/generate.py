@@ -0,0 +1,427 @@
+"""
+Generate large numbers of samples from a model.
+
+Long Markov chains are run (optionally in a process pool) with burn-in
+and thinning, and the visible samples are streamed to a file in chunks,
+so the memory does not grow with the number of samples. The state of the
+chains is saved next to the samples after every chunk, so a later run
+resumes the chains and appends to the same file.
+
+Example usage:
+'''
+with SampleGenerator(rbm, 'samples.dat', num_chains=1000, thin=10) as gen:
+    gen.start(1000000)
+    ...
+    gen.wait()
+samples = MemmapStore('samples.dat', rbm.layers[0].len).read()
+'''
+
+"""
+import os
+import threading
+import numpy
+import pandas
+
+from . import backends as be
+from . import fit
+from .models.model import State
+
+# ----- STORAGE ----- #
+
+class MemmapStore(object):
+    """
+    Rows of samples appended to a flat binary file of float32 values,
+    which can be read as a numpy memmap.
+
+    """
+    def __init__(self, filename, num_units):
+        """
+        Create (or reopen) a memmap store.
+
+        Args:
+            filename (str): the name of the file
+            num_units (int): the number of values in each sample
+
+        Returns:
+            MemmapStore
+
+        """
+        self.filename = filename
+        self.num_units = num_units
+
+    def num_rows(self):
+        """
+        Get the number of samples in the store.
+
+        Args:
+            None
+
+        Returns:
+            int
+
+        """
+        if not os.path.exists(self.filename):
+            return 0
+        return os.path.getsize(self.filename) // (4 * self.num_units)
+
+    def append(self, samples):
+        """
+        Append samples to the store.
+
+        Notes:
+            Performs an IO operation.
+
+        Args:
+            samples (numpy array (num_samples, num_units))
+
+        Returns:
+            None
+
+        """
+        with open(self.filename, 'ab') as f:
+            f.write(numpy.ascontiguousarray(samples,
+                                            dtype=numpy.float32).tobytes())
+
+    def read(self):
+        """
+        Get a read only view of the samples.
+
+        Args:
+            None
+
+        Returns:
+            numpy.memmap (num_samples, num_units)
+
+        """
+        return numpy.memmap(self.filename, dtype=numpy.float32, mode='r',
+                            shape=(self.num_rows(), self.num_units))
+
+    def close(self):
+        """
+        Close the store.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        pass
+
+
+class HDFStore(object):
+    """
+    Rows of samples appended to a table in an HDF5 file,
+    which can be read with batch.Batch.
+
+    """
+    def __init__(self, filename, key='samples'):
+        """
+        Create (or reopen) an HDF5 store.
+
+        Args:
+            filename (str): the name of the file
+            key (str; optional): the key of the table
+
+        Returns:
+            HDFStore
+
+        """
+        self.filename = filename
+        self.key = key
+        self.store = pandas.HDFStore(filename, mode='a')
+
+    def num_rows(self):
+        """
+        Get the number of samples in the store.
+
+        Args:
+            None
+
+        Returns:
+            int
+
+        """
+        if self.key not in self.store:
+            return 0
+        return self.store.get_storer(self.key).nrows
+
+    def append(self, samples):
+        """
+        Append samples to the store.
+
+        Notes:
+            Performs an IO operation.
+
+        Args:
+            samples (numpy array (num_samples, num_units))
+
+        Returns:
+            None
+
+        """
+        self.store.append(self.key, pandas.DataFrame(samples),
+                          format='table', index=False)
+        self.store.flush()
+
+    def read(self):
+        """
+        Read the samples.
+
+        Args:
+            None
+
+        Returns:
+            numpy array (num_samples, num_units)
+
+        """
+        return self.store.select(self.key).values
+
+    def close(self):
+        """
+        Close the store.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        self.store.close()
+
+
+# ----- GENERATOR ----- #
+
+class SampleGenerator(object):
+    """
+    Run Markov chains for a model and stream the visible samples to a file.
+
+    """
+    def __init__(self, model, filename, num_chains=100, burn_in=100,
+                 thin=10, chunk_size=10000, storage='memmap', key='samples',
+                 method='stochastic', num_workers=0):
+        """
+        Create a sample generator.
+
+        Args:
+            model: a model object
+            filename (str): the name of the output file. The state of the
+                chains is saved in filename + '.chains.npz'.
+            num_chains (int; optional): the number of chains
+            burn_in (int; optional): the number of Monte Carlo steps before
+                the first sample (skipped if the chains are resumed)
+            thin (int; optional): the number of Monte Carlo steps between
+                samples of a chain
+            chunk_size (int; optional): the number of samples held in
+                memory before they are written
+            storage (str; optional): 'memmap' or 'hdf'
+            key (str; optional): the key of the HDF5 table
+            method (str; optional): how to update the chains
+                ('stochastic', 'mean_field', or 'deterministic')
+            num_workers (int; optional): number of worker processes
+                (0 runs the chains in this process)
+
+        Returns:
+            SampleGenerator
+
+        """
+        self.model = model
+        self.filename = filename
+        self.num_chains = num_chains
+        self.burn_in = burn_in
+        self.thin = thin
+        self.chunk_size = max(chunk_size, 1)
+        if storage == 'memmap':
+            self.store = MemmapStore(filename, model.layers[0].len)
+        elif storage == 'hdf':
+            self.store = HDFStore(filename, key)
+        else:
+            raise ValueError("Unknown storage {}".format(storage))
+        self.sampler = fit.SequentialMC(model, method=method,
+                                        num_workers=num_workers)
+        self.thread = None
+        self.error = None
+        self.stopping = threading.Event()
+
+    def _chains_filename(self):
+        return self.filename + '.chains.npz'
+
+    def _save_chains(self):
+        """
+        Save the state of the chains.
+
+        Notes:
+            Performs an IO operation.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        units = [be.to_numpy_array(u) for u in self.sampler.neg_state.units]
+        # write to a temporary file first so an interrupted save
+        # does not destroy the previous state
+        temporary = self._chains_filename() + '.tmp.npz'
+        numpy.savez(temporary, *units)
+        os.replace(temporary, self._chains_filename())
+
+    def _start_chains(self):
+        """
+        Resume the saved chains, or start new chains and burn them in.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if os.path.exists(self._chains_filename()):
+            with numpy.load(self._chains_filename()) as saved:
+                units = [be.float_tensor(saved['arr_{}'.format(i)])
+                         for i in range(len(saved.files))]
+            self.sampler.set_negative_state(State(units))
+        else:
+            self.sampler.set_negative_state(
+                State.from_model(self.num_chains, self.model))
+            self.sampler.update_negative_state(self.burn_in)
+
+    def run(self, num_samples):
+        """
+        Generate samples and append them to the file.
+
+        Notes:
+            Blocks until the samples are written or stop is called.
+            The memory used does not depend on num_samples.
+
+        Args:
+            num_samples (int): the number of samples to generate
+
+        Returns:
+            int: the number of samples written
+
+        """
+        if self.sampler.neg_state is None:
+            self._start_chains()
+        buffer = numpy.empty((self.chunk_size, self.model.layers[0].len),
+                             dtype=numpy.float32)
+        filled = 0
+        written = 0
+        while written + filled < num_samples and not self.stopping.is_set():
+            self.sampler.update_negative_state(self.thin)
+            vis = be.to_numpy_array(self.sampler.neg_state.units[0])
+            vis = vis[:num_samples - written - filled]
+            while len(vis):
+                n = min(len(vis), self.chunk_size - filled)
+                buffer[filled:filled + n] = vis[:n]
+                filled += n
+                vis = vis[n:]
+                if filled == self.chunk_size:
+                    self.store.append(buffer)
+                    self._save_chains()
+                    written += filled
+                    filled = 0
+        if filled:
+            self.store.append(buffer[:filled])
+            self._save_chains()
+            written += filled
+        return written
+
+    def _run_in_thread(self, num_samples):
+        try:
+            self.run(num_samples)
+        except Exception as error:
+            self.error = error
+
+    def start(self, num_samples):
+        """
+        Generate samples in a background thread.
+
+        Args:
+            num_samples (int): the number of samples to generate
+
+        Returns:
+            None
+
+        """
+        self.wait()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run_in_thread,
+                                       args=(num_samples,), daemon=True)
+        self.thread.start()
+
+    def running(self):
+        """
+        Check if the background thread is generating samples.
+
+        Args:
+            None
+
+        Returns:
+            bool
+
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def wait(self):
+        """
+        Wait for the background thread to finish.
+
+        Notes:
+            Raises the exception of the thread, if any.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def stop(self):
+        """
+        Stop the background thread after the current update of the chains.
+        The samples generated so far are written.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        self.stopping.set()
+        self.wait()
+
+    def close(self):
+        """
+        Stop generating samples and release the resources.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        try:
+            self.stop()
+        finally:
+            self.sampler.close()
+            self.store.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,4 +1,4 @@
-import os, sys
+import os, sys, copy
 from collections import OrderedDict, namedtuple
 import pandas
 
@@ -11,6 +11,9 @@ ParamsLayer = namedtuple("Params", [])
 class Layer(object):
     """A general layer class with common functionality."""
 
+    # the precisions in which the samples of the layer can be stored
+    precisions = ['float32']
+
     def __init__(self, *args, **kwargs):
         """
         Basic layer initialization method.
@@ -28,6 +31,8 @@ class Layer(object):
         # these attributes are mutable (their keys do change)
         self.penalties = OrderedDict()
         self.constraints = OrderedDict()
+        # the samples of the layer are stored in this precision
+        self.precision = 'float32'
 
     def get_base_config(self):
         """
@@ -50,7 +55,8 @@ class Layer(object):
             "penalties"   : {pk: self.penalties[pk].get_config()
                              for pk in self.penalties},
             "constraints" : {ck: self.constraints[ck].__name__
-                             for ck in self.constraints}
+                             for ck in self.constraints},
+            "precision"   : self.precision
         }
 
     def get_config(self):
@@ -123,7 +129,7 @@ class Layer(object):
         params = []
         for i, ip in enumerate(self.params):
             params.append(be.float_tensor(
-                store.get(os.path.join(key, 'parameters', 'key'+str(i))).as_matrix()
+                store.get(os.path.join(key, 'parameters', 'key'+str(i))).values
             ).squeeze()) # collapse trivial dimensions to a vector
         self.params = self.params.__class__(*params)
 
@@ -235,6 +241,50 @@ class Layer(object):
         self.params = be.mapzip(be.subtract, deltas, self.params)
         self.enforce_constraints()
 
+    def set_precision(self, precision):
+        """
+        Set the precision in which the samples of the layer are stored.
+
+        Notes:
+            Lower precisions reduce the memory (and memory bandwidth)
+            used by the states of the layer. The fields on the layer
+            are still computed in single precision.
+
+        Args:
+            precision (str): one of the precisions attribute of the layer
+                (e.g., 'uint8' for Bernoulli layers)
+
+        Returns:
+            None
+
+        """
+        if precision not in self.precisions:
+            raise ValueError("{} does not support precision {}".format(
+                             self.__class__.__name__, precision))
+        self.precision = precision
+
+    def subset(self, index):
+        """
+        Get a layer restricted to a subset of the units of this layer
+        (e.g., for block updates of a wide layer).
+
+        Notes:
+            The parameters of the subset are copies, so the subset
+            must be recreated after the parameters change.
+
+        Args:
+            index (tensor): the indices of the units
+
+        Returns:
+            layer
+
+        """
+        layer = copy.copy(self)
+        layer.len = len(index)
+        layer.params = be.apply(lambda p: be.index_select(p, index, axis=-1),
+                                self.params)
+        return layer
+
 
 ParamsWeights = namedtuple("ParamsWeights", ["matrix"])
 
@@ -294,6 +344,7 @@ class Weights(Layer):
             layer.add_penalty({k: penalties.from_config(v)})
         for k, v in config["constraints"].items():
             layer.add_constraint({k: getattr(constraints, v)})
+        layer.set_precision(config.get("precision", "float32"))
         return layer
 
     def W(self):
@@ -365,11 +416,244 @@ class Weights(Layer):
         return -be.batch_dot(vis, self.W(), hid)
 
 
+class ConvolutionOperator(object):
+    """
+    The product x W (or x W^T) with the weights of a convolutional
+    weights layer, used in place of a weight matrix by the layer
+    functions (see weights_product). The dense matrix W is never formed.
+
+    """
+    def __init__(self, filters, image_shape, kernel_shape, stride=1,
+                 transposed=False):
+        """
+        Create a convolution operator.
+
+        Args:
+            filters (tensor (channels * kernel_size, num_filters))
+            image_shape (tuple): (channels, height, width) of the images
+            kernel_shape (tuple): (height, width) of the filters
+            stride (int; optional): the step between patches
+            transposed (bool; optional): multiply by W^T instead of W
+
+        Returns:
+            ConvolutionOperator
+
+        """
+        self.filters = filters
+        self.image_shape = image_shape
+        self.kernel_shape = kernel_shape
+        self.stride = stride
+        self.transposed = transposed
+
+    def product(self, x):
+        """
+        Multiply a batch of rows by the weights.
+
+        Args:
+            x (tensor (num_samples, num_units)): the rescaled units
+                of the layer on the left of the product
+
+        Returns:
+            tensor (num_samples, num_connected_units)
+
+        """
+        func = be.conv2d_transpose if self.transposed else be.conv2d
+        return func(x, self.filters, self.image_shape, self.kernel_shape,
+                    self.stride)
+
+
+class ConvolutionalWeights(Weights):
+    """
+    Layer class for weights shared between the patches of an image
+    (a valid 2D convolution).
+
+    The visible units are images of shape (channels, height, width),
+    flattened in that order. The hidden units are the responses of
+    num_filters filters to each patch, flattened in (filter, row, column)
+    order. The filters are stored in params.matrix as a
+    (channels * kernel_height * kernel_width, num_filters) matrix,
+    so the number of parameters does not depend on the image size.
+
+    Example usage:
+    '''
+    conv = ConvolutionalWeights((1, 28, 28), (5, 5), num_filters=16)
+    vis = BernoulliLayer(conv.num_visible)
+    hid = BernoulliLayer(conv.num_hidden)
+    rbm = Model([vis, hid], weights=[conv])
+    '''
+
+    """
+    def __init__(self, image_shape, kernel_shape, num_filters, stride=1):
+        """
+        Create a convolutional weights layer.
+
+        Notes:
+            The shape attribute is the shape of the filter matrix.
+
+        Args:
+            image_shape (tuple): (channels, height, width) of the images
+            kernel_shape (tuple): (height, width) of the filters
+            num_filters (int): the number of filters
+            stride (int; optional): the step between patches
+
+        Returns:
+            convolutional weights layer
+
+        """
+        Layer.__init__(self)
+        self.image_shape = tuple(image_shape)
+        self.kernel_shape = tuple(kernel_shape)
+        self.num_filters = num_filters
+        self.stride = stride
+        channels, height, width = self.image_shape
+        kernel_height, kernel_width = self.kernel_shape
+        # the shape (filters, rows, columns) of the hidden units
+        self.output_shape = (num_filters,
+                             (height - kernel_height) // stride + 1,
+                             (width - kernel_width) // stride + 1)
+        self.num_visible = channels * height * width
+        self.num_hidden = num_filters * self.output_shape[1] \
+                          * self.output_shape[2]
+        self.shape = (channels * kernel_height * kernel_width, num_filters)
+        self.params = ParamsWeights(0.01 * be.randn(self.shape))
+
+    def get_config(self):
+        """
+        Get the configuration dictionary of the convolutional weights layer.
+
+        Args:
+            None:
+
+        Returns:
+            configuration (dict):
+
+        """
+        base_config = self.get_base_config()
+        base_config["image_shape"] = self.image_shape
+        base_config["kernel_shape"] = self.kernel_shape
+        base_config["num_filters"] = self.num_filters
+        base_config["stride"] = self.stride
+        return base_config
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a convolutional weights layer from a configuration dictionary.
+
+        Args:
+            config (dict)
+
+        Returns:
+            layer (ConvolutionalWeights)
+
+        """
+        layer = cls(config["image_shape"], config["kernel_shape"],
+                    config["num_filters"], config["stride"])
+        for k, v in config["penalties"].items():
+            layer.add_penalty({k: penalties.from_config(v)})
+        for k, v in config["constraints"].items():
+            layer.add_constraint({k: getattr(constraints, v)})
+        layer.set_precision(config.get("precision", "float32"))
+        return layer
+
+    def load_params(self, store, key):
+        """
+        Load the parameters from an HDFStore.
+
+        Notes:
+            Performs an IO operation.
+
+        Args:
+            store (pandas.HDFStore): the readable stream for the params.
+            key (str): the path for the layer params.
+
+        Returns:
+            None
+
+        """
+        super().load_params(store, key)
+        # restore the dimensions collapsed for a single filter
+        self.params = ParamsWeights(be.reshape(self.params.matrix,
+                                               self.shape))
+
+    def W(self):
+        """
+        Get the weights as a convolution operator.
+
+        Args:
+            None
+
+        Returns:
+            ConvolutionOperator: multiplies visible units by the weights
+
+        """
+        return ConvolutionOperator(self.params.matrix, self.image_shape,
+                                   self.kernel_shape, self.stride)
+
+    def W_T(self):
+        """
+        Get the transpose of the weights as a convolution operator.
+
+        Args:
+            None
+
+        Returns:
+            ConvolutionOperator: multiplies hidden units by the
+                transpose of the weights
+
+        """
+        return ConvolutionOperator(self.params.matrix, self.image_shape,
+                                   self.kernel_shape, self.stride,
+                                   transposed=True)
+
+    def derivatives(self, vis, hid):
+        """
+        Compute the derivative of the filters.
+
+        dW_{pf} = - \frac{1}{num_samples} * \sum_{k, patches} x_{kp} h_{kf}
+
+        where x_{kp} is the p-th unit of a patch of sample k and
+        h_{kf} is the response of filter f to that patch.
+
+        Args:
+            vis (tensor (num_samples, num_visible)): Rescaled visible units.
+            hid (tensor (num_samples, num_hidden)): Rescaled hidden units.
+
+        Returns:
+            derivs (namedtuple): 'matrix': tensor (contains gradient)
+
+        """
+        outer = be.conv2d_filter_outer(vis, hid, self.image_shape,
+                                       self.kernel_shape, self.stride)
+        derivs = ParamsWeights(
+            self.get_penalty_grad(-outer / len(vis), "matrix"))
+        return derivs
+
+    def energy(self, vis, hid):
+        """
+        Compute the contribution of the weight layer to the model energy.
+
+        For sample k:
+        E_k = -\sum_{j} (v_k W)_{j} h_{kj}
+
+        Args:
+            vis (tensor (num_samples, num_visible)): Rescaled visible units.
+            hid (tensor (num_samples, num_hidden)): Rescaled hidden units.
+
+        Returns:
+            tensor (num_samples,): energy per sample
+
+        """
+        return -be.tsum(self.W().product(vis) * hid, axis=1)
+
+
 ParamsGaussian = namedtuple("ParamsGaussian", ["loc", "log_var"])
 
 class GaussianLayer(Layer):
     """Layer with Gaussian units"""
 
+    precisions = ['float32', 'float16']
+
     def __init__(self, num_units):
         """
         Create a layer with Gaussian units.
@@ -423,6 +707,7 @@ class GaussianLayer(Layer):
             layer.add_penalty({k: penalties.from_config(v)})
         for k, v in config["constraints"].items():
             layer.add_constraint({k: getattr(constraints, v)})
+        layer.set_precision(config.get("precision", "float32"))
         return layer
 
     def energy(self, vis):
@@ -574,7 +859,8 @@ class GaussianLayer(Layer):
         log_var = -0.5 * be.mean(be.square(be.subtract(
             self.params.loc, vis)), axis=0)
         for i in range(len(hid)):
-            log_var += be.batch_dot(hid[i], weights[i], vis, axis=0) / len(vis)
+            log_var += be.tsum(weights_product(hid[i], weights[i]) * vis,
+                               axis=0) / len(vis)
         log_var = self.rescale(log_var)
         log_var = self.get_penalty_grad(log_var, 'log_var')
 
@@ -598,9 +884,7 @@ class GaussianLayer(Layer):
             tuple (tensor, tensor): conditional parameters
 
         """
-        mean = be.dot(scaled_units[0], weights[0])
-        for i in range(1, len(weights)):
-            mean += be.dot(scaled_units[i], weights[i])
+        mean = connected_field(scaled_units, weights)
         if beta is not None:
             mean *= be.broadcast(beta, mean)
         mean += be.broadcast(self.params.loc, mean)
@@ -666,8 +950,8 @@ class GaussianLayer(Layer):
 
         """
         mean, var = self._conditional_params(scaled_units, weights, beta)
-        r = be.float_tensor(self.rand(be.shape(mean)))
-        return mean + be.sqrt(var)*r
+        r = self.rand(be.shape(mean))
+        return be.cast_tensor(mean + be.sqrt(var)*r, self.precision)
 
     def random(self, array_or_shape):
         """
@@ -695,7 +979,8 @@ class GaussianLayer(Layer):
         var = be.exp(self.params.log_var)
         r = self.rand(shape)
 
-        return be.add(mean, be.multiply(be.sqrt(var), r))
+        return be.cast_tensor(be.add(mean, be.multiply(be.sqrt(var), r)),
+                              self.precision)
 
 
 ParamsIsing = namedtuple("ParamsIsing", ["loc"])
@@ -703,6 +988,8 @@ ParamsIsing = namedtuple("ParamsIsing", ["loc"])
 class IsingLayer(Layer):
     """Layer with Ising units (i.e., -1 or +1)."""
 
+    precisions = ['float32', 'float16', 'int8']
+
     def __init__(self, num_units):
         """
         Create a layer with Ising units.
@@ -756,6 +1043,7 @@ class IsingLayer(Layer):
             layer.add_penalty({k: penalties.from_config(v)})
         for k, v in config["constraints"].items():
             layer.add_constraint({k: getattr(constraints, v)})
+        layer.set_precision(config.get("precision", "float32"))
         return layer
 
     def energy(self, data):
@@ -893,9 +1181,7 @@ class IsingLayer(Layer):
             tensor: conditional parameters
 
         """
-        field = be.dot(scaled_units[0], weights[0])
-        for i in range(1, len(weights)):
-            field += be.dot(scaled_units[i], weights[i])
+        field = connected_field(scaled_units, weights)
         if beta is not None:
             field *= be.broadcast(beta,field)
         field += be.broadcast(self.params.loc, field)
@@ -961,7 +1247,7 @@ class IsingLayer(Layer):
         field = self._conditional_params(scaled_units, weights, beta)
         p = be.expit(field)
         r = self.rand(be.shape(p))
-        return 2 * be.float_tensor(r < p) - 1
+        return 2 * be.cast_tensor(r < p, self.precision) - 1
 
     def random(self, array_or_shape):
         """
@@ -987,7 +1273,7 @@ class IsingLayer(Layer):
 
         r = self.rand(shape)
         p = be.expit(be.broadcast(self.params.loc, r))
-        return 2 * be.float_tensor(r < p) - 1
+        return 2 * be.cast_tensor(r < p, self.precision) - 1
 
 
 ParamsBernoulli = namedtuple("ParamsBernoulli", ["loc"])
@@ -995,6 +1281,8 @@ ParamsBernoulli = namedtuple("ParamsBernoulli", ["loc"])
 class BernoulliLayer(Layer):
     """Layer with Bernoulli units (i.e., 0 or +1)."""
 
+    precisions = ['float32', 'float16', 'uint8']
+
     def __init__(self, num_units):
         """
         Create a layer with Bernoulli units.
@@ -1048,6 +1336,7 @@ class BernoulliLayer(Layer):
             layer.add_penalty({k: penalties.from_config(v)})
         for k, v in config["constraints"].items():
             layer.add_constraint({k: getattr(constraints, v)})
+        layer.set_precision(config.get("precision", "float32"))
         return layer
 
     def energy(self, data):
@@ -1185,9 +1474,7 @@ class BernoulliLayer(Layer):
             tensor: conditional parameters
 
         """
-        field = be.dot(scaled_units[0], weights[0])
-        for i in range(1, len(weights)):
-            field += be.dot(scaled_units[i], weights[i])
+        field = connected_field(scaled_units, weights)
         if beta is not None:
             field *= be.broadcast(beta, field)
         field += be.broadcast(self.params.loc, field)
@@ -1253,7 +1540,7 @@ class BernoulliLayer(Layer):
         field = self._conditional_params(scaled_units, weights, beta)
         p = be.expit(field)
         r = self.rand(be.shape(p))
-        return be.float_tensor(r < p)
+        return be.cast_tensor(r < p, self.precision)
 
     def random(self, array_or_shape):
         """
@@ -1279,7 +1566,7 @@ class BernoulliLayer(Layer):
 
         r = self.rand(shape)
         p = be.expit(be.broadcast(self.params.loc, r))
-        return be.float_tensor(r < p)
+        return be.cast_tensor(r < p, self.precision)
 
 
 ParamsExponential = namedtuple("ParamsExponential", ["loc"])
@@ -1287,6 +1574,8 @@ ParamsExponential = namedtuple("ParamsExponential", ["loc"])
 class ExponentialLayer(Layer):
     """Layer with Exponential units (non-negative)."""
 
+    precisions = ['float32', 'float16']
+
     def __init__(self, num_units):
         """
         Create a layer with Exponential units.
@@ -1340,6 +1629,7 @@ class ExponentialLayer(Layer):
             layer.add_penalty({k: penalties.from_config(v)})
         for k, v in config["constraints"].items():
             layer.add_constraint({k: getattr(constraints, v)})
+        layer.set_precision(config.get("precision", "float32"))
         return layer
 
     def energy(self, data):
@@ -1477,9 +1767,7 @@ class ExponentialLayer(Layer):
             tensor: conditional parameters
 
         """
-        rate = -be.dot(scaled_units[0], weights[0])
-        for i in range(1, len(weights)):
-            rate -= be.dot(scaled_units[i], weights[i])
+        rate = -connected_field(scaled_units, weights)
         if beta is not None:
             rate *= be.broadcast(beta,rate)
         rate += be.broadcast(self.params.loc, rate)
@@ -1543,7 +1831,8 @@ class ExponentialLayer(Layer):
         """
         rate = self._conditional_params(scaled_units, weights, beta)
         r = self.rand(be.shape(rate))
-        return -be.log(r) / rate
+        # the uniform numbers include 0 but not 1
+        return be.cast_tensor(-be.log(1 - r) / rate, self.precision)
 
     def random(self, array_or_shape):
         """
@@ -1568,12 +1857,61 @@ class ExponentialLayer(Layer):
             shape = array_or_shape
 
         r = self.rand(shape)
-        return be.divide(self.params.loc, -be.log(r))
+        # the uniform numbers include 0 but not 1
+        return be.cast_tensor(be.divide(self.params.loc, -be.log(1 - r)),
+                              self.precision)
 
 
 
 # ---- FUNCTIONS ----- #
 
+def weights_product(x, weights):
+    """
+    Multiply a batch of rescaled units by the weights connecting
+    their layer to another layer.
+
+    Args:
+        x (tensor (num_samples, num_units)): rescaled units
+        weights: a tensor (num_units, num_connected_units), or a
+            ConvolutionOperator
+
+    Returns:
+        tensor (num_samples, num_connected_units)
+
+    """
+    if isinstance(weights, ConvolutionOperator):
+        return weights.product(x)
+    return be.dot(x, weights)
+
+def connected_field(scaled_units, weights):
+    """
+    Compute the field on a layer from the connected layers.
+
+    field = \sum_i scaled_units[i] weights[i]
+
+    Notes:
+        A weight of None means that the corresponding entry of
+        scaled_units is already a field on the layer (e.g., a field
+        that is cached between block updates). It is not modified.
+
+    Args:
+        scaled_units list[tensor (num_samples, num_connected_units)]:
+            The rescaled values of the connected units.
+        weights list[tensor (num_connected_units, num_units)]:
+            The weights connecting the layers (see weights_product).
+
+    Returns:
+        tensor (num_samples, num_units): a new tensor with the field
+
+    """
+    field = None
+    for x, w in zip(scaled_units, weights):
+        if field is None:
+            field = weights_product(x, w) if w is not None else x + 0
+        else:
+            field += weights_product(x, w) if w is not None else x
+    return field
+
 def get(key):
     if 'gauss' in key.lower():
         return GaussianLayer
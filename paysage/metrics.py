@@ -8,6 +8,7 @@ from collections import namedtuple
 import math
 
 from . import backends as be
+from . import partition
 
 # ----- CLASSES ----- #
 
@@ -361,3 +362,181 @@ class EnergyZscore(object):
             return (self.data_mean - self.random_mean) / math.sqrt(self.random_mean_square)
         else:
             return None
+
+
+class LogLikelihood(object):
+    """
+    The average log-likelihood of the observations,
+    log p(v) = -F(v) - log Z, where the log partition function
+    is estimated by annealed importance sampling (see partition.AIS).
+
+    """
+
+    name = 'LogLikelihood'
+
+    def __init__(self, num_chains=100, num_steps=1000):
+        """
+        Create a LogLikelihood object.
+
+        Args:
+            num_chains (int; optional): the number of AIS chains
+            num_steps (int; optional): the number of AIS annealing steps
+
+        Returns:
+            log-likelihood object
+
+        """
+        self.num_chains = num_chains
+        self.num_steps = num_steps
+        self.log_Z = None
+        self.log_likelihood = 0
+        self.norm = 0
+
+    def reset(self) -> None:
+        """
+        Reset the metric to it's initial state.
+
+        Note:
+            Modifies log_Z, log_likelihood, and norm in place.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        self.log_Z = None
+        self.log_likelihood = 0
+        self.norm = 0
+
+    def update(self, update_args: MetricState) -> None:
+        """
+        Update the estimate for the log-likelihood using a batch
+        of observations.
+
+        Notes:
+            Changes log_Z, log_likelihood, and norm in place.
+            Estimates log_Z on the first update after a reset.
+
+        Args:
+            minibatch (State): observations
+            amodel (Model): the model
+            kwargs: key word arguments
+                not used, but helpful for looping through metric functions
+
+        Returns:
+            None
+
+        """
+        if self.log_Z is None:
+            ais = partition.AIS(update_args.amodel, self.num_chains,
+                                partition.linear_schedule(self.num_steps))
+            self.log_Z, _ = ais.run()
+        self.norm += be.shape(update_args.minibatch.units[0])[0]
+        self.log_likelihood -= be.tsum(update_args.amodel
+                                       .marginal_free_energy(update_args.minibatch))
+
+    def value(self) -> float:
+        """
+        Get the value of the log-likelihood.
+
+        Args:
+            None
+
+        Returns:
+            log-likelihood (float)
+
+        """
+        if self.norm:
+            return self.log_likelihood / self.norm - self.log_Z
+        else:
+            return None
+
+
+class ExactLogLikelihood(object):
+    """
+    The average log-likelihood of the observations computed with the
+    exact partition function (see partition.ExactPartition).
+    Only for models with a small Bernoulli hidden layer.
+
+    """
+
+    name = 'ExactLogLikelihood'
+
+    def __init__(self, num_threads=1):
+        """
+        Create an ExactLogLikelihood object.
+
+        Args:
+            num_threads (int; optional): the number of enumeration threads
+
+        Returns:
+            exact log-likelihood object
+
+        """
+        self.num_threads = num_threads
+        self.log_Z = None
+        self.log_likelihood = 0
+        self.norm = 0
+
+    def reset(self) -> None:
+        """
+        Reset the metric to it's initial state.
+
+        Note:
+            Modifies log_Z, log_likelihood, and norm in place.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        self.log_Z = None
+        self.log_likelihood = 0
+        self.norm = 0
+
+    def update(self, update_args: MetricState) -> None:
+        """
+        Update the log-likelihood using a batch of observations.
+
+        Notes:
+            Changes log_Z, log_likelihood, and norm in place.
+            Computes log_Z on the first update after a reset.
+
+        Args:
+            minibatch (State): observations
+            amodel (Model): the model
+            kwargs: key word arguments
+                not used, but helpful for looping through metric functions
+
+        Returns:
+            None
+
+        """
+        if self.log_Z is None:
+            with partition.ExactPartition(update_args.amodel,
+                                          num_threads=self.num_threads) \
+                as engine:
+                self.log_Z = engine.log_partition_function()
+        self.norm += be.shape(update_args.minibatch.units[0])[0]
+        self.log_likelihood -= be.tsum(update_args.amodel
+                                       .marginal_free_energy(update_args.minibatch))
+
+    def value(self) -> float:
+        """
+        Get the value of the log-likelihood.
+
+        Args:
+            None
+
+        Returns:
+            log-likelihood (float)
+
+        """
+        if self.norm:
+            return self.log_likelihood / self.norm - self.log_Z
+        else:
+            return None
@@ -5,3 +5,4 @@ from . import model
 from . import tap_machine
 from . import recurrent
 from . import deep
+from . import stacked
@@ -0,0 +1,268 @@
+"""
+Fused Gibbs sampling kernels for specific pairs of layers.
+
+Each Gibbs step through Model._alternating_update allocates several
+temporary tensors per layer. For the most common models the
+full chain can instead be run inside a single compiled kernel that
+updates the units in place, reuses its buffers between calls, and uses
+an independent random number generator for each chain.
+
+Only available with the python backend.
+
+"""
+import math
+import numpy
+from numba import jit, prange
+
+from .. import backends as be
+from .. import layers
+
+# ----- RANDOM NUMBERS ----- #
+
+@jit(nopython=True, nogil=True)
+def _uniform(rng, i):
+    """
+    Draw a uniform random number in [0, 1) from the xorshift64* generator
+    of chain i.
+
+    Notes:
+        Modifies rng[i] in place.
+
+    Args:
+        rng (uint64[:]): generator states, one per chain
+        i (int): the index of the chain
+
+    Returns:
+        float32
+
+    """
+    x = rng[i]
+    x ^= x >> numpy.uint64(12)
+    x ^= x << numpy.uint64(25)
+    x ^= x >> numpy.uint64(27)
+    rng[i] = x
+    x = x * numpy.uint64(0x2545F4914F6CDD1D)
+    return numpy.float32(x >> numpy.uint64(40)) * numpy.float32(1.0 / 16777216.0)
+
+# ----- KERNELS ----- #
+
+@jit(nopython=True, nogil=True)
+def _bernoulli_update(i, source, W, loc, beta, target, field, rng):
+    """
+    Sample the units of one Bernoulli layer for chain i
+    conditioned on a connected Bernoulli layer.
+
+    field_j = beta_i * sum_k source_ik W_kj + loc_j
+    target_ij = 1 with probability expit(field_j)
+
+    Notes:
+        Modifies target[i], field[i], and rng[i] in place.
+        Only the rows of W for active source units are read.
+
+    Args:
+        i (int): the index of the chain
+        source (float32[:,:]): units of the connected layer
+        W (float32[:,:]): weights (num_source_units, num_target_units)
+        loc (float32[:]): biases of the updated layer
+        beta (float32[:]): inverse temperature of each chain
+        target (float32[:,:]): units of the updated layer
+        field (float32[:,:]): buffer for the field on the updated layer
+        rng (uint64[:]): generator states, one per chain
+
+    Returns:
+        None
+
+    """
+    n = W.shape[1]
+    f = field[i]
+    for j in range(n):
+        f[j] = 0.0
+    for k in range(W.shape[0]):
+        if source[i, k] != 0.0:
+            s = source[i, k]
+            for j in range(n):
+                f[j] += s * W[k, j]
+    b = beta[i]
+    for j in range(n):
+        p = 1.0 / (1.0 + math.exp(-(b * f[j] + loc[j])))
+        if _uniform(rng, i) < p:
+            target[i, j] = 1.0
+        else:
+            target[i, j] = 0.0
+
+def _bernoulli_gibbs(steps, vis, hid, W, W_T, a, b, beta, vis_field,
+                     hid_field, rng, update_vis, update_hid):
+    """
+    Run Gibbs sampling on a Bernoulli-Bernoulli RBM.
+
+    Notes:
+        Modifies vis, hid, the field buffers, and rng in place.
+
+    Args:
+        steps (int): the number of Gibbs steps
+        vis (float32[:,:]): visible units (num_chains, num_visible)
+        hid (float32[:,:]): hidden units (num_chains, num_hidden)
+        W (float32[:,:]): weights (num_visible, num_hidden)
+        W_T (float32[:,:]): contiguous transpose of the weights
+        a (float32[:]): visible biases
+        b (float32[:]): hidden biases
+        beta (float32[:]): inverse temperature of each chain
+        vis_field (float32[:,:]): buffer (num_chains, num_visible)
+        hid_field (float32[:,:]): buffer (num_chains, num_hidden)
+        rng (uint64[:]): generator states, one per chain
+        update_vis (bool): whether to update the visible layer
+        update_hid (bool): whether to update the hidden layer
+
+    Returns:
+        None
+
+    """
+    for i in prange(vis.shape[0]):
+        for _ in range(steps):
+            # update the odd (hidden) then the even (visible) layers
+            if update_hid:
+                _bernoulli_update(i, vis, W, b, beta, hid, hid_field, rng)
+            if update_vis:
+                _bernoulli_update(i, hid, W_T, a, beta, vis, vis_field, rng)
+
+# the chains are distributed over threads unless use_threads is False
+# (e.g., in worker processes that already run in parallel)
+use_threads = True
+# set once the threaded kernel has started the numba thread pool,
+# after which it is no longer safe to fork the process
+threads_started = False
+_bernoulli_gibbs_threaded = jit(nopython=True, nogil=True,
+                                parallel=True)(_bernoulli_gibbs)
+_bernoulli_gibbs_serial = jit(nopython=True, nogil=True)(_bernoulli_gibbs)
+
+# ----- ENGINES ----- #
+
+class BernoulliGibbsEngine(object):
+    """
+    Fused Gibbs sampler for an RBM with Bernoulli visible
+    and Bernoulli hidden layers.
+
+    """
+    # for larger weight matrices a dense matrix product (BLAS)
+    # is faster than the per chain sparse accumulation of the kernel
+    max_weights = 2 ** 18
+
+    def __init__(self):
+        """
+        Create a fused Gibbs engine.
+        The buffers are allocated on the first call.
+
+        Args:
+            None
+
+        Returns:
+            BernoulliGibbsEngine
+
+        """
+        self.vis_field = None
+        self.hid_field = None
+        self.rng = None
+        self.ones = None
+
+    @staticmethod
+    def supports(model):
+        """
+        Check if the engine can (efficiently) sample from a model.
+
+        Args:
+            model: a model object
+
+        Returns:
+            bool
+
+        """
+        return (be.config['backend'] == 'python'
+                and model.num_layers == 2
+                and type(model.weights[0]) is layers.Weights
+                and all(type(ly) is layers.BernoulliLayer
+                        and ly.precision == 'float32'
+                        for ly in model.layers)
+                and be.num_elements(model.weights[0].W())
+                    <= BernoulliGibbsEngine.max_weights)
+
+    def _buffers(self, num_chains, num_visible, num_hidden):
+        """
+        Make sure the buffers match the number of chains and units.
+
+        Notes:
+            Modifies the buffer attributes in place.
+
+        Args:
+            num_chains (int)
+            num_visible (int)
+            num_hidden (int)
+
+        Returns:
+            None
+
+        """
+        if (self.vis_field is None
+            or self.vis_field.shape != (num_chains, num_visible)
+            or self.hid_field.shape != (num_chains, num_hidden)):
+            self.vis_field = numpy.empty((num_chains, num_visible),
+                                         dtype=numpy.float32)
+            self.hid_field = numpy.empty((num_chains, num_hidden),
+                                         dtype=numpy.float32)
+            self.rng = numpy.empty(num_chains, dtype=numpy.uint64)
+            self.ones = numpy.ones(num_chains, dtype=numpy.float32)
+
+    def run(self, model, n, state, beta=None, clamped=[]):
+        """
+        Perform multiple Gibbs sampling steps in alternating layers.
+
+        Notes:
+            Modifies the units of state in place. Units that are not
+            contiguous float32 arrays (e.g., the row tiles of a larger
+            State) are sampled in a copy that is written back.
+            The generator of each chain is seeded from the current
+            random stream of the backend, so runs are reproducible.
+
+        Args:
+            model: a model object
+            n (int): number of steps
+            state (State object): the current state of each layer
+            beta (optional, tensor (batch_size, 1)): Inverse temperatures
+            clamped (list): list of layer indices to clamp
+
+        Returns:
+            None
+
+        """
+        units = [numpy.ascontiguousarray(u, dtype=numpy.float32)
+                 for u in state.units]
+        vis, hid = units
+        num_chains = vis.shape[0]
+        self._buffers(num_chains, vis.shape[1], hid.shape[1])
+
+        W = numpy.ascontiguousarray(model.weights[0].W(), dtype=numpy.float32)
+        W_T = numpy.ascontiguousarray(W.T)
+        a = numpy.ascontiguousarray(model.layers[0].params.loc,
+                                    dtype=numpy.float32)
+        b = numpy.ascontiguousarray(model.layers[1].params.loc,
+                                    dtype=numpy.float32)
+        if beta is None:
+            beta = self.ones
+        else:
+            beta = numpy.ascontiguousarray(beta, dtype=numpy.float32).ravel()
+
+        # the state of a xorshift generator cannot be zero
+        self.rng[:] = be.get_stream().bits((num_chains,))
+
+        global threads_started
+        if use_threads:
+            threads_started = True
+            kernel = _bernoulli_gibbs_threaded
+        else:
+            kernel = _bernoulli_gibbs_serial
+        kernel(n, vis, hid, W, W_T, a, b, beta,
+               self.vis_field, self.hid_field, self.rng,
+               0 not in clamped, 1 not in clamped)
+
+        for u, x in zip(state.units, units):
+            if x is not u:
+                u[...] = x
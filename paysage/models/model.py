@@ -1,11 +1,14 @@
 import os
 import copy
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
 import pandas
 
 from .. import layers
 from .. import backends as be
 from ..models.initialize import init_model as init
 from . import gradient_util as gu
+from . import fused_gibbs
 
 class State(object):
     """
@@ -87,12 +90,124 @@ class State(object):
         """
         return copy.deepcopy(state)
 
+    def copy_from(self, state):
+        """
+        Copy the units of another State with the same shapes.
+
+        Notes:
+            Modifies the units of the State in place.
+
+        Args:
+            state (State): a State instance
+
+        Returns:
+            None
+
+        """
+        for x, u in zip(self.units, state.units):
+            be.copy_inplace(x, u)
+
+
+
+# a layer update in a Gibbs sweep: the index of the layer, the bound layer
+# function, the (index, rescale function) of each connected layer, and the
+# (weights layer, transposed) pair of each connecting weights layer
+PlanStep = namedtuple("PlanStep", ["index", "update", "connected", "weights"])
+
+class UpdatePlan(object):
+    """
+    The sequence of layer updates in an alternating Gibbs sweep,
+    resolved once for a model, a layer function, and a set of clamped layers.
+
+    The plan holds the bound layer functions and the connections of each
+    updated layer, so the steps of a sampling loop do not look them up
+    again. It remains valid while the model has the same layer and weight
+    objects (see is_valid).
+
+    The steps are grouped by the parity of their layers. The layers in a
+    group are not connected to each other, so they can be updated in any
+    order (or concurrently) from the units of the other group.
+
+    """
+    def __init__(self, model, func_name, clamped=[]):
+        """
+        Compile an update plan.
+
+        Args:
+            model (Model): a model object
+            func_name (str): the layer function to apply to the units
+            clamped (list): list of layer indices to clamp (no update)
+
+        Returns:
+            UpdatePlan
+
+        """
+        self.layers = list(model.layers)
+        self.weights = list(model.weights)
+        self.steps = []
+        # the positions in steps of the updates in each parity group
+        self.groups = []
+        # update the odd then the even layers
+        for ll in [range(1, model.num_layers, 2),
+                   range(0, model.num_layers, 2)]:
+            group = []
+            for i in ll:
+                if i in clamped:
+                    continue
+                group.append(len(self.steps))
+                self.steps.append(PlanStep(
+                    i,
+                    getattr(model.layers[i], func_name),
+                    [(j, model.layers[j].rescale)
+                     for j in model.layer_connections[i]],
+                    [(model.weights[j], j >= i)
+                     for j in model.weight_connections[i]]
+                ))
+            if group:
+                self.groups.append(group)
+
+    def is_valid(self, model):
+        """
+        Check if the plan still describes the structure of a model.
+
+        Args:
+            model (Model): a model object
+
+        Returns:
+            bool
+
+        """
+        return (len(model.layers) == len(self.layers)
+                and len(model.weights) == len(self.weights)
+                and all(a is b for a, b in zip(model.layers, self.layers))
+                and all(a is b for a, b in zip(model.weights, self.weights)))
+
+    def connected_weights(self):
+        """
+        Get the current weights connected to the layer of each step.
+
+        Notes:
+            The weight parameters are replaced by the optimizers, so they
+            are resolved once per sampling call rather than compiled.
+
+        Args:
+            None
+
+        Returns:
+            list[list[tensor]]: the weights for each step
+
+        """
+        return [[w.W_T() if transposed else w.W()
+                 for w, transposed in step.weights]
+                for step in self.steps]
+
 
 class Model(object):
     """
     General model class.
-    Currently only supports models with 2 layers,
-    (i.e., Restricted Boltzmann Machines).
+    A chain of layers connected by weights: 2 layers form a
+    Restricted Boltzmann Machine, more layers a Deep Boltzmann Machine.
+    Some samplers and marginal_free_energy only support 2-layer models.
 
     Example usage:
     '''
@@ -101,16 +216,18 @@ class Model(object):
     rbm = Model([vis, hid])
     '''
 
+    The weights are dense matrices unless other weights layers are given
+    (e.g., layers.ConvolutionalWeights).
+
     """
-    def __init__(self, layer_list):
+    def __init__(self, layer_list, weights=None):
         """
         Create a model.
 
-        Notes:
-            Only 2-layer models currently supported.
-
         Args:
             layer_list: A list of layers objects.
+            weights (optional): A list of weights layers connecting
+                adjacent layers. Defaults to dense layers.Weights.
 
         Returns:
             model: A model.
@@ -123,15 +240,45 @@ class Model(object):
         self.layer_connections = self._layer_connections()
         self.weight_connections = self._weight_connections()
 
-        assert self.num_layers == 2,\
-        "Only models with 2 layers are currently supported"
-
         # adjacent layers are connected by weights
         # therefore, if there are len(layers) = n then len(weights) = n - 1
-        self.weights = [
-            layers.Weights((self.layers[i].len, self.layers[i+1].len))
-        for i in range(self.num_layers - 1)
-        ]
+        if weights is None:
+            self.weights = [
+                layers.Weights((self.layers[i].len, self.layers[i+1].len))
+            for i in range(self.num_layers - 1)
+            ]
+        else:
+            assert len(weights) == self.num_layers - 1,\
+            "A model with n layers needs n - 1 weights layers"
+            self.weights = list(weights)
+
+        # optionally use a compiled Gibbs sampler for supported layer types
+        # (opt in, because it draws from a different random stream and
+        # starts a thread pool)
+        self.use_fused_sampler = False
+        self.fused_sampler = None
+
+        # optionally update only a random block of this many hidden units
+        # in each Monte Carlo step and gradient estimate (for wide models)
+        self.hidden_block_size = None
+
+        # optionally update the fields on the layers from the units that
+        # changed in each Monte Carlo step, recomputing a field in full
+        # when more than this fraction of the connected units changed
+        self.max_flip_fraction = None
+
+        # optionally process States with more rows than this in tiles
+        # of this many rows, to bound the memory used by temporaries
+        self.max_tile_rows = None
+
+        # compiled update plans, keyed by (layer function, clamped layers)
+        self.update_plans = {}
+
+        # optionally update the layers of each parity group concurrently
+        # on a pool of this many threads (for models with more than 2 layers;
+        # call close() before changing it)
+        self.layer_threads = 0
+        self.layer_executor = None
 
     def get_config(self) -> dict:
         """
@@ -150,6 +297,7 @@ class Model(object):
         config = {
             "model type": "RBM",
             "layers": [ly.get_config() for ly in self.layers],
+            "weights": [w.get_config() for w in self.weights],
         }
         return config
 
@@ -168,7 +316,10 @@ class Model(object):
         layer_list = []
         for ly in config["layers"]:
             layer_list.append(layers.Layer.from_config(ly))
-        return cls(layer_list)
+        weights = None
+        if "weights" in config:
+            weights = [layers.Layer.from_config(w) for w in config["weights"]]
+        return cls(layer_list, weights)
 
     def initialize(self, data, method: str='hinton'):
         """
@@ -269,39 +420,490 @@ class Model(object):
                             for j in self.weight_connections[i]]
 
 
-    def _alternating_update(self, func_name, state, beta=None, clamped=[]):
+    def _update_plan(self, func_name, clamped=[]):
+        """
+        Get the compiled update plan for a layer function and a set of
+        clamped layers, compiling it if needed.
+
+        Notes:
+            The plan is compiled again if the layer or weight objects
+            of the model have been replaced.
+
+        Args:
+            func_name (str, function name): layer function name to apply to the units to sample
+            clamped (list): list of layer indices to clamp (no update)
+
+        Returns:
+            UpdatePlan
+
+        """
+        key = (func_name, tuple(sorted(set(clamped))))
+        plan = self.update_plans.get(key)
+        if plan is None or not plan.is_valid(self):
+            plan = UpdatePlan(self, func_name, clamped)
+            self.update_plans[key] = plan
+        return plan
+
+    def _alternating_update(self, func_name, state, beta=None, clamped=[],
+                            out=None, free=None, plan=None, weights=None):
         """
         Performs a single Gibbs sampling update in alternating layers.
         state -> new state
 
+        Notes:
+            The layer functions return new tensors, so the units of the
+            input state are not modified. If out is provided, the updated
+            units are copied into its tensors instead. Because the odd
+            layers only depend on the even layers (and vice versa),
+            out may be the input state itself.
+
+            If layer_threads is set, the layers of a parity group are
+            updated concurrently (see _layer_executor).
+
         Args:
             func_name (str, function name): layer function name to apply to the units to sample
             state (State object): the current state of each layer
             beta (optional, tensor (batch_size, 1)): Inverse temperatures
             clamped (list): list of layer indices to clamp (no update)
+            out (optional, State object): preallocated storage for the result
+            free (optional, list): for each layer, None or a tensor
+                (batch_size, num_units) with 0 for the units that keep
+                their current values and 1 for the units to update
+                (see _free_units)
+            plan (optional, UpdatePlan): the compiled plan for func_name
+                and clamped (see _update_plan)
+            weights (optional, list): the result of plan.connected_weights()
 
         Returns:
             new state
 
         """
-        updated_state = State.from_state(state)
-
-        # update the odd then the even layers
-        for ll in [range(1, self.num_layers, 2), range(0, self.num_layers, 2)]:
-            for i in ll:
-                if i in clamped:
-                    continue
+        if plan is None:
+            plan = self._update_plan(func_name, clamped)
+        if weights is None:
+            weights = plan.connected_weights()
+
+        # a new list of references to the tensors, not a copy of the tensors
+        updated_state = State(list(state.units))
+
+        def update(k):
+            step = plan.steps[k]
+            i = step.index
+            units = step.update(
+                [rescale(updated_state.units[j])
+                 for j, rescale in step.connected],
+                weights[k],
+                beta)
+
+            if free is not None and free[i] is not None:
+                # keep the current values of the clamped units
+                mixed = be.cast_tensor(units, 'float32')
+                be.mix_inplace(free[i], mixed, updated_state.units[i])
+                units = be.cast_tensor(mixed, self.layers[i].precision)
+            return units
+
+        executor = self._layer_executor()
+        for group in plan.groups:
+            # the layers of a group only read the units of the other group
+            if executor is None or len(group) == 1:
+                new_units = [update(k) for k in group]
+            else:
+                new_units = list(executor.map(update, group))
+
+            for k, units in zip(group, new_units):
+                i = plan.steps[k].index
+                if out is None:
+                    updated_state.units[i] = units
                 else:
-                    func = getattr(self.layers[i], func_name)
+                    be.copy_inplace(out.units[i], units)
+                    updated_state.units[i] = out.units[i]
+
+        if out is None:
+            return updated_state
+
+        for i in clamped:
+            if out.units[i] is not state.units[i]:
+                be.copy_inplace(out.units[i], state.units[i])
+        return out
+
+    def _layer_executor(self):
+        """
+        Get the thread pool that updates the layers of a parity group
+        concurrently, starting it if needed.
+
+        Notes:
+            The updates of the layers mostly run in matrix products and
+            numexpr kernels, which release the GIL, so the threads
+            overlap the layers of a deep model. With 2 layers there
+            is only one layer in each group, so no pool is started.
+            The random draws of the layers are interleaved in the order
+            the threads run, so the samples follow the same distribution
+            as without threads but are not reproducible from a seed.
+
+        Args:
+            None
+
+        Returns:
+            ThreadPoolExecutor, or None if the layers are updated serially
+
+        """
+        if not self.layer_threads or self.num_layers < 3:
+            return None
+        if self.layer_executor is None:
+            self.layer_executor = ThreadPoolExecutor(self.layer_threads)
+        return self.layer_executor
+
+    def close(self):
+        """
+        Shut down the thread pool of the layer updates, if there is one.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.layer_executor is not None:
+            self.layer_executor.shutdown()
+            self.layer_executor = None
+
+    def _free_units(self, mask):
+        """
+        Convert per unit clamp masks into the weights of the updated units.
+
+        Args:
+            mask (list): for each layer, None or a tensor
+                (batch_size, num_units) with 1 for clamped units
+                and 0 for free units
+
+        Returns:
+            list: for each layer, None or 1 - mask
+
+        """
+        if mask is None:
+            return None
+        return [None if m is None else 1 - be.float_tensor(m) for m in mask]
+
+    def _iterate(self, func_name, n, state, beta=None, clamped=[], out=None,
+                 mask=None):
+        """
+        Apply multiple alternating updates.
+        state -> new state
+
+        Notes:
+            Without out, the state is copied once and the steps only
+            allocate the new units of each layer. With out, the first step
+            reads from state and every step writes into out, so no State
+            is allocated or copied. The update plan and the weights are
+            resolved once, before the first step.
+
+        Args:
+            func_name (str, function name): layer function name to apply to the units to sample
+            n (int): number of steps.
+            state (State object): the current state of each layer
+            beta (optional, tensor (batch_size, 1)): Inverse temperatures
+            clamped (list): list of layer indices to clamp
+            out (optional, State object): preallocated storage for the result
+            mask (optional, list): per unit clamp masks for each layer
+
+        Returns:
+            new state
+
+        """
+        free = self._free_units(mask)
+        # resolve the layer functions and weights once for all of the steps
+        plan = self._update_plan(func_name, clamped)
+        weights = plan.connected_weights()
+        if out is None:
+            new_state = State.from_state(state)
+            for _ in range(n):
+                new_state = self._alternating_update(func_name, new_state,
+                                                     beta, clamped, None,
+                                                     free, plan, weights)
+            return new_state
+
+        if n == 0 and out is not state:
+            out.copy_from(state)
+        new_state = state
+        for _ in range(n):
+            new_state = self._alternating_update(func_name, new_state,
+                                                 beta, clamped, out, free,
+                                                 plan, weights)
+        return out
+
+    def _tiles(self, num_rows):
+        """
+        Split the rows of a State into tiles of at most max_tile_rows rows.
+
+        Args:
+            num_rows (int): the number of rows
+
+        Returns:
+            List[(int, int)], or None if the rows are not tiled
+
+        """
+        if self.max_tile_rows is None or num_rows <= self.max_tile_rows:
+            return None
+        return [(start, min(start + self.max_tile_rows, num_rows))
+                for start in range(0, num_rows, self.max_tile_rows)]
+
+    def _tiled_iteration(self, func, tiles, n, state, beta=None, clamped=[],
+                         out=None, mask=None):
+        """
+        Apply an iteration method to the tiles of a State.
+
+        Notes:
+            The chains are independent, so each tile is updated
+            separately, in place in the output State. Only the
+            temporaries of one tile are allocated at a time.
+
+        Args:
+            func (callable): markov_chain, mean_field_iteration,
+                or deterministic_iteration
+            tiles (List[(int, int)]): the rows of each tile
+            n (int): number of steps.
+            state (State object): the current state of each layer
+            beta (optional, tensor (batch_size, 1)): Inverse temperatures
+            clamped (list): list of layer indices to clamp
+            out (optional, State object): preallocated storage for the
+                result (may be state itself)
+            mask (optional, list): per unit clamp masks for each layer
+
+        Returns:
+            new state
+
+        """
+        if out is None:
+            out = State.from_state(state)
+        elif out is not state:
+            out.copy_from(state)
+        for start, stop in tiles:
+            tile = State([u[start:stop] for u in out.units])
+            func(n, tile,
+                 None if beta is None else beta[start:stop],
+                 clamped, out=tile,
+                 mask=None if mask is None else
+                      [None if m is None else m[start:stop] for m in mask])
+        return out
+
+    def _tiled_energy(self, func, tiles, data, beta=None):
+        """
+        Evaluate an energy function on the tiles of a State.
+
+        Args:
+            func (callable): joint_energy or marginal_free_energy
+            tiles (List[(int, int)]): the rows of each tile
+            data (State object): the current state of each layer
+            beta (optional, tensor (num_samples, 1)): Inverse temperatures
+
+        Returns:
+            tensor (num_samples,)
+
+        """
+        energy = be.zeros((tiles[-1][1],))
+        for start, stop in tiles:
+            tile = State([u[start:stop] for u in data.units])
+            be.copy_inplace(energy[start:stop],
+                            func(tile, None if beta is None
+                                 else beta[start:stop]))
+        return energy
+
+    def _dense_rbm(self):
+        """
+        Check if the model has 2 layers connected by a dense weight matrix
+        (required by the samplers that select rows or columns of it).
+
+        Args:
+            None
+
+        Returns:
+            bool
+
+        """
+        return self.num_layers == 2 and type(self.weights[0]) is layers.Weights
+
+    def _use_hidden_blocks(self, clamped=[]):
+        """
+        Check if the hidden units should be updated in random blocks.
+
+        Args:
+            clamped (list): list of layer indices to clamp
+
+        Returns:
+            bool
+
+        """
+        return (self.hidden_block_size is not None
+                and self._dense_rbm()
+                and 1 not in clamped
+                and self.hidden_block_size < self.layers[1].len)
+
+    def _hidden_block(self):
+        """
+        Choose a random block of hidden units.
+
+        Args:
+            None
+
+        Returns:
+            tensor (hidden_block_size,): the indices of the hidden units
+
+        """
+        return be.randperm(self.layers[1].len)[:self.hidden_block_size]
+
+    def _block_markov_chain(self, n, state, beta=None, clamped=[], out=None):
+        """
+        Perform multiple block stochastic Gibbs sampling steps.
+        state -> new state
+
+        Notes:
+            Each step resamples a random block of hidden_block_size
+            hidden units conditioned on the visible units, and then the
+            visible units conditioned on all of the hidden units.
+            Choosing the block at random in every step (random scan
+            block Gibbs sampling) preserves the stationary distribution.
+
+            The field on the visible layer is computed once and then
+            updated with the change in the block, so each further step
+            costs O(num_visible * hidden_block_size) per chain
+            instead of O(num_visible * num_hidden).
+
+        Args:
+            n (int): number of steps.
+            state (State object): the current state of each layer
+            beta (optional, tensor (batch_size, 1)): Inverse temperatures
+            clamped (list): list of layer indices to clamp
+            out (optional, State object): preallocated storage for the
+                result (may be state itself).
+
+        Returns:
+            new state
+
+        """
+        if out is None:
+            new_state = State.from_state(state)
+        else:
+            new_state = out
+            if out is not state:
+                out.copy_from(state)
+        vis_layer, hid_layer = self.layers
+        vis, hid = new_state.units
+        W = self.weights[0].W()
+
+        field = be.dot(hid_layer.rescale(hid), self.weights[0].W_T())
+        for _ in range(n):
+            index = self._hidden_block()
+            block = hid_layer.subset(index)
+            W_block = be.index_select(W, index, axis=1)
+            old_units = block.rescale(be.index_select(hid, index, axis=1))
+            units = block.conditional_sample([vis_layer.rescale(vis)],
+                                             [W_block], beta)
+            be.index_copy_inplace(hid, index, units, axis=1)
+            # subtract in single precision (the units may be unsigned)
+            field += be.dot(be.cast_tensor(block.rescale(units), 'float32')
+                            - be.cast_tensor(old_units, 'float32'),
+                            be.transpose(W_block))
+            if 0 not in clamped:
+                be.copy_inplace(vis, vis_layer.conditional_sample(
+                                [field], [None], beta))
+        return new_state
+
+    def _update_field(self, field, delta, W):
+        """
+        Add the change in the field on a layer caused by a change in
+        the rescaled units of a connected layer.
+
+        field += delta W
+
+        Notes:
+            Modifies field in place.
+            Only the rows of W for the units that changed in any chain
+            are gathered, unless more than max_flip_fraction of the
+            units changed.
+
+        Args:
+            field (tensor (num_samples, num_units)): the field to update
+            delta (tensor (num_samples, num_connected_units)): the change
+                in the rescaled connected units
+            W (tensor (num_connected_units, num_units)): the weights
+
+        Returns:
+            None
 
-                    updated_state.units[i] = func(
-                        self._connected_rescaled_units(i, updated_state),
-                        self._connected_weights(i),
-                        beta)
+        """
+        index = be.flatnonzero(be.tany(delta, axis=0))
+        num_changed = be.shape(index)[0]
+        if num_changed == 0:
+            return
+        if num_changed > self.max_flip_fraction * be.shape(delta)[1]:
+            field += be.dot(delta, W)
+        else:
+            field += be.dot(be.index_select(delta, index, axis=1),
+                            be.index_select(W, index, axis=0))
+
+    def _incremental_markov_chain(self, n, state, beta=None, clamped=[],
+                                  out=None):
+        """
+        Perform multiple Gibbs sampling steps, updating the fields on the
+        layers from the units that changed.
+        state -> new state
+
+        Notes:
+            The fields on both layers are computed once. After a layer is
+            sampled, the field on the other layer is corrected with the
+            rows of the weights for the units that changed (see
+            _update_field). When the chains are nearly mixed, few units
+            change in each step, so a step costs about
+            O(num_changed * num_units) per chain instead of
+            O(num_visible * num_hidden).
+
+        Args:
+            n (int): number of steps.
+            state (State object): the current state of each layer
+            beta (optional, tensor (batch_size, 1)): Inverse temperatures
+            clamped (list): list of layer indices to clamp
+            out (optional, State object): preallocated storage for the
+                result (may be state itself).
+
+        Returns:
+            new state
 
-        return updated_state
+        """
+        if out is None:
+            new_state = State.from_state(state)
+        else:
+            new_state = out
+            if out is not state:
+                out.copy_from(state)
+        vis_layer, hid_layer = self.layers
+        vis, hid = new_state.units
+        W = self.weights[0].W()
+        W_T = self.weights[0].W_T()
+
+        # the rescaled units (in single precision) that produced the fields
+        vis_scaled = be.cast_tensor(vis_layer.rescale(vis), 'float32') + 0
+        hid_scaled = be.cast_tensor(hid_layer.rescale(hid), 'float32') + 0
+        hid_field = be.dot(vis_scaled, W)
+        vis_field = be.dot(hid_scaled, W_T)
+
+        for _ in range(n):
+            if 1 not in clamped:
+                be.copy_inplace(hid, hid_layer.conditional_sample(
+                                [hid_field], [None], beta))
+                scaled = be.cast_tensor(hid_layer.rescale(hid), 'float32')
+                self._update_field(vis_field, scaled - hid_scaled, W_T)
+                be.copy_inplace(hid_scaled, scaled)
+            if 0 not in clamped:
+                be.copy_inplace(vis, vis_layer.conditional_sample(
+                                [vis_field], [None], beta))
+                scaled = be.cast_tensor(vis_layer.rescale(vis), 'float32')
+                self._update_field(hid_field, scaled - vis_scaled, W)
+                be.copy_inplace(vis_scaled, scaled)
+        return new_state
 
-    def markov_chain(self, n, state, beta=None, clamped=[]):
+    def markov_chain(self, n, state, beta=None, clamped=[], out=None,
+                     mask=None):
         """
         Perform multiple Gibbs sampling steps in alternating layers.
         state -> new state
@@ -311,25 +913,72 @@ class Model(object):
             on adjacent layers,
             x_i ~ P(x_i | x_(i-1), x_(i+1) )
 
+            If use_fused_sampler is True, Bernoulli-Bernoulli RBMs are
+            sampled with a fused kernel (see fused_gibbs). The samples
+            follow the same distribution but a different random stream.
+
+            If hidden_block_size is set, each step only resamples a
+            random block of the hidden units (see _block_markov_chain).
+
+            If max_flip_fraction is set, the fields on the layers are
+            updated from the units that changed in each step
+            (see _incremental_markov_chain). The samples are the same
+            as without it, up to rounding.
+
+            None of these samplers supports per unit clamp masks,
+            models with more than 2 layers, or weights other than a dense
+            matrix (e.g., convolutional weights). For deep models, the layers
+            of each parity group can be updated on a thread pool by
+            setting layer_threads (see _alternating_update).
+
+            If max_tile_rows is set, larger States are updated in tiles
+            of rows (see _tiled_iteration).
+
         Args:
             n (int): number of steps.
             state (State object): the current state of each layer
             beta (optional, tensor (batch_size, 1)): Inverse temperatures
             clamped (list): list of layer indices to clamp
+            out (optional, State object): preallocated storage for the
+                result (may be state itself). Avoids copying the State.
+            mask (optional, list): for each layer, None or a tensor
+                (batch_size, num_units) with 1 for the units that are
+                clamped to their values in state and 0 for the units that
+                are sampled (e.g., to fill in missing visible units)
 
         Returns:
             new state
 
         """
-        new_state = State.from_state(state)
-        for _ in range(n):
-            new_state = self._alternating_update('conditional_sample',
-                                                 new_state,
-                                                 beta,
-                                                 clamped)
-        return new_state
-
-    def mean_field_iteration(self, n, state, beta=None, clamped=[]):
+        tiles = self._tiles(be.shape(state.units[0])[0])
+        if tiles is not None:
+            return self._tiled_iteration(self.markov_chain, tiles, n, state,
+                                         beta, clamped, out, mask)
+        if mask is not None:
+            return self._iterate('conditional_sample', n, state, beta,
+                                 clamped, out, mask)
+        if self._use_hidden_blocks(clamped):
+            return self._block_markov_chain(n, state, beta, clamped, out)
+        if self.max_flip_fraction is not None and self._dense_rbm():
+            return self._incremental_markov_chain(n, state, beta, clamped,
+                                                  out)
+        if self.use_fused_sampler and \
+            fused_gibbs.BernoulliGibbsEngine.supports(self):
+            if out is None:
+                new_state = State.from_state(state)
+            else:
+                new_state = out
+                if out is not state:
+                    out.copy_from(state)
+            if self.fused_sampler is None:
+                self.fused_sampler = fused_gibbs.BernoulliGibbsEngine()
+            self.fused_sampler.run(self, n, new_state, beta, clamped)
+            return new_state
+        return self._iterate('conditional_sample', n, state, beta, clamped,
+                             out)
+
+    def mean_field_iteration(self, n, state, beta=None, clamped=[], out=None,
+                             mask=None):
         """
         Perform multiple mean-field updates in alternating layers
         states -> new state
@@ -339,25 +988,32 @@ class Model(object):
             conditioned on adjacent layers,
             x_i = E[x_i | x_(i-1), x_(i+1) ]
 
+            If max_tile_rows is set, larger States are updated in tiles
+            of rows (see _tiled_iteration).
+
         Args:
             n (int): number of steps.
             state (State object): the current state of each layer
             beta (optional, tensor (batch_size, 1)): Inverse temperatures
             clamped (list): list of layer indices to clamp
+            out (optional, State object): preallocated storage for the
+                result (may be state itself). Avoids copying the State.
+            mask (optional, list): per unit clamp masks for each layer
+                (see markov_chain)
 
         Returns:
             new state
 
         """
-        new_state = State.from_state(state)
-        for _ in range(n):
-            new_state = self._alternating_update('conditional_mean',
-                                                 new_state,
-                                                 beta,
-                                                 clamped)
-        return new_state
-
-    def deterministic_iteration(self, n, state, beta=None, clamped=[]):
+        tiles = self._tiles(be.shape(state.units[0])[0])
+        if tiles is not None:
+            return self._tiled_iteration(self.mean_field_iteration, tiles, n,
+                                         state, beta, clamped, out, mask)
+        return self._iterate('conditional_mean', n, state, beta, clamped,
+                             out, mask)
+
+    def deterministic_iteration(self, n, state, beta=None, clamped=[],
+                                out=None, mask=None):
         """
         Perform multiple deterministic (maximum probability) updates
         in alternating layers.
@@ -368,23 +1024,60 @@ class Model(object):
             conditioned on adjacent layers,
             x_i = argmax P(x_i | x_(i-1), x_(i+1))
 
+            If max_tile_rows is set, larger States are updated in tiles
+            of rows (see _tiled_iteration).
+
         Args:
             n (int): number of steps.
             state (State object): the current state of each layer
             beta (optional, tensor (batch_size, 1)): Inverse temperatures
             clamped (list): list of layer indices to clamp
+            out (optional, State object): preallocated storage for the
+                result (may be state itself). Avoids copying the State.
+            mask (optional, list): per unit clamp masks for each layer
+                (see markov_chain)
 
         Returns:
             new state
 
         """
-        new_state = State.from_state(state)
-        for _ in range(n):
-            new_state = self._alternating_update('conditional_mode',
-                                                 new_state,
-                                                 beta,
-                                                 clamped)
-        return new_state
+        tiles = self._tiles(be.shape(state.units[0])[0])
+        if tiles is not None:
+            return self._tiled_iteration(self.deterministic_iteration, tiles,
+                                         n, state, beta, clamped, out, mask)
+        return self._iterate('conditional_mode', n, state, beta, clamped,
+                             out, mask)
+
+    def impute(self, n, vis, mask, method='markov_chain', beta=None):
+        """
+        Fill in the missing units of a batch of partially observed
+        visible vectors.
+
+        Notes:
+            The missing units are initialized with a random sample
+            from the visible layer, so their values in vis are ignored
+            (but must be finite).
+
+        Args:
+            n (int): number of steps.
+            vis (tensor (num_samples, num_visible)): visible unit values
+            mask (tensor (num_samples, num_visible)): 1 for the observed
+                units and 0 for the missing units
+            method (str; optional): 'markov_chain', 'mean_field_iteration',
+                or 'deterministic_iteration'
+            beta (optional, tensor (batch_size, 1)): Inverse temperatures
+
+        Returns:
+            tensor (num_samples, num_visible): the completed visible units
+
+        """
+        mask = be.float_tensor(mask)
+        vis = be.float_tensor(vis)
+        be.mix_inplace(mask, vis, self.layers[0].random(vis))
+        state = State.from_visible(vis, self)
+        masks = [mask] + [None for _ in range(self.num_layers - 1)]
+        return getattr(self, method)(n, state, beta, mask=masks,
+                                     out=state).units[0]
 
     def gradient(self, data_state, model_state):
         """
@@ -392,6 +1085,11 @@ class Model(object):
         Updates the states for the positive and negative phases,
         and computes the gradient from the unit values.
 
+        Notes:
+            If hidden_block_size is set, the gradient is estimated
+            from a random block of the hidden units
+            (see _block_gradient).
+
         Args:
             data_state (State object): The observed visible units and sampled hidden units.
             model_state (State objects): The visible and hidden units sampled from the model.
@@ -400,6 +1098,16 @@ class Model(object):
             dict: Gradients of the model parameters.
 
         """
+        # the derivatives are computed in single precision
+        # even if the layers store their samples in lower precision
+        data_state = State([be.cast_tensor(u, 'float32')
+                            for u in data_state.units])
+        model_state = State([be.cast_tensor(u, 'float32')
+                             for u in model_state.units])
+
+        if self._use_hidden_blocks():
+            return self._block_gradient(data_state, model_state)
+
         grad = gu.Gradient(
             [None for l in self.layers],
             [None for w in self.weights]
@@ -451,6 +1159,59 @@ class Model(object):
 
         return grad
 
+    def _block_gradient(self, data_state, model_state):
+        """
+        Estimate the gradient of the model parameters from a random
+        block of the hidden units.
+
+        Notes:
+            The derivatives with respect to the parameters of the hidden
+            units outside of the block (and of the weights connected to
+            them) are zero. The derivatives inside of the block are
+            multiplied by num_hidden / hidden_block_size, the inverse
+            of the probability that a unit is in the block, so the
+            estimate is unbiased. Both phases use the same block.
+
+        Args:
+            data_state (State object): The observed visible units and sampled hidden units.
+            model_state (State objects): The visible and hidden units sampled from the model.
+
+        Returns:
+            dict: Gradients of the model parameters.
+
+        """
+        vis_layer, hid_layer = self.layers
+        index = self._hidden_block()
+        block = hid_layer.subset(index)
+        weights = self.weights[0].subset(index)
+        scale = hid_layer.len / self.hidden_block_size
+
+        def phase(state):
+            vis = vis_layer.rescale(state.units[0])
+            hid = block.conditional_mean([vis], [weights.W()])
+            return (
+                vis_layer.derivatives(state.units[0],
+                                      [scale * block.rescale(hid)],
+                                      [weights.W_T()]),
+                block.derivatives(hid, [vis], [weights.W()]),
+                weights.derivatives(vis, block.rescale(hid))
+            )
+
+        def scatter(params, derivs):
+            full = be.apply(be.zeros_like, params)
+            for f, d in zip(full, derivs):
+                be.index_copy_inplace(f, index, scale * d, axis=-1)
+            return full
+
+        data_derivs = phase(data_state)
+        model_derivs = phase(model_state)
+        diff = [be.mapzip(be.subtract, m, d)
+                for m, d in zip(model_derivs, data_derivs)]
+        return gu.Gradient(
+            [diff[0], scatter(hid_layer.params, diff[1])],
+            [scatter(self.weights[0].params, diff[2])]
+        )
+
     def parameter_update(self, deltas):
         """
         Update the model parameters.
@@ -470,25 +1231,39 @@ class Model(object):
         for i in range(self.num_layers - 1):
             self.weights[i].parameter_step(deltas.weights[i])
 
-    def joint_energy(self, data):
+    def joint_energy(self, data, beta=None):
         """
         Compute the joint energy of the model based on a state.
 
+        Notes:
+            The inverse temperature only multiplies the contribution
+            of the weights, consistent with the conditional distributions
+            sampled by the layers.
+            If max_tile_rows is set, large States are evaluated in tiles
+            of rows.
+
         Args:
             data (State object): the current state of each layer
+            beta (optional, tensor (num_samples, 1)): Inverse temperatures
 
         Returns:
             tensor (num_samples,): Joint energies.
 
         """
+        tiles = self._tiles(be.shape(data.units[0])[0])
+        if tiles is not None:
+            return self._tiled_energy(self.joint_energy, tiles, data, beta)
         energy = 0
-        for i in range(self.num_layers - 1):
+        for i in range(self.num_layers):
             energy += self.layers[i].energy(data.units[i])
-            energy += self.layers[i+1].energy(data.units[i+1])
-            energy += self.weights[i].energy(data.units[i], data.units[i+1])
+        for i in range(self.num_layers - 1):
+            coupling = self.weights[i].energy(data.units[i], data.units[i+1])
+            if beta is not None:
+                coupling *= be.flatten(beta)
+            energy += coupling
         return energy
 
-    def marginal_free_energy(self, data):
+    def marginal_free_energy(self, data, beta=None):
         """
         Compute the marginal free energy of the model.
 
@@ -498,16 +1273,26 @@ class Model(object):
         F(v) =  -\sum_i a_i(v_i) - \sum_j \log \int dh_j \exp(b_j(h_j) - \sum_i W_{ij} v_i)
         This can be extended to a deep model by a sum over all hidden states
 
+        At inverse temperature beta, the weights are multiplied by beta.
+        If max_tile_rows is set, large States are evaluated in tiles of rows.
+
         Args:
             data (State object): The current state of each layer.
+            beta (optional, tensor (batch_size, 1)): Inverse temperatures
 
         Returns:
             tensor (batch_size, ): Marginal free energies.
 
         """
         assert self.num_layers == 2 # supported for 2-layer models only
+        tiles = self._tiles(be.shape(data.units[0])[0])
+        if tiles is not None:
+            return self._tiled_energy(self.marginal_free_energy, tiles, data,
+                                      beta)
         i = 0
-        phi = be.dot(data.units[i], self.weights[i].W())
+        phi = layers.weights_product(data.units[i], self.weights[i].W())
+        if beta is not None:
+            phi *= be.broadcast(beta, phi)
         log_Z_hidden = self.layers[i+1].log_partition_function(phi)
         energy = 0
         energy += self.layers[i].energy(data.units[i])
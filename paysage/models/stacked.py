@@ -0,0 +1,469 @@
+"""
+Train many restricted Boltzmann machines with the same shape at once.
+
+The parameters of N models are stacked into tensors with a leading axis
+of length N (e.g., the weights are a tensor (N, num_visible, num_hidden)),
+so the Gibbs steps, gradients, and parameter updates of all of the models
+are computed with a few batched matrix products instead of N small ones.
+All of the models see the same minibatches, but each model has its own
+persistent chains, random stream, and optimizer hyperparameters
+(stepsize, momentum, and weight penalty), which makes the engine well
+suited to hyperparameter sweeps. Any member can be extracted as a Model.
+
+Example usage:
+'''
+rbms = [Model([BernoulliLayer(784), BernoulliLayer(200)]) for _ in range(8)]
+for rbm in rbms:
+    rbm.initialize(data)
+stack = StackedRBM(rbms)
+opt = StackedMomentum(stepsize=[0.001, 0.01] * 4, penalty=[0.0] * 4 + [1e-4] * 4)
+StackedPCD(stack, data, opt, epochs=10).train()
+best = stack.member(0)
+'''
+
+"""
+import time
+import numpy
+
+from .. import backends as be
+from .. import layers
+from ..optimizers import PowerLawDecay
+from . import gradient_util as gu
+from .model import Model, State
+
+# ----- MODEL ----- #
+
+class StackedRBM(object):
+    """
+    A stack of Bernoulli-Bernoulli restricted Boltzmann machines
+    with the same number of visible and hidden units.
+
+    """
+    def __init__(self, models, seeds=None):
+        """
+        Stack the parameters of some models.
+
+        Notes:
+            The parameters are copied, so later changes to the stack
+            do not change the models (see member).
+
+        Args:
+            models (List[Model]): models with the same layer sizes
+            seeds (List[int]; optional): a random seed for each model.
+                Defaults to independent child streams of the current
+                random stream.
+
+        Returns:
+            StackedRBM
+
+        """
+        if not all(self.supports(m) for m in models):
+            raise ValueError("StackedRBM needs Bernoulli-Bernoulli RBMs")
+        shapes = {(m.layers[0].len, m.layers[1].len) for m in models}
+        if len(shapes) != 1:
+            raise ValueError("The models must have the same layer sizes")
+        self.config = models[0].get_config()
+        self.num_models = len(models)
+        self.num_visible, self.num_hidden = shapes.pop()
+
+        self.vis_loc = be.stack([m.layers[0].params.loc for m in models], 0)
+        self.hid_loc = be.stack([m.layers[1].params.loc for m in models], 0)
+        self.matrix = be.stack([m.weights[0].params.matrix for m in models],
+                               0)
+
+        if seeds is None:
+            self.streams = be.spawn_streams(self.num_models)
+        else:
+            if len(seeds) != self.num_models:
+                raise ValueError("Need one seed per model")
+            self.streams = [be.RandomStream(s) for s in seeds]
+
+    @staticmethod
+    def supports(model):
+        """
+        Check if a model can be stacked.
+
+        Args:
+            model: a model object
+
+        Returns:
+            bool
+
+        """
+        return (isinstance(model, Model)
+                and model.num_layers == 2
+                and type(model.weights[0]) is layers.Weights
+                and all(isinstance(ly, layers.BernoulliLayer)
+                        for ly in model.layers)
+                and all(ly.precision == 'float32' for ly in model.layers))
+
+    def member(self, i):
+        """
+        Extract a model from the stack.
+
+        Args:
+            i (int): the index of the model
+
+        Returns:
+            Model: a new model with a copy of the parameters
+
+        """
+        model = Model.from_config(self.config)
+        model.layers[0].params = layers.ParamsBernoulli(
+            be.float_tensor(self.vis_loc[i]))
+        model.layers[1].params = layers.ParamsBernoulli(
+            be.float_tensor(self.hid_loc[i]))
+        model.weights[0].params = layers.ParamsWeights(
+            be.float_tensor(self.matrix[i]))
+        return model
+
+    def members(self):
+        """
+        Extract all of the models from the stack.
+
+        Args:
+            None
+
+        Returns:
+            List[Model]
+
+        """
+        return [self.member(i) for i in range(self.num_models)]
+
+    def _rand(self, num_samples, num_units):
+        """
+        Draw uniform random numbers from the stream of each model.
+
+        Args:
+            num_samples (int): the number of samples per model
+            num_units (int): the number of units per sample
+
+        Returns:
+            tensor (num_models, num_samples, num_units)
+
+        """
+        r = be.zeros((self.num_models, num_samples, num_units))
+        for i, stream in enumerate(self.streams):
+            stream.rand((num_samples, num_units), out=r[i])
+        return r
+
+    def hidden_mean(self, vis):
+        """
+        Compute the mean of the hidden units conditioned on
+        the visible units.
+
+        Args:
+            vis (tensor (num_models, num_samples, num_visible) or
+                tensor (num_samples, num_visible) shared by the models)
+
+        Returns:
+            tensor (num_models, num_samples, num_hidden)
+
+        """
+        return be.expit(be.batch_matmul(vis, self.matrix)
+                        + be.unsqueeze(self.hid_loc, 1))
+
+    def visible_mean(self, hid):
+        """
+        Compute the mean of the visible units conditioned on
+        the hidden units.
+
+        Args:
+            hid (tensor (num_models, num_samples, num_hidden))
+
+        Returns:
+            tensor (num_models, num_samples, num_visible)
+
+        """
+        return be.expit(be.batch_matmul(hid, be.batch_transpose(self.matrix))
+                        + be.unsqueeze(self.vis_loc, 1))
+
+    def _sample(self, p):
+        """
+        Draw Bernoulli samples with the given means.
+
+        Args:
+            p (tensor (num_models, num_samples, num_units))
+
+        Returns:
+            tensor (num_models, num_samples, num_units)
+
+        """
+        shape = be.shape(p)
+        return be.float_tensor(self._rand(shape[1], shape[2]) < p)
+
+    def random_state(self, num_chains):
+        """
+        Draw random configurations for the chains of each model
+        from the visible biases.
+
+        Args:
+            num_chains (int): the number of chains per model
+
+        Returns:
+            State: units of shape (num_models, num_chains, num_units)
+
+        """
+        vis = self._sample(be.expit(be.unsqueeze(self.vis_loc, 1))
+                           + be.zeros((self.num_models, num_chains,
+                                       self.num_visible)))
+        return State([vis, self._sample(self.hidden_mean(vis))])
+
+    def markov_chain(self, n, state):
+        """
+        Perform multiple Gibbs sampling steps on the chains of every model.
+
+        Args:
+            n (int): number of steps
+            state (State): units of shape (num_models, num_chains, num_units)
+
+        Returns:
+            State
+
+        """
+        vis, hid = state.units
+        for _ in range(n):
+            hid = self._sample(self.hidden_mean(vis))
+            vis = self._sample(self.visible_mean(hid))
+        return State([vis, hid])
+
+    def gradient(self, vdata, model_state):
+        """
+        Compute the gradient of the parameters of every model.
+
+        Notes:
+            As in Model.gradient, the gradient is the mean statistics
+            of the chains minus the mean statistics of the data,
+            with the hidden units replaced by their conditional means.
+            The weight penalties are added by the optimizer.
+
+        Args:
+            vdata (tensor (num_samples, num_visible)): the observed visible
+                units, shared by all of the models
+            model_state (State): the chains of the models
+
+        Returns:
+            Gradient: the layer and weight parameters of the gradient
+                have a leading axis of length num_models
+
+        """
+        vis_model = model_state.units[0]
+        hid_data = self.hidden_mean(vdata)
+        hid_model = self.hidden_mean(vis_model)
+        num_data = be.shape(vdata)[0]
+        num_model = be.shape(vis_model)[1]
+
+        vis_grad = be.mean(vis_model, axis=1) \
+                   - be.unsqueeze(be.mean(vdata, axis=0), 0)
+        hid_grad = be.mean(hid_model, axis=1) - be.mean(hid_data, axis=1)
+        matrix_grad = \
+            be.batch_matmul(be.batch_transpose(vis_model),
+                            hid_model) / num_model \
+            - be.batch_matmul(be.transpose(vdata), hid_data) / num_data
+        return gu.Gradient(
+            [layers.ParamsBernoulli(vis_grad),
+             layers.ParamsBernoulli(hid_grad)],
+            [layers.ParamsWeights(matrix_grad)]
+        )
+
+    def parameter_update(self, deltas):
+        """
+        Update the parameters of every model.
+
+        params -= deltas
+
+        Notes:
+            Modifies the parameters in place.
+
+        Args:
+            deltas (Gradient): with the same layout as the gradient
+
+        Returns:
+            None
+
+        """
+        self.vis_loc -= deltas.layers[0].loc
+        self.hid_loc -= deltas.layers[1].loc
+        self.matrix -= deltas.weights[0].matrix
+
+
+# ----- OPTIMIZER ----- #
+
+def _per_model(values, num_models):
+    """
+    Convert a hyperparameter to a vector with a value for each model.
+
+    Args:
+        values (float or List[float])
+        num_models (int)
+
+    Returns:
+        numpy array (num_models,)
+
+    """
+    values = numpy.asarray(values, dtype=numpy.float32)
+    if values.ndim == 0:
+        return numpy.full(num_models, values, dtype=numpy.float32)
+    if len(values) != num_models:
+        raise ValueError("Need one hyperparameter value per model")
+    return values
+
+def _broadcast(values, tensor):
+    """
+    Reshape a vector with a value for each model so that it
+    broadcasts against a stacked parameter tensor.
+
+    Args:
+        values (numpy array (num_models,))
+        tensor (tensor (num_models, ...))
+
+    Returns:
+        tensor (num_models, 1, ...)
+
+    """
+    shape = (len(values),) + (1,) * (be.ndim(tensor) - 1)
+    return be.float_tensor(values.reshape(shape))
+
+
+class StackedMomentum(object):
+    """
+    Stochastic gradient descent with momentum and an L2 penalty on the
+    weights, with different hyperparameters for each model of a stack.
+
+    The update of model k mirrors optimizers.Momentum:
+        mean_k <- momentum_k * mean_k + (1 - momentum_k) * grad_k
+        params_k <- params_k - lr * stepsize_k * mean_k
+    where grad_k includes penalty_k * W_k for the weights.
+
+    """
+    def __init__(self, stepsize=0.001, momentum=0.0, penalty=0.0,
+                 scheduler=None):
+        """
+        Create a stacked momentum optimizer.
+
+        Args:
+            stepsize (float or List[float]; optional): the initial stepsizes
+            momentum (float or List[float]; optional): the amounts of momentum
+            penalty (float or List[float]; optional): the L2 penalties
+                on the weights
+            scheduler (a learning rate scheduler object; optional):
+                shared by all of the models. Defaults to PowerLawDecay().
+
+        Returns:
+            StackedMomentum
+
+        """
+        self.stepsize = stepsize
+        self.momentum = momentum
+        self.penalty = penalty
+        self.scheduler = scheduler if scheduler is not None \
+                         else PowerLawDecay()
+        self.mean_gradient = None
+
+    def update(self, stack, grad, epoch):
+        """
+        Update the parameters of the models with a gradient step.
+
+        Notes:
+            Changes the parameters of the stack in place.
+
+        Args:
+            stack (StackedRBM)
+            grad (Gradient): from stack.gradient
+            epoch (int): the current epoch
+
+        Returns:
+            None
+
+        """
+        self.scheduler.increment(epoch)
+        n = stack.num_models
+        stepsize = _per_model(self.stepsize, n) * self.scheduler.get_lr()
+        momentum = _per_model(self.momentum, n)
+        penalty = _per_model(self.penalty, n)
+
+        matrix = grad.weights[0].matrix
+        matrix += _broadcast(penalty, matrix) * stack.matrix
+
+        if self.mean_gradient is None:
+            self.mean_gradient = gu.grad_apply(be.float_tensor, grad)
+        else:
+            def mix(mean, g):
+                w = _broadcast(momentum, mean)
+                return w * mean + (1 - w) * g
+            self.mean_gradient = gu.grad_mapzip(mix, self.mean_gradient, grad)
+
+        def step(mean):
+            return _broadcast(stepsize, mean) * mean
+        stack.parameter_update(gu.grad_apply(step, self.mean_gradient))
+
+
+# ----- TRAINING ----- #
+
+class StackedPCD(object):
+    """
+    Train a stack of models with persistent contrastive divergence.
+
+    """
+    def __init__(self, stack, batch, optimizer, epochs, num_chains=None,
+                 mcsteps=1):
+        """
+        Create a trainer.
+
+        Args:
+            stack (StackedRBM)
+            batch: a batch object that serves the minibatches
+                (shared by all of the models)
+            optimizer (StackedMomentum)
+            epochs (int): the number of epochs
+            num_chains (int; optional): the number of persistent chains
+                per model. Defaults to the size of the first minibatch.
+            mcsteps (int; optional): the number of Gibbs steps per update
+
+        Returns:
+            StackedPCD
+
+        """
+        self.stack = stack
+        self.batch = batch
+        self.optimizer = optimizer
+        self.epochs = epochs
+        self.num_chains = num_chains
+        self.mcsteps = mcsteps
+        self.neg_state = None
+
+    def train(self):
+        """
+        Train the models.
+
+        Notes:
+            Updates the parameters of the stack in place.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        for epoch in range(self.epochs):
+            start_time = time.time()
+            while True:
+                try:
+                    v_data = self.batch.get(mode='train')
+                except StopIteration:
+                    break
+                if self.neg_state is None:
+                    num_chains = self.num_chains or be.shape(v_data)[0]
+                    self.neg_state = self.stack.random_state(num_chains)
+                self.neg_state = self.stack.markov_chain(self.mcsteps,
+                                                         self.neg_state)
+                self.optimizer.update(self.stack,
+                                      self.stack.gradient(v_data,
+                                                          self.neg_state),
+                                      epoch)
+
+            end_time = time.time()
+            print('End of epoch {}: '.format(epoch))
+            print('Epoch took {0:.2f} seconds'.format(end_time - start_time),
+                  end='\n\n')
@@ -0,0 +1,582 @@
+"""
+Process pools for running Monte Carlo chains in parallel.
+
+The parameters of a model are published to shared memory so that
+worker processes always sample from the current parameters without
+pickling the model for every task. Particle states can also be stored
+in shared memory, so that workers advance disjoint slices of the
+chains and write the results directly into a shared output State.
+
+Requires the python backend, and Python 3.8 or later for the shared
+memory (the module itself can be imported on older versions).
+
+"""
+import atexit
+import multiprocessing
+import numpy
+
+from . import backends as be
+from .models.model import State
+from .models import fused_gibbs
+
+# ----- SHARED MEMORY ----- #
+
+class SharedArray(object):
+    """A numpy array stored in shared memory."""
+
+    def __init__(self, shape, dtype=numpy.float32, name=None):
+        """
+        Create (or attach to) a shared memory array.
+
+        Args:
+            shape (tuple): shape of the array
+            dtype (optional): numpy dtype of the array
+            name (str; optional): the name of an existing shared memory
+                block. If None, a new block is created.
+
+        Returns:
+            SharedArray
+
+        """
+        # imported here so that importing paysage does not require it
+        from multiprocessing import shared_memory
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = numpy.dtype(dtype)
+        self.owner = name is None
+        nbytes = max(1, int(numpy.prod(self.shape)) * self.dtype.itemsize)
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.array = numpy.ndarray(self.shape, dtype=self.dtype,
+                                   buffer=self.shm.buf)
+
+    def descriptor(self):
+        """
+        Get a picklable description of the array.
+
+        Args:
+            None
+
+        Returns:
+            tuple (name, shape, dtype)
+
+        """
+        return (self.name, self.shape, self.dtype.str)
+
+    @classmethod
+    def from_descriptor(cls, descriptor):
+        """
+        Attach to an existing shared array.
+
+        Args:
+            descriptor (tuple): from SharedArray.descriptor()
+
+        Returns:
+            SharedArray
+
+        """
+        name, shape, dtype = descriptor
+        return cls(shape, dtype=dtype, name=name)
+
+    def close(self):
+        """
+        Release the shared memory.
+        The block is destroyed if this object created it.
+
+        Notes:
+            Performs an IO operation.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # views of the array are still alive, the memory is
+            # released when they are garbage collected
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedState(object):
+    """A State whose tensors are stored in shared memory."""
+
+    def __init__(self, shapes, dtypes=None):
+        """
+        Allocate shared memory for a State.
+
+        Args:
+            shapes (List[tuple]): the shape of each layer of the State
+            dtypes (List; optional): the dtype of each layer of the State
+                (e.g., the precisions of the layers). Defaults to float32.
+
+        Returns:
+            SharedState
+
+        """
+        self.shapes = [tuple(s) for s in shapes]
+        if dtypes is None:
+            dtypes = [numpy.float32 for _ in self.shapes]
+        self.dtypes = [numpy.dtype(d) for d in dtypes]
+        self.arrays = [SharedArray(s, d)
+                       for s, d in zip(self.shapes, self.dtypes)]
+
+    def state(self):
+        """
+        Get a State object that views the shared memory.
+
+        Args:
+            None
+
+        Returns:
+            State
+
+        """
+        return State([a.array for a in self.arrays])
+
+    def descriptor(self):
+        """
+        Get a picklable description of the shared State.
+
+        Args:
+            None
+
+        Returns:
+            List[tuple]
+
+        """
+        return [a.descriptor() for a in self.arrays]
+
+    def close(self):
+        """
+        Release the shared memory.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        for a in self.arrays:
+            a.close()
+
+
+# ----- WORKER PROCESSES ----- #
+
+# the attributes of a model (not in its config) that choose
+# how its chains are sampled
+SAMPLER_SETTINGS = ['use_fused_sampler', 'hidden_block_size',
+                    'max_flip_fraction', 'max_tile_rows', 'layer_threads']
+
+def sampler_settings(model):
+    """
+    Get the sampler settings of a model.
+
+    Args:
+        model: a model object
+
+    Returns:
+        dict: {attribute name: value} for the SAMPLER_SETTINGS of the model
+
+    """
+    return {name: getattr(model, name) for name in SAMPLER_SETTINGS
+            if hasattr(model, name)}
+
+# each worker process holds its own copy of the model
+# whose parameters are views of the shared memory
+_worker_model = None
+_worker_arrays = {}
+
+def _apply_settings(settings):
+    """
+    Set the sampler settings of the worker model.
+
+    Notes:
+        Modifies the _worker_model global.
+
+    Args:
+        settings (dict): from sampler_settings
+
+    Returns:
+        None
+
+    """
+    if settings.get('layer_threads') != \
+        getattr(_worker_model, 'layer_threads', None):
+        # the thread pool is started again with the new size
+        _worker_model.close()
+    for name, value in settings.items():
+        setattr(_worker_model, name, value)
+
+def _attach(descriptor):
+    """
+    Attach to a shared array from a worker process, caching the result.
+
+    Args:
+        descriptor (tuple): from SharedArray.descriptor()
+
+    Returns:
+        numpy array
+
+    """
+    name = descriptor[0]
+    if name not in _worker_arrays:
+        _worker_arrays[name] = SharedArray.from_descriptor(descriptor)
+    return _worker_arrays[name].array
+
+def _evict(live):
+    """
+    Detach from cached shared arrays that are no longer in use
+    (e.g., buffers that the pool has reallocated and destroyed).
+
+    Notes:
+        Modifies the _worker_arrays global.
+
+    Args:
+        live (set): the names of the shared arrays that are in use
+
+    Returns:
+        None
+
+    """
+    for name in [n for n in _worker_arrays if n not in live]:
+        _worker_arrays.pop(name).close()
+
+def _init_worker(model_class, config, settings, layer_params,
+                 weight_params):
+    """
+    Build the model in a worker process.
+
+    Notes:
+        Sets the _worker_model global.
+
+    Args:
+        model_class (type): the class of the model
+        config (dict): the model configuration
+        settings (dict): the sampler settings of the model
+        layer_params (List[List[tuple]]): shared parameters of the layers
+        weight_params (List[List[tuple]]): shared parameters of the weights
+
+    Returns:
+        None
+
+    """
+    global _worker_model
+    # the workers already run in parallel
+    fused_gibbs.use_threads = False
+    _worker_model = model_class.from_config(config)
+    _apply_settings(settings)
+    for ly, descriptors in zip(_worker_model.layers, layer_params):
+        ly.params = ly.params.__class__(*[_attach(d) for d in descriptors])
+    for w, descriptors in zip(_worker_model.weights, weight_params):
+        w.params = w.params.__class__(*[_attach(d) for d in descriptors])
+
+def _run_task(task):
+    """
+    Run a function on the worker model.
+
+    Args:
+        task (tuple): (func, stream, live, settings, args) where stream
+            is the random stream of the task, live is the set of names of
+            the shared arrays currently owned by the pool, and settings
+            are the current sampler settings of the model
+
+    Returns:
+        the result of func(model, *args)
+
+    """
+    func, stream, live, settings, args = task
+    _evict(live)
+    _apply_settings(settings)
+    be.set_stream(stream)
+    return func(_worker_model, *args)
+
+def advance_chains(model, updater, steps, source, target, start, stop, beta):
+    """
+    Advance a slice of a shared State and write it into another shared State.
+
+    Args:
+        model: a model object
+        updater (str): the name of the Model sampling method
+            (e.g., 'markov_chain')
+        steps (int): the number of Monte Carlo steps
+        source (List[tuple]): descriptor of the input SharedState
+        target (List[tuple]): descriptor of the output SharedState
+        start (int): the first row of the slice
+        stop (int): the end of the slice
+        beta (tensor (stop - start, 1); optional): inverse temperatures
+
+    Returns:
+        None
+
+    """
+    # the units keep the precisions of the layers
+    state = State([_attach(d)[start:stop] for d in source])
+    new_state = getattr(model, updater)(steps, state, beta)
+    for d, u in zip(target, new_state.units):
+        _attach(d)[start:stop] = be.to_numpy_array(u)
+
+
+# ----- POOLS ----- #
+
+class ModelPool(object):
+    """
+    A pool of worker processes that sample from a shared model.
+
+    Example usage:
+    '''
+    pool = ModelPool(rbm, num_workers=4)
+    new_state = pool.advance('markov_chain', 10, state)
+    pool.close()
+    '''
+
+    """
+    def __init__(self, model, num_workers=None, start_method=None):
+        """
+        Create a pool of workers.
+
+        Notes:
+            The parameters of the model are copied to shared memory,
+            and republished before every batch of tasks.
+
+        Args:
+            model: a model object
+            num_workers (int; optional): the number of processes
+                (defaults to the number of cpus)
+            start_method (str; optional): multiprocessing start method.
+                Defaults to the platform default, or to forkserver (spawn)
+                if the threaded fused Gibbs kernel has already run in
+                this process, because forking a process with a running
+                numba thread pool can deadlock. These start methods
+                re-import the main module, so scripts need an
+                `if __name__ == "__main__":` guard.
+
+        Returns:
+            ModelPool
+
+        """
+        if be.config['backend'] != 'python':
+            raise NotImplementedError(
+                "Process pools are only supported by the python backend")
+        self.model = model
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+
+        self.layer_params = [[SharedArray(be.shape(p)) for p in ly.params]
+                             for ly in model.layers]
+        self.weight_params = [[SharedArray(be.shape(p)) for p in w.params]
+                              for w in model.weights]
+        self.publish()
+
+        self.buffers = None
+        self.current = 0
+
+        if start_method is None and fused_gibbs.threads_started:
+            methods = multiprocessing.get_all_start_methods()
+            start_method = 'forkserver' if 'forkserver' in methods \
+                           else 'spawn'
+        context = multiprocessing.get_context(start_method)
+        self.pool = context.Pool(
+            self.num_workers,
+            initializer=_init_worker,
+            initargs=(model.__class__,
+                      model.get_config(),
+                      sampler_settings(model),
+                      [[a.descriptor() for a in p] for p in self.layer_params],
+                      [[a.descriptor() for a in p] for p in self.weight_params])
+        )
+        atexit.register(self.close)
+
+    def publish(self):
+        """
+        Copy the current parameters of the model into shared memory.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        for ly, shared in zip(self.model.layers, self.layer_params):
+            for p, a in zip(ly.params, shared):
+                a.array[...] = be.to_numpy_array(p)
+        for w, shared in zip(self.model.weights, self.weight_params):
+            for p, a in zip(w.params, shared):
+                a.array[...] = be.to_numpy_array(p)
+
+    def _live_names(self):
+        """
+        Get the names of the shared arrays that the pool currently owns.
+
+        Args:
+            None
+
+        Returns:
+            set
+
+        """
+        arrays = [a for p in self.layer_params + self.weight_params for a in p]
+        if self.buffers is not None:
+            arrays += [a for b in self.buffers for a in b.arrays]
+        return set(a.name for a in arrays)
+
+    def map(self, func, args_list):
+        """
+        Apply a function to the shared model in the worker processes.
+
+        Notes:
+            Publishes the parameters and the sampler settings
+            of the model first, so the workers sample the same way
+            as the model does in this process.
+            Each task draws from its own child of the random stream of
+            the main process, so the results do not depend on which
+            worker runs which task.
+
+        Args:
+            func (callable): a module level function func(model, *args)
+            args_list (List[tuple]): the arguments for each task
+
+        Returns:
+            list: the results of the tasks
+
+        """
+        self.publish()
+        streams = be.spawn_streams(len(args_list))
+        live = self._live_names()
+        settings = sampler_settings(self.model)
+        tasks = [(func, s, live, settings, args)
+                 for s, args in zip(streams, args_list)]
+        return self.pool.map(_run_task, tasks)
+
+    def _partition(self, num_samples):
+        """
+        Split the rows of a State into one contiguous slice per worker.
+
+        Args:
+            num_samples (int): the number of rows
+
+        Returns:
+            List[(int, int)]
+
+        """
+        edges = numpy.linspace(0, num_samples, self.num_workers + 1)
+        edges = [int(round(e)) for e in edges]
+        return [(edges[i], edges[i+1]) for i in range(self.num_workers)
+                if edges[i+1] > edges[i]]
+
+    def _match_buffers(self, state):
+        """
+        Make sure that the shared buffers have the shape of the state,
+        and the precisions of the layers of the model.
+
+        Notes:
+            Modifies the buffers attribute in place.
+
+        Args:
+            state (State)
+
+        Returns:
+            None
+
+        """
+        shapes = [tuple(be.shape(u)) for u in state.units]
+        dtypes = [numpy.dtype(ly.precision) for ly in self.model.layers]
+        if (self.buffers is None or self.buffers[0].shapes != shapes
+            or self.buffers[0].dtypes != dtypes):
+            self._close_buffers()
+            self.buffers = [SharedState(shapes, dtypes),
+                            SharedState(shapes, dtypes)]
+            self.current = 0
+
+    def advance(self, updater, steps, state, beta=None):
+        """
+        Advance the chains in parallel.
+        Each worker updates a contiguous slice of the particles.
+
+        Notes:
+            The returned State is a view of shared memory that is
+            double buffered: it is overwritten by the second call to
+            advance after this one.
+
+        Args:
+            updater (str): the name of the Model sampling method
+                (e.g., 'markov_chain')
+            steps (int): the number of Monte Carlo steps
+            state (State): the current state of each layer
+            beta (tensor (num_samples, 1); optional): inverse temperatures
+
+        Returns:
+            new state
+
+        """
+        self._match_buffers(state)
+        source = self.buffers[self.current]
+        target = self.buffers[1 - self.current]
+
+        source_units = source.state().units
+        if not all(u is s for u, s in zip(state.units, source_units)):
+            for s, u in zip(source_units, state.units):
+                s[...] = be.to_numpy_array(u)
+
+        args_list = []
+        for start, stop in self._partition(be.shape(state.units[0])[0]):
+            b = None if beta is None else be.to_numpy_array(beta)[start:stop]
+            args_list.append((updater, steps, source.descriptor(),
+                              target.descriptor(), start, stop, b))
+        self.map(advance_chains, args_list)
+
+        self.current = 1 - self.current
+        return target.state()
+
+    def _close_buffers(self):
+        """
+        Release the shared State buffers.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.buffers is not None:
+            for b in self.buffers:
+                b.close()
+            self.buffers = None
+
+    def close(self):
+        """
+        Shut down the worker processes and release the shared memory.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+        self._close_buffers()
+        for shared in self.layer_params + self.weight_params:
+            for a in shared:
+                a.close()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,608 @@
+"""
+Estimators of the partition function of a model.
+
+The log-likelihood of an observation is log p(v) = -F(v) - log Z,
+where F(v) is the marginal free energy and Z is the partition function.
+Z is intractable for most models and is estimated by annealed importance
+sampling (AIS) from the independent layers at beta = 0 to the model at
+beta = 1. For small Bernoulli hidden layers, Z and the likelihood gradient
+can be computed exactly by enumerating the hidden states.
+
+Neal, Radford M. "Annealed importance sampling."
+Statistics and Computing 11.2 (2001): 125-139.
+
+Salakhutdinov, Ruslan, and Iain Murray.
+"On the quantitative analysis of deep belief networks."
+Proceedings of the 25th International Conference on Machine Learning.
+ACM, 2008.
+
+"""
+import math
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+
+from . import backends as be
+from . import layers
+from . import parallel
+from .models.model import State
+from .models import gradient_util as gu
+
+# ----- SCHEDULES ----- #
+
+def linear_schedule(num_steps):
+    """
+    Inverse temperatures spaced evenly from 0 to 1.
+
+    Args:
+        num_steps (int): the number of annealing steps
+
+    Returns:
+        numpy array (num_steps + 1,)
+
+    """
+    return numpy.linspace(0, 1, num_steps + 1)
+
+def sigmoid_schedule(num_steps, radius=4):
+    """
+    Inverse temperatures from 0 to 1 that are spaced more
+    closely near both ends of the schedule.
+
+    Args:
+        num_steps (int): the number of annealing steps
+        radius (float > 0): larger values concentrate more steps at the ends
+
+    Returns:
+        numpy array (num_steps + 1,)
+
+    """
+    s = 1 / (1 + numpy.exp(-numpy.linspace(-radius, radius, num_steps + 1)))
+    return (s - s[0]) / (s[-1] - s[0])
+
+# ----- LOG-LIKELIHOOD ----- #
+
+def average_log_likelihood(model, batch, log_Z, mode='validate'):
+    """
+    Compute the average log-likelihood of the samples in a Batch,
+    log p(v) = -F(v) - log Z.
+
+    Args:
+        model: a model object
+        batch: a batch object
+        log_Z (float): the log partition function of the model
+        mode (str): the part of the batch to use ('train' or 'validate')
+
+    Returns:
+        float
+
+    """
+    total = 0
+    num_samples = 0
+    while True:
+        try:
+            v_data = batch.get(mode=mode)
+        except StopIteration:
+            break
+        free_energy = model.marginal_free_energy(
+                          State.from_visible(v_data, model))
+        total -= float(be.tsum(free_energy))
+        num_samples += be.shape(v_data)[0]
+    return total / num_samples - log_Z
+
+# ----- ANNEALED IMPORTANCE SAMPLING ----- #
+
+def base_log_partition_function(model):
+    """
+    Compute the log partition function of a model at beta = 0,
+    where the layers are independent.
+
+    Args:
+        model: a model object
+
+    Returns:
+        float
+
+    """
+    log_Z = 0
+    for ly in model.layers:
+        log_Z += be.tsum(ly.log_partition_function(be.zeros((1, ly.len))))
+    return float(log_Z)
+
+def ais_log_weights(model, schedule, num_chains):
+    """
+    Anneal a batch of chains from beta = 0 to beta = 1 and compute
+    their log importance weights.
+
+    log w = sum_k [ F_{beta_(k-1)}(v_k) - F_{beta_k}(v_k) ]
+    where v_k is sampled by a Gibbs step at beta_(k-1) from v_(k-1).
+
+    Notes:
+        The chains are updated in place, one step per inverse temperature.
+
+    Args:
+        model: a model object
+        schedule (array (num_steps + 1,)): increasing inverse temperatures
+            from 0 to 1
+        num_chains (int): the number of chains
+
+    Returns:
+        numpy array (num_chains,): log importance weights
+
+    """
+    ones = be.ones((num_chains, 1))
+    beta = 0 * ones
+    # at beta = 0 a single step samples the layers exactly
+    state = model.markov_chain(1, State.from_model(num_chains, model), beta)
+    log_weights = be.zeros((num_chains,))
+    for k in range(1, len(schedule)):
+        log_weights += model.marginal_free_energy(state, beta)
+        beta = float(schedule[k]) * ones
+        log_weights -= model.marginal_free_energy(state, beta)
+        if k < len(schedule) - 1:
+            model.markov_chain(1, state, beta, out=state)
+    return be.to_numpy_array(log_weights)
+
+
+class AIS(object):
+    """
+    Annealed importance sampling estimator of the log partition function.
+
+    Example usage:
+    '''
+    ais = AIS(rbm, num_chains=1000, schedule=linear_schedule(10000))
+    log_Z, log_Z_std = ais.run()
+    test_log_likelihood = ais.log_likelihood(batch)
+    '''
+
+    """
+    def __init__(self, model, num_chains=100, schedule=None, num_workers=0):
+        """
+        Create an AIS estimator.
+
+        Notes:
+            The base distribution at beta = 0 is normalized with the
+            log_partition_function of each layer.
+
+        Args:
+            model: a model object
+            num_chains (int): the number of annealing chains
+            schedule (array; optional): increasing inverse temperatures
+                from 0 to 1 (defaults to linear_schedule(1000))
+            num_workers (int; optional): if positive, the chains are
+                split across a pool of worker processes
+
+        Returns:
+            AIS
+
+        """
+        self.model = model
+        self.num_chains = num_chains
+        self.schedule = linear_schedule(1000) if schedule is None \
+                        else numpy.asarray(schedule, dtype=numpy.float64)
+        assert self.schedule[0] == 0 and self.schedule[-1] == 1, \
+        "The schedule must go from beta = 0 to beta = 1"
+        self.num_workers = num_workers
+        self.pool = None
+
+        self.log_weights = None
+        self.log_Z = None
+        self.log_Z_std = None
+
+    def _log_weights(self):
+        """
+        Run the annealing chains, in worker processes if there are any.
+
+        Args:
+            None
+
+        Returns:
+            numpy array (num_chains,)
+
+        """
+        if not self.num_workers:
+            return ais_log_weights(self.model, self.schedule, self.num_chains)
+        if self.pool is None:
+            self.pool = parallel.ModelPool(self.model, self.num_workers)
+        args_list = [(self.schedule, stop - start) for start, stop
+                     in self.pool._partition(self.num_chains)]
+        return numpy.concatenate(self.pool.map(ais_log_weights, args_list))
+
+    def run(self):
+        """
+        Estimate the log partition function of the current model.
+
+        Notes:
+            Sets the log_weights, log_Z, and log_Z_std attributes.
+            The error bar is the standard deviation of the log of the
+            mean importance weight from the delta method:
+            std(w) / (sqrt(num_chains) * mean(w)).
+
+        Args:
+            None
+
+        Returns:
+            log_Z (float), log_Z_std (float)
+
+        """
+        self.log_weights = self._log_weights().astype(numpy.float64)
+        shift = numpy.max(self.log_weights)
+        w = numpy.exp(self.log_weights - shift)
+        mean_w = numpy.mean(w)
+        self.log_Z = (base_log_partition_function(self.model)
+                      + float(shift) + math.log(mean_w))
+        self.log_Z_std = float(numpy.std(w)
+                               / (math.sqrt(len(w)) * mean_w))
+        return self.log_Z, self.log_Z_std
+
+    def log_likelihood(self, batch, mode='validate'):
+        """
+        Compute the average log-likelihood of the samples in a Batch.
+
+        Notes:
+            Calls run() first if log_Z has not been estimated yet.
+
+        Args:
+            batch: a batch object
+            mode (str): the part of the batch to use ('train' or 'validate')
+
+        Returns:
+            float
+
+        """
+        if self.log_Z is None:
+            self.run()
+        return average_log_likelihood(self.model, batch, self.log_Z, mode)
+
+    def close(self):
+        """
+        Shut down the process pool, if there is one.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ----- EXACT ENUMERATION ----- #
+
+def _gray_code(k):
+    """
+    Get the k-th element of the binary reflected Gray code.
+
+    Args:
+        k (int)
+
+    Returns:
+        int
+
+    """
+    return k ^ (k >> 1)
+
+def _bits(k, num_bits):
+    """
+    Get the binary digits of an integer, least significant first.
+
+    Args:
+        k (int or array): the integers
+        num_bits (int): the number of digits
+
+    Returns:
+        numpy array (..., num_bits)
+
+    """
+    k = numpy.asarray(k)[..., None]
+    return ((k >> numpy.arange(num_bits)) & 1).astype(numpy.float64)
+
+
+class ExactPartition(object):
+    """
+    Exact log partition function and likelihood gradient of an RBM
+    with a small Bernoulli hidden layer.
+
+    The visible layer is summed out analytically,
+    log Z = log sum_h exp(b.h + sum_i log Z_i((W h)_i))
+    where log Z_i is the log_partition_function of the visible layer.
+    The 2^num_hidden hidden states are enumerated in blocks: the lowest
+    block_bits hidden units take all of their values at once in a
+    (2^block_bits, num_visible) tensor, and the remaining units step
+    through a Gray code so that the field of the next block differs
+    from the last one by a single column of the weights. Memory is bounded
+    by the block size and the blocks are divided over a thread pool
+    (started on first use and kept until close()).
+
+    Requires the python backend.
+
+    """
+    max_hidden = 25
+
+    def __init__(self, model, block_bits=10, num_threads=1):
+        """
+        Create an exact enumeration engine.
+
+        Args:
+            model: a model object
+            block_bits (int): the hidden states are enumerated in blocks
+                of 2^block_bits states
+            num_threads (int): the number of threads that process blocks
+
+        Returns:
+            ExactPartition
+
+        """
+        if not self.supports(model):
+            raise ValueError(
+                "Exact enumeration requires the python backend and a model "
+                "with at most {} Bernoulli hidden units"
+                .format(self.max_hidden))
+        self.model = model
+        self.block_bits = min(block_bits, model.layers[1].len)
+        self.num_threads = num_threads
+        # the states of the lowest hidden units, shared by all blocks
+        self.h_low = _bits(numpy.arange(2 ** self.block_bits),
+                           self.block_bits)
+        self.executor = None
+
+    @staticmethod
+    def supports(model):
+        """
+        Check if the engine can enumerate the states of a model.
+
+        Args:
+            model: a model object
+
+        Returns:
+            bool
+
+        """
+        return (be.config['backend'] == 'python'
+                and model.num_layers == 2
+                and type(model.weights[0]) is layers.Weights
+                and type(model.layers[1]) is layers.BernoulliLayer
+                and model.layers[1].len <= ExactPartition.max_hidden)
+
+    def _setup(self):
+        """
+        Get the parameters of the current model, and the field and
+        log weights of the lowest hidden units, shared by all blocks.
+
+        Args:
+            None
+
+        Returns:
+            dict
+
+        """
+        num_low = self.block_bits
+        W = be.to_numpy_array(self.model.weights[0].W()).astype(numpy.float64)
+        b = be.to_numpy_array(self.model.layers[1].params.loc) \
+              .astype(numpy.float64)
+        return {
+            'phi_low': numpy.dot(self.h_low, W[:, :num_low].T),
+            'log_w_low': numpy.dot(self.h_low, b[:num_low]),
+            'W_high': W[:, num_low:],
+            'b_high': b[num_low:]
+        }
+
+    def _run_blocks(self, start, stop, moments, setup):
+        """
+        Enumerate the hidden states of the blocks in [start, stop).
+
+        Args:
+            start (int): the first block
+            stop (int): the end of the blocks
+            moments (bool): whether to accumulate the moments
+                needed for the gradient
+            setup (dict): the result of _setup()
+
+        Returns:
+            shift (float): the log weights are relative to this value
+            total (float): the sum of the relative weights
+            sums (dict): the weighted sums of the units
+
+        """
+        vis = self.model.layers[0]
+        h_low = self.h_low
+        phi_low = setup['phi_low']
+        log_w_low = setup['log_w_low']
+        W_high = setup['W_high']
+        b_high = setup['b_high']
+
+        h_high = _bits(_gray_code(start), len(b_high))
+        phi_high = numpy.dot(W_high, h_high)
+        log_w_high = numpy.dot(b_high, h_high)
+
+        shift = -numpy.inf
+        total = 0
+        sums = {}
+        if moments:
+            sums = {'vis': 0, 'hid_low': 0, 'hid_high': 0,
+                    'vh_low': 0, 'vh_high': 0}
+
+        for k in range(start, stop):
+            if k > start:
+                # gray(k) differs from gray(k-1) in the lowest set bit of k
+                j = (k & -k).bit_length() - 1
+                step = 1 - 2 * h_high[j]
+                h_high[j] += step
+                phi_high += step * W_high[:, j]
+                log_w_high += step * b_high[j]
+
+            field = phi_low + phi_high
+            log_w = log_w_low + log_w_high + \
+                    numpy.sum(vis.log_partition_function(field), axis=1)
+
+            m = numpy.max(log_w)
+            if m > shift:
+                scale = math.exp(shift - m)
+                total *= scale
+                for key in sums:
+                    sums[key] = sums[key] * scale
+                shift = m
+            w = numpy.exp(log_w - shift)
+            w_total = numpy.sum(w)
+            total += w_total
+
+            if moments:
+                # the conditional mean of a Bernoulli visible layer
+                mean_v = be.expit(field + vis.params.loc)
+                w_v = numpy.dot(w, mean_v)
+                sums['vis'] += w_v
+                sums['hid_low'] += numpy.dot(w, h_low)
+                sums['hid_high'] += w_total * h_high
+                sums['vh_low'] += numpy.dot(mean_v.T, w[:, None] * h_low)
+                sums['vh_high'] += numpy.outer(w_v, h_high)
+
+        return shift, total, sums
+
+    def _enumerate(self, moments=False):
+        """
+        Enumerate all of the hidden states.
+
+        Args:
+            moments (bool): whether to compute the moments of the units
+
+        Returns:
+            log_Z (float), moments (dict or None)
+
+        """
+        num_blocks = 2 ** (self.model.layers[1].len - self.block_bits)
+        edges = numpy.linspace(0, num_blocks,
+                               min(self.num_threads, num_blocks) + 1)
+        edges = [int(round(e)) for e in edges]
+        ranges = [(edges[i], edges[i+1]) for i in range(len(edges) - 1)]
+
+        setup = self._setup()
+        if len(ranges) == 1:
+            results = [self._run_blocks(*ranges[0], moments, setup)]
+        else:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.num_threads)
+            results = list(self.executor.map(
+                lambda r: self._run_blocks(r[0], r[1], moments, setup),
+                ranges))
+
+        shift = max(r[0] for r in results)
+        scales = [math.exp(r[0] - shift) for r in results]
+        total = sum(s * r[1] for s, r in zip(scales, results))
+        log_Z = shift + math.log(total)
+        if not moments:
+            return log_Z, None
+
+        sums = {key: sum(s * r[2][key] for s, r in zip(scales, results))
+                for key in results[0][2]}
+        return log_Z, {
+            'vis': sums['vis'] / total,
+            'hid': numpy.concatenate([sums['hid_low'],
+                                      sums['hid_high']]) / total,
+            'vh': numpy.hstack([sums['vh_low'], sums['vh_high']]) / total
+        }
+
+    def close(self):
+        """
+        Shut down the thread pool, if there is one.
+
+        Args:
+            None
+
+        Returns:
+            None
+
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def log_partition_function(self):
+        """
+        Compute the log partition function of the current model.
+
+        Args:
+            None
+
+        Returns:
+            float
+
+        """
+        return self._enumerate()[0]
+
+    def log_likelihood(self, batch, mode='validate'):
+        """
+        Compute the average log-likelihood of the samples in a Batch.
+
+        Args:
+            batch: a batch object
+            mode (str): the part of the batch to use ('train' or 'validate')
+
+        Returns:
+            float
+
+        """
+        return average_log_likelihood(self.model, batch,
+                                      self.log_partition_function(), mode)
+
+    def gradient(self, data_state):
+        """
+        Compute the exact gradient of the log-likelihood.
+
+        Notes:
+            The negative phase is the exact expectation under the model.
+            Requires a Bernoulli visible layer.
+
+        Args:
+            data_state (State object): the observed visible units
+
+        Returns:
+            Gradient
+
+        """
+        assert type(self.model.layers[0]) is layers.BernoulliLayer, \
+        "The exact gradient requires a Bernoulli visible layer"
+        model = self.model
+        _, moments = self._enumerate(moments=True)
+
+        model_derivs = gu.Gradient(
+            [ly.params.__class__(ly.get_penalty_grad(
+                -be.float_tensor(moments[key]), 'loc'))
+             for ly, key in zip(model.layers, ['vis', 'hid'])],
+            [model.weights[0].params.__class__(
+                model.weights[0].get_penalty_grad(
+                    -be.float_tensor(moments['vh']), 'matrix'))]
+        )
+
+        # the positive phase as in Model.gradient
+        new_data_state = model.mean_field_iteration(1, data_state,
+                                                    clamped=[0])
+        data_derivs = gu.Gradient(
+            [model.layers[i].derivatives(
+                new_data_state.units[i],
+                model._connected_rescaled_units(i, new_data_state),
+                model._connected_weights(i))
+             for i in range(model.num_layers)],
+            [model.weights[0].derivatives(
+                model.layers[0].rescale(new_data_state.units[0]),
+                model.layers[1].rescale(new_data_state.units[1]))]
+        )
+
+        return gu.Gradient(
+            [be.mapzip(be.subtract, m, d)
+             for m, d in zip(model_derivs.layers, data_derivs.layers)],
+            [be.mapzip(be.subtract, m, d)
+             for m, d in zip(model_derivs.weights, data_derivs.weights)]
+        )
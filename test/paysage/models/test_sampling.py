@@ -0,0 +1,468 @@
+import itertools
+import numpy
+
+from paysage import layers
+from paysage.models import model
+from paysage import backends as be
+
+import pytest
+
+num_vis = 3
+num_hid = 2
+num_chains = 5000
+
+# ----- UTILITIES ----- #
+
+def small_rbm():
+    be.set_seed()
+    rbm = model.Model([layers.BernoulliLayer(num_vis),
+                       layers.BernoulliLayer(num_hid)])
+    rbm.weights[0].params.matrix[:] = be.randn((num_vis, num_hid))
+    rbm.layers[0].params.loc[:] = be.randn((num_vis,))
+    rbm.layers[1].params.loc[:] = be.randn((num_hid,))
+    return rbm
+
+def exact_visible_mean(rbm, beta=1.0):
+    W = beta * be.to_numpy_array(rbm.weights[0].W())
+    a = be.to_numpy_array(rbm.layers[0].params.loc)
+    b = be.to_numpy_array(rbm.layers[1].params.loc)
+    vis = numpy.array(list(itertools.product([0, 1], repeat=num_vis)),
+                      dtype=numpy.float32)
+    log_prob = vis @ a + numpy.logaddexp(0, vis @ W + b).sum(axis=1)
+    prob = numpy.exp(log_prob - log_prob.max())
+    return prob @ vis / prob.sum()
+
+
+# ----- FUSED SAMPLER ----- #
+
+def test_fused_sampler_off_by_default():
+    rbm = small_rbm()
+    assert not rbm.use_fused_sampler
+    rbm.markov_chain(1, model.State.from_model(10, rbm))
+    assert rbm.fused_sampler is None
+
+def test_fused_sampler_marginals():
+    rbm = small_rbm()
+    rbm.use_fused_sampler = True
+    state = model.State.from_model(num_chains, rbm)
+    state = rbm.markov_chain(20, state)
+    assert rbm.fused_sampler is not None, "fused sampler was not used"
+    assert numpy.allclose(be.mean(state.units[0], axis=0),
+                          exact_visible_mean(rbm), atol=0.03), \
+    "fused sampler has the wrong stationary distribution"
+
+def test_fused_sampler_matches_alternating_update():
+    rbm = small_rbm()
+    state = model.State.from_model(num_chains, rbm)
+    rbm.use_fused_sampler = True
+    fused = rbm.markov_chain(20, state)
+    rbm.use_fused_sampler = False
+    unfused = rbm.markov_chain(20, state)
+    for i in range(rbm.num_layers):
+        assert numpy.allclose(be.mean(fused.units[i], axis=0),
+                              be.mean(unfused.units[i], axis=0), atol=0.04), \
+        "fused and unfused samplers have different marginals"
+
+def test_fused_sampler_reproducible():
+    rbm = small_rbm()
+    rbm.use_fused_sampler = True
+    state = model.State.from_model(num_chains, rbm)
+    samples = []
+    for _ in range(2):
+        be.set_seed(137)
+        samples.append(rbm.markov_chain(5, state))
+    for i in range(rbm.num_layers):
+        assert be.allclose(samples[0].units[i], samples[1].units[i]), \
+        "the fused sampler is not reproducible"
+
+def test_fused_sampler_beta():
+    rbm = small_rbm()
+    rbm.use_fused_sampler = True
+    beta = 0.5 * be.ones((num_chains, 1))
+    state = model.State.from_model(num_chains, rbm)
+    state = rbm.markov_chain(20, state, beta=beta)
+    assert numpy.allclose(be.mean(state.units[0], axis=0),
+                          exact_visible_mean(rbm, beta=0.5), atol=0.03), \
+    "fused sampler has the wrong distribution at beta = 0.5"
+
+def test_fused_sampler_clamped():
+    rbm = small_rbm()
+    rbm.use_fused_sampler = True
+    state = model.State.from_model(100, rbm)
+    new_state = rbm.markov_chain(3, state, clamped=[0])
+    assert be.allclose(state.units[0], new_state.units[0]), \
+    "fused sampler modified a clamped layer"
+
+
+# ----- IN PLACE UPDATES ----- #
+
+def test_fused_sampler_writes_copies_back():
+    rbm = small_rbm()
+    rbm.use_fused_sampler = True
+    # double precision units are sampled in a float32 copy
+    vis = numpy.zeros((12, num_vis))
+    state = model.State.from_visible(vis, rbm)
+    units = list(state.units)
+    new_state = rbm.markov_chain(3, state, out=state)
+    assert all(u is v for u, v in zip(new_state.units, units))
+    assert be.tsum(new_state.units[0]) > 0
+    # the tiles of a State are views of its units
+    state = model.State.from_visible(numpy.zeros((12, num_vis)), rbm)
+    rbm.max_tile_rows = 5
+    new_state = rbm.markov_chain(3, state)
+    assert be.tsum(new_state.units[0][10:]) > 0
+    assert be.tsum(new_state.units[0]) > 0
+
+def test_markov_chain_out_matches_copy():
+    rbm = small_rbm()
+    state = model.State.from_model(100, rbm)
+    be.set_seed(137)
+    copied = rbm.markov_chain(4, state)
+    out = model.State.from_model(100, rbm)
+    be.set_seed(137)
+    result = rbm.markov_chain(4, state, out=out)
+    assert result is out
+    for i in range(rbm.num_layers):
+        assert be.allclose(copied.units[i], out.units[i]), \
+        "in place updates change the samples"
+
+def test_markov_chain_out_is_state():
+    rbm = small_rbm()
+    state = model.State.from_model(100, rbm)
+    vis = be.float_tensor(be.to_numpy_array(state.units[0]).copy())
+    be.set_seed(137)
+    copied = rbm.markov_chain(4, state, clamped=[0])
+    be.set_seed(137)
+    rbm.markov_chain(4, state, clamped=[0], out=state)
+    assert be.allclose(state.units[0], vis), "clamped layer was modified"
+    assert be.allclose(copied.units[1], state.units[1])
+
+def test_iteration_out_leaves_input():
+    rbm = small_rbm()
+    state = model.State.from_model(100, rbm)
+    before = model.State.from_state(state)
+    out = model.State.from_model(100, rbm)
+    rbm.mean_field_iteration(3, state, out=out)
+    rbm.deterministic_iteration(0, state, out=out)
+    for i in range(rbm.num_layers):
+        assert be.allclose(state.units[i], before.units[i]), \
+        "the input state was modified"
+        assert be.allclose(state.units[i], out.units[i])
+
+# ----- CLAMP MASKS ----- #
+
+def test_mask_keeps_clamped_units():
+    rbm = small_rbm()
+    state = model.State.from_model(10, rbm)
+    mask = be.float_tensor(be.rand((10, num_vis)) < 0.5)
+    for method in ['markov_chain', 'mean_field_iteration',
+                   'deterministic_iteration']:
+        new_state = getattr(rbm, method)(3, state, mask=[mask, None])
+        assert be.allclose(mask * new_state.units[0], mask * state.units[0])
+    # a full mask clamps the layer
+    masked = rbm.mean_field_iteration(3, state,
+                                      mask=[be.ones_like(mask), None])
+    clamped = rbm.mean_field_iteration(3, state, clamped=[0])
+    for i in range(rbm.num_layers):
+        assert be.allclose(masked.units[i], clamped.units[i])
+
+def test_impute_conditional():
+    # fill in the last visible unit given the others
+    rbm = small_rbm()
+    vis = be.zeros((num_chains, num_vis))
+    vis[:, 0] = 1
+    mask = be.ones_like(vis)
+    mask[:, -1] = 0
+    completed = rbm.impute(20, vis, mask)
+    assert be.allclose(completed[:, :-1], vis[:, :-1])
+
+    candidates = be.float_tensor(numpy.array([[1, 0, 0], [1, 0, 1]]))
+    free_energy = be.to_numpy_array(rbm.marginal_free_energy(
+        model.State.from_visible(candidates, rbm)))
+    p = 1 / (1 + numpy.exp(free_energy[1] - free_energy[0]))
+    assert abs(be.mean(completed[:, -1]) - p) < 0.03, \
+    "imputed units do not follow the conditional distribution"
+
+# ----- PRECISION ----- #
+
+def test_low_precision_marginals():
+    rbm = small_rbm()
+    rbm.layers[0].set_precision('uint8')
+    rbm.layers[1].set_precision('float16')
+    state = model.State.from_model(num_chains, rbm)
+    assert state.units[0].dtype == numpy.uint8
+    state = rbm.markov_chain(20, state)
+    assert state.units[0].dtype == numpy.uint8
+    assert state.units[1].dtype == numpy.float16
+    assert numpy.allclose(be.mean(be.float_tensor(state.units[0]), axis=0),
+                          exact_visible_mean(rbm), atol=0.03), \
+    "low precision states have the wrong stationary distribution"
+
+    # masked and block updates also keep the precision
+    mask = be.float_tensor(be.rand((num_chains, num_vis)) < 0.5)
+    masked = rbm.markov_chain(2, state, mask=[mask, None])
+    assert masked.units[0].dtype == numpy.uint8
+    assert be.allclose(mask * masked.units[0], mask * state.units[0])
+    rbm.hidden_block_size = 1
+    blocked = rbm.markov_chain(2, state)
+    assert blocked.units[1].dtype == numpy.float16
+
+def test_low_precision_gradient():
+    rbm = small_rbm()
+    vdata = rbm.layers[0].random((100, num_vis))
+    data_state = model.State.from_visible(vdata, rbm)
+    model_state = rbm.markov_chain(2, model.State.from_model(100, rbm))
+    full = rbm.gradient(data_state, model_state)
+    rbm.layers[0].set_precision('uint8')
+    rbm.layers[1].set_precision('uint8')
+    low_state = model.State([be.cast_tensor(u, 'uint8')
+                             for u in model_state.units])
+    low = rbm.gradient(data_state, low_state)
+    for f, l in zip(full.layers + full.weights, low.layers + low.weights):
+        for x, y in zip(f, l):
+            assert y.dtype == numpy.float32
+            assert be.allclose(x, y)
+
+def test_precision_config():
+    rbm = small_rbm()
+    rbm.layers[0].set_precision('uint8')
+    with pytest.raises(ValueError):
+        rbm.layers[1].set_precision('int8')
+    copy = model.Model.from_config(rbm.get_config())
+    assert copy.layers[0].precision == 'uint8'
+    assert copy.layers[1].precision == 'float32'
+
+def test_ising_int8():
+    ly = layers.IsingLayer(num_vis)
+    ly.set_precision('int8')
+    x = ly.random((10, num_vis))
+    assert x.dtype == numpy.int8
+    assert numpy.all(numpy.abs(x) == 1)
+
+# ----- BLOCK UPDATES ----- #
+
+def test_block_markov_chain_marginals():
+    rbm = small_rbm()
+    rbm.hidden_block_size = 1
+    state = model.State.from_model(num_chains, rbm)
+    state = rbm.markov_chain(40, state)
+    assert numpy.allclose(be.mean(state.units[0], axis=0),
+                          exact_visible_mean(rbm), atol=0.03), \
+    "block updates have the wrong stationary distribution"
+
+def test_block_markov_chain_clamped():
+    rbm = small_rbm()
+    rbm.hidden_block_size = 1
+    state = model.State.from_model(10, rbm)
+    clamped = rbm.markov_chain(5, state, clamped=[0])
+    assert be.allclose(clamped.units[0], state.units[0])
+    hid = be.to_numpy_array(clamped.units[1])
+    assert numpy.allclose(hid * (1 - hid), 0)
+
+def test_block_gradient():
+    rbm = small_rbm()
+    vdata = rbm.layers[0].random((100, num_vis))
+    data_state = model.State.from_visible(vdata, rbm)
+    model_state = rbm.markov_chain(5, model.State.from_model(100, rbm))
+    full = rbm.gradient(data_state, model_state)
+    rbm.hidden_block_size = 1
+    be.set_seed()
+    block = rbm.gradient(data_state, model_state)
+    # the estimate is unbiased: the block is rescaled by num_hid / block size
+    W_full = be.to_numpy_array(full.weights[0].matrix)
+    W_block = be.to_numpy_array(block.weights[0].matrix)
+    b_block = be.to_numpy_array(block.layers[1].loc)
+    in_block = numpy.any(W_block != 0, axis=0)
+    assert in_block.sum() == 1
+    assert numpy.allclose(W_block[:, in_block], num_hid * W_full[:, in_block],
+                          atol=1e-5)
+    assert numpy.allclose(W_block[:, ~in_block], 0)
+    assert numpy.allclose(b_block[~in_block], 0)
+    assert be.allclose(block.layers[0].loc, full.layers[0].loc)
+
+# ----- INCREMENTAL FIELDS ----- #
+
+def test_incremental_markov_chain_matches():
+    rbm = small_rbm()
+    state = model.State.from_model(100, rbm)
+    be.set_seed(3)
+    expected = rbm.markov_chain(20, state)
+    for fraction in [0.0, 0.5, 1.0]:
+        rbm.max_flip_fraction = fraction
+        be.set_seed(3)
+        new_state = rbm.markov_chain(20, state)
+        for u, v in zip(new_state.units, expected.units):
+            assert be.allclose(u, v)
+
+def test_incremental_markov_chain_clamped():
+    rbm = small_rbm()
+    rbm.max_flip_fraction = 0.5
+    state = model.State.from_model(100, rbm)
+    new_state = rbm.markov_chain(5, state, clamped=[0])
+    assert be.allclose(new_state.units[0], state.units[0])
+    assert not be.allclose(new_state.units[1], state.units[1])
+
+def test_incremental_markov_chain_marginals():
+    rbm = small_rbm()
+    rbm.max_flip_fraction = 0.3
+    state = model.State.from_model(num_chains, rbm)
+    rbm.markov_chain(100, state, out=state)
+    assert numpy.allclose(be.to_numpy_array(be.mean(state.units[0], axis=0)),
+                          exact_visible_mean(rbm), atol=0.03)
+
+
+# ----- TILES ----- #
+
+def test_tiled_iterations_match():
+    rbm = small_rbm()
+    state = model.State.from_model(50, rbm)
+    beta = be.rand((50, 1))
+    expected = rbm.mean_field_iteration(3, state, beta)
+    joint = rbm.joint_energy(state, beta)
+    free = rbm.marginal_free_energy(state, beta)
+    rbm.max_tile_rows = 16
+    tiled = rbm.mean_field_iteration(3, state, beta)
+    for u, v in zip(tiled.units, expected.units):
+        assert be.allclose(u, v)
+    assert be.allclose(rbm.joint_energy(state, beta), joint)
+    assert be.allclose(rbm.marginal_free_energy(state, beta), free)
+
+def test_tiled_markov_chain():
+    rbm = small_rbm()
+    rbm.max_tile_rows = 1000
+    state = model.State.from_model(num_chains, rbm)
+    mask = [be.float_tensor(be.rand((num_chains, num_vis)) < 0.5), None]
+    clamped = rbm.markov_chain(2, state, mask=mask)
+    assert be.allclose(mask[0] * clamped.units[0], mask[0] * state.units[0])
+    rbm.markov_chain(100, state, out=state)
+    assert numpy.allclose(be.to_numpy_array(be.mean(state.units[0], axis=0)),
+                          exact_visible_mean(rbm), atol=0.03)
+
+# ----- UPDATE PLANS ----- #
+
+def test_update_plan_cached():
+    rbm = small_rbm()
+    state = model.State.from_model(10, rbm)
+    rbm.mean_field_iteration(2, state)
+    plan = rbm.update_plans[('conditional_mean', ())]
+    assert [step.index for step in plan.steps] == [1, 0]
+    rbm.mean_field_iteration(2, state)
+    assert rbm.update_plans[('conditional_mean', ())] is plan
+    rbm.mean_field_iteration(2, state, clamped=[0])
+    assert [step.index for step in
+            rbm.update_plans[('conditional_mean', (0,))].steps] == [1]
+    # replacing a layer invalidates the plan
+    rbm.layers[1] = layers.BernoulliLayer(num_hid)
+    rbm.mean_field_iteration(1, state)
+    assert rbm.update_plans[('conditional_mean', ())] is not plan
+
+def test_update_plan_parameter_step():
+    rbm = small_rbm()
+    vis = be.float_tensor(be.rand((10, num_vis)) < 0.5)
+    state = model.State.from_visible(vis, rbm)
+    rbm.mean_field_iteration(1, state, clamped=[0])
+    # the optimizers replace the parameter tensors
+    rbm.weights[0].params = layers.ParamsWeights(
+        2 * rbm.weights[0].params.matrix)
+    new_state = rbm.mean_field_iteration(1, state, clamped=[0])
+    expected = be.expit(be.dot(vis, rbm.weights[0].W())
+                        + rbm.layers[1].params.loc)
+    assert be.allclose(new_state.units[1], expected)
+
+# ----- DEEP MODELS ----- #
+
+def small_dbm(sizes=(num_vis, num_hid, num_hid)):
+    be.set_seed()
+    dbm = model.Model([layers.BernoulliLayer(n) for n in sizes])
+    for l in dbm.layers:
+        l.params.loc[:] = be.randn((l.len,))
+    for w in dbm.weights:
+        w.params.matrix[:] = be.randn(w.shape)
+    return dbm
+
+def exact_deep_visible_mean(dbm):
+    configs = [numpy.array(list(itertools.product([0, 1], repeat=l.len)),
+                           dtype=numpy.float32) for l in dbm.layers]
+    units = [numpy.stack(u) for u in zip(*itertools.product(*configs))]
+    energy = be.to_numpy_array(dbm.joint_energy(
+        model.State([be.float_tensor(u) for u in units])))
+    prob = numpy.exp(-(energy - energy.min()))
+    return prob @ units[0] / prob.sum()
+
+def test_deep_update_plan():
+    dbm = small_dbm((3, 2, 2, 2))
+    plan = dbm._update_plan('conditional_mean', clamped=[0])
+    assert [[plan.steps[k].index for k in g] for g in plan.groups] \
+           == [[1, 3], [2]]
+
+def test_layer_threads_match():
+    dbm = small_dbm((3, 4, 4, 4, 4))
+    state = model.State.from_model(20, dbm)
+    beta = be.rand((20, 1))
+    expected = dbm.mean_field_iteration(3, state, beta)
+    dbm.layer_threads = 2
+    threaded = dbm.mean_field_iteration(3, state, beta)
+    assert dbm.layer_executor is not None
+    for u, v in zip(threaded.units, expected.units):
+        assert be.allclose(u, v)
+    dbm.mean_field_iteration(3, state, beta, out=state)
+    for u, v in zip(state.units, expected.units):
+        assert be.allclose(u, v)
+    dbm.close()
+    assert dbm.layer_executor is None
+
+def test_layer_threads_marginals():
+    dbm = small_dbm()
+    dbm.layer_threads = 2
+    state = dbm.markov_chain(50, model.State.from_model(num_chains, dbm))
+    assert numpy.allclose(be.to_numpy_array(be.mean(state.units[0], axis=0)),
+                          exact_deep_visible_mean(dbm), atol=0.03)
+    dbm.close()
+
+# ----- CONVOLUTIONAL WEIGHTS ----- #
+
+def conv_and_dense_rbms():
+    be.set_seed()
+    conv = layers.ConvolutionalWeights((2, 5, 4), (2, 2), num_filters=3)
+    conv.params.matrix[:] = be.randn(conv.shape)
+    conv_rbm = model.Model([layers.GaussianLayer(conv.num_visible),
+                            layers.BernoulliLayer(conv.num_hidden)],
+                           weights=[conv])
+    dense_rbm = model.Model([layers.GaussianLayer(conv.num_visible),
+                             layers.BernoulliLayer(conv.num_hidden)])
+    dense_rbm.weights[0].params.matrix[:] = \
+        conv.W().product(be.identity(conv.num_visible))
+    for rbm in [conv_rbm, dense_rbm]:
+        rbm.layers[1].params.loc[:] = 0.1
+    return conv_rbm, dense_rbm
+
+def test_convolutional_rbm_matches_dense():
+    conv_rbm, dense_rbm = conv_and_dense_rbms()
+    state = model.State.from_model(10, conv_rbm)
+    beta = be.rand((10, 1))
+    for u, v in zip(conv_rbm.mean_field_iteration(2, state, beta).units,
+                    dense_rbm.mean_field_iteration(2, state, beta).units):
+        assert be.allclose(u, v, atol=1e-4)
+    assert be.allclose(conv_rbm.joint_energy(state, beta),
+                       dense_rbm.joint_energy(state, beta), atol=1e-3)
+    assert be.allclose(conv_rbm.marginal_free_energy(state, beta),
+                       dense_rbm.marginal_free_energy(state, beta), atol=1e-3)
+    conv_grad = conv_rbm.gradient(state, state)
+    dense_grad = dense_rbm.gradient(state, state)
+    assert be.allclose(conv_grad.layers[0].log_var,
+                       dense_grad.layers[0].log_var, atol=1e-4)
+    assert be.shape(conv_grad.weights[0].matrix) == conv_rbm.weights[0].shape
+
+def test_convolutional_rbm_samplers():
+    conv_rbm, _ = conv_and_dense_rbms()
+    # the samplers that need a dense matrix are skipped
+    conv_rbm.hidden_block_size = 2
+    conv_rbm.max_flip_fraction = 0.1
+    state = model.State.from_model(10, conv_rbm)
+    new_state = conv_rbm.markov_chain(2, state)
+    assert [be.shape(u) for u in new_state.units] == state.shapes
+    conv_rbm.gradient(state, new_state)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -47,6 +47,16 @@ def test_grbm_from_config():
     config_from_config = rbm_from_config.get_config()
     assert config == config_from_config
 
+def test_convolutional_from_config():
+    conv = layers.ConvolutionalWeights((1, 4, 4), (3, 3), num_filters=2)
+    rbm = model.Model([layers.BernoulliLayer(conv.num_visible),
+                       layers.BernoulliLayer(conv.num_hidden)],
+                      weights=[conv])
+    config = rbm.get_config()
+    rbm_from_config = model.Model.from_config(config)
+    assert type(rbm_from_config.weights[0]) is layers.ConvolutionalWeights
+    assert rbm_from_config.get_config() == config
+
 def test_grbm_save():
     vis_layer = layers.BernoulliLayer(num_vis)
     hid_layer = layers.GaussianLayer(num_hid)
@@ -77,5 +87,33 @@ def test_grbm_reload():
     vis_reload = grbm_reload.deterministic_iteration(1, data_state).units[0]
     assert be.allclose(vis_orig, vis_reload)
 
+def test_convolutional_reload():
+    for num_filters in [1, 2]:
+        conv = layers.ConvolutionalWeights((1, 4, 4), (3, 3),
+                                           num_filters=num_filters)
+        rbm = model.Model([layers.BernoulliLayer(conv.num_visible),
+                           layers.BernoulliLayer(conv.num_hidden)],
+                          weights=[conv])
+        with tempfile.NamedTemporaryFile() as file:
+            # save the model
+            store = pandas.HDFStore(file.name, mode='w')
+            rbm.save(store)
+            store.close()
+            # reload
+            store = pandas.HDFStore(file.name, mode='r')
+            rbm_reload = model.Model.from_saved(store)
+            store.close()
+        # the filters keep their (patch, filter) shape
+        conv_reload = rbm_reload.weights[0]
+        assert type(conv_reload) is layers.ConvolutionalWeights
+        assert be.shape(conv_reload.params.matrix) == conv.shape
+        assert be.allclose(conv_reload.params.matrix, conv.params.matrix)
+        # check the two models are consistent
+        vis_data = rbm.layers[0].random((num_samples, conv.num_visible))
+        data_state = model.State.from_visible(vis_data, rbm)
+        vis_orig = rbm.deterministic_iteration(1, data_state).units[0]
+        vis_reload = rbm_reload.deterministic_iteration(1, data_state).units[0]
+        assert be.allclose(vis_orig, vis_reload)
+
 if __name__ == "__main__":
     pytest.main([__file__])
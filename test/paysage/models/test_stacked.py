@@ -0,0 +1,107 @@
+import numpy
+
+from paysage import layers
+from paysage.models import model
+from paysage.models import stacked
+from paysage import backends as be
+
+import pytest
+
+num_vis = 6
+num_hid = 4
+num_models = 3
+
+# ----- UTILITIES ----- #
+
+def random_rbms():
+    be.set_seed()
+    rbms = []
+    for _ in range(num_models):
+        rbm = model.Model([layers.BernoulliLayer(num_vis),
+                           layers.BernoulliLayer(num_hid)])
+        rbm.weights[0].params.matrix[:] = be.randn((num_vis, num_hid))
+        rbm.layers[0].params.loc[:] = be.randn((num_vis,))
+        rbm.layers[1].params.loc[:] = be.randn((num_hid,))
+        rbms.append(rbm)
+    return rbms
+
+def random_visible(num_samples, shape=()):
+    return be.float_tensor(be.rand(shape + (num_samples, num_vis)) < 0.5)
+
+class _Batch(object):
+    """Serves the same minibatches in every epoch."""
+    def __init__(self, minibatches):
+        self.minibatches = minibatches
+        self.index = 0
+
+    def get(self, mode):
+        if self.index == len(self.minibatches):
+            self.index = 0
+            raise StopIteration
+        self.index += 1
+        return self.minibatches[self.index - 1]
+
+
+# ----- TESTS ----- #
+
+def test_stacked_members():
+    rbms = random_rbms()
+    stack = stacked.StackedRBM(rbms)
+    for rbm, member in zip(rbms, stack.members()):
+        assert be.allclose(rbm.weights[0].W(), member.weights[0].W())
+        assert be.allclose(rbm.layers[0].params.loc,
+                           member.layers[0].params.loc)
+        assert be.allclose(rbm.layers[1].params.loc,
+                           member.layers[1].params.loc)
+
+def test_stacked_supports():
+    rbm = model.Model([layers.BernoulliLayer(num_vis),
+                       layers.GaussianLayer(num_hid)])
+    assert not stacked.StackedRBM.supports(rbm)
+    with pytest.raises(ValueError):
+        stacked.StackedRBM([rbm])
+
+def test_stacked_gradient():
+    rbms = random_rbms()
+    stack = stacked.StackedRBM(rbms)
+    vdata = random_visible(10)
+    state = stack.random_state(7)
+    grad = stack.gradient(vdata, state)
+    for i, rbm in enumerate(rbms):
+        data_state = model.State.from_visible(vdata, rbm)
+        model_state = model.State.from_visible(state.units[0][i], rbm)
+        expected = rbm.gradient(data_state, model_state)
+        assert be.allclose(grad.weights[0].matrix[i],
+                           expected.weights[0].matrix)
+        for l in range(2):
+            assert be.allclose(grad.layers[l].loc[i],
+                               expected.layers[l].loc)
+
+def test_stacked_markov_chain_seeds():
+    rbms = random_rbms()
+    # a member's chains only depend on its own seed
+    stack = stacked.StackedRBM(rbms, seeds=[1, 2, 3])
+    single = stacked.StackedRBM(rbms[1:2], seeds=[2])
+    state = stack.markov_chain(3, stack.random_state(5))
+    single_state = single.markov_chain(3, single.random_state(5))
+    assert be.allclose(state.units[0][1], single_state.units[0][0])
+    assert not be.allclose(state.units[0][0], state.units[0][1])
+
+def test_stacked_train():
+    rbms = random_rbms()
+    batch = _Batch([random_visible(10) for _ in range(3)])
+    stack = stacked.StackedRBM(rbms, seeds=[1, 2, 3])
+    opt = stacked.StackedMomentum(stepsize=[0.0, 0.1, 0.1],
+                                  momentum=0.5, penalty=[0, 0, 2.0])
+    stacked.StackedPCD(stack, batch, opt, epochs=2, num_chains=8).train()
+    # a member with a zero stepsize does not change
+    assert be.allclose(stack.member(0).weights[0].W(), rbms[0].weights[0].W())
+    assert not be.allclose(stack.member(1).weights[0].W(),
+                           rbms[1].weights[0].W())
+    # the penalty shrinks the weights
+    assert be.norm(stack.member(2).weights[0].W()) \
+           < 0.5 * be.norm(rbms[2].weights[0].W())
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
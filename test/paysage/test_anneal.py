@@ -0,0 +1,127 @@
+import itertools
+import numpy
+
+from paysage import layers
+from paysage import anneal
+from paysage.models import model
+from paysage import backends as be
+
+import pytest
+
+num_vis = 6
+num_hid = 4
+
+# ----- UTILITIES ----- #
+
+def small_rbm():
+    be.set_seed()
+    rbm = model.Model([layers.BernoulliLayer(num_vis),
+                       layers.BernoulliLayer(num_hid)])
+    rbm.weights[0].params.matrix[:] = 2 * be.randn((num_vis, num_hid))
+    rbm.layers[0].params.loc[:] = be.randn((num_vis,))
+    rbm.layers[1].params.loc[:] = be.randn((num_hid,))
+    return rbm
+
+def ground_state_energy(rbm):
+    configs = numpy.array(list(itertools.product([0, 1],
+                                                 repeat=num_vis + num_hid)),
+                          dtype=numpy.float32)
+    state = model.State([be.float_tensor(configs[:, :num_vis]),
+                         be.float_tensor(configs[:, num_vis:])])
+    return be.tmin(rbm.joint_energy(state))
+
+def exact_log_Z(rbm):
+    vis = numpy.array(list(itertools.product([0, 1], repeat=num_vis)),
+                      dtype=numpy.float32)
+    state = model.State.from_visible(be.float_tensor(vis), rbm)
+    log_weights = -be.to_numpy_array(rbm.marginal_free_energy(state))
+    return numpy.logaddexp.reduce(log_weights.astype(numpy.float64))
+
+def exact_visible_mean(rbm):
+    vis = numpy.array(list(itertools.product([0, 1], repeat=num_vis)),
+                      dtype=numpy.float32)
+    state = model.State.from_visible(be.float_tensor(vis), rbm)
+    log_prob = -be.to_numpy_array(rbm.marginal_free_energy(state))
+    prob = numpy.exp(log_prob - log_prob.max())
+    return prob @ vis / prob.sum()
+
+
+# ----- TESTS ----- #
+
+def test_schedules():
+    linear = anneal.linear_schedule(10, 0.5, 2.0)
+    geometric = anneal.geometric_schedule(10, 0.5, 2.0)
+    for schedule in [linear, geometric]:
+        assert len(schedule) == 11
+        assert numpy.isclose(schedule[0], 0.5)
+        assert numpy.isclose(schedule[-1], 2.0)
+    assert numpy.allclose(numpy.diff(linear), 0.15)
+    assert numpy.allclose(geometric[1:] / geometric[:-1],
+                          geometric[1] / geometric[0])
+
+def test_unique_modes():
+    rbm = small_rbm()
+    vis = be.float_tensor(numpy.array([[1, 0, 1, 0, 1, 0],
+                                       [0, 0, 0, 0, 0, 0],
+                                       [1, 0, 1, 0, 1, 0]]))
+    state = model.State([vis, be.zeros((3, num_hid))])
+    modes = anneal.unique_modes(rbm, state)
+    assert be.shape(modes.state.units[0]) == (2, num_vis)
+    assert sorted(modes.counts) == [1, 2]
+    assert numpy.all(numpy.diff(modes.energy) >= 0)
+
+def test_annealer_finds_ground_state():
+    rbm = small_rbm()
+    annealer = anneal.Annealer(rbm, anneal.geometric_schedule(50, 0.1, 3.0))
+    modes = annealer.run(200)
+    assert modes.counts.sum() == 200
+    assert abs(modes.energy[0] - ground_state_energy(rbm)) < 1e-4, \
+    "annealing did not find the lowest energy configuration"
+    # the modes are fixed points of the deterministic updates
+    fixed = rbm.deterministic_iteration(1, modes.state)
+    for i in range(rbm.num_layers):
+        assert be.allclose(fixed.units[i], modes.state.units[i])
+
+def test_annealer_per_chain_schedule():
+    rbm = small_rbm()
+    num_chains = 20
+    schedule = numpy.outer(anneal.linear_schedule(20),
+                           numpy.linspace(0.5, 2.0, num_chains))
+    annealer = anneal.Annealer(rbm, schedule)
+    state = annealer.anneal(model.State.from_model(num_chains, rbm))
+    assert be.shape(state.units[0]) == (num_chains, num_vis)
+    modes = annealer.run(state)
+    assert modes.counts.sum() == num_chains
+
+
+def test_systematic_resample():
+    be.set_seed()
+    weights = numpy.array([0.1, 0.0, 0.6, 0.3])
+    index = anneal.systematic_resample(numpy.log(weights + 1e-300), 10)
+    counts = numpy.bincount(index, minlength=4)
+    assert counts.sum() == 10
+    assert numpy.all(numpy.abs(counts - 10 * weights) < 1)
+
+def test_population_annealing():
+    rbm = small_rbm()
+    annealer = anneal.PopulationAnnealer(rbm, population_size=4000,
+                                         steps_per_beta=2)
+    state = annealer.run()
+    assert be.shape(state.units[0]) == (4000, num_vis)
+    assert abs(annealer.log_Z - exact_log_Z(rbm)) < 0.1, \
+    "population annealing does not match the partition function"
+    assert numpy.allclose(be.to_numpy_array(be.mean(state.units[0], axis=0)),
+                          exact_visible_mean(rbm), atol=0.05)
+
+def test_population_annealing_workers():
+    rbm = small_rbm()
+    with anneal.PopulationAnnealer(rbm, population_size=2000,
+                                   num_workers=2) as annealer:
+        state = annealer.run()
+    assert be.shape(state.units[0]) == (2000, num_vis)
+    assert abs(annealer.log_Z - exact_log_Z(rbm)) < 0.15
+
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,506 @@
+import itertools
+import math
+import numpy
+
+from paysage import layers
+from paysage import fit
+from paysage import parallel
+from paysage import optimizers
+from paysage.models import model
+from paysage import backends as be
+
+import pytest
+
+num_vis = 8
+num_hid = 5
+num_samples = 10
+
+# ----- UTILITIES ----- #
+
+def rbm_and_data():
+    be.set_seed()
+    vis_layer = layers.BernoulliLayer(num_vis)
+    hid_layer = layers.BernoulliLayer(num_hid)
+    rbm = model.Model([vis_layer, hid_layer])
+    rbm.weights[0].params.matrix[:] = be.randn((num_vis, num_hid))
+    vdata = rbm.layers[0].random((num_samples, num_vis))
+    return rbm, vdata
+
+def exact_visible_mean(rbm):
+    W = be.to_numpy_array(rbm.weights[0].W())
+    a = be.to_numpy_array(rbm.layers[0].params.loc)
+    b = be.to_numpy_array(rbm.layers[1].params.loc)
+    nv = len(a)
+    vis = numpy.array(list(itertools.product([0, 1], repeat=nv)),
+                      dtype=numpy.float32)
+    log_prob = vis @ a + numpy.logaddexp(0, vis @ W + b).sum(axis=1)
+    prob = numpy.exp(log_prob - log_prob.max())
+    return prob @ vis / prob.sum()
+
+
+# ----- PARALLEL TEMPERING ----- #
+
+def test_parallel_tempering_shapes():
+    rbm, vdata = rbm_and_data()
+    sampler = fit.ParallelTempering(rbm, num_replicas=4)
+    sampler.set_positive_state(model.State.from_visible(vdata, rbm))
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    sampler.update_negative_state(5)
+
+    assert be.shape(sampler.replica_state.units[0]) == (4 * num_samples, num_vis)
+    assert be.shape(sampler.neg_state.units[0]) == (num_samples, num_vis)
+    assert be.shape(sampler.neg_state.units[1]) == (num_samples, num_hid)
+
+def test_parallel_tempering_ladder():
+    rbm, vdata = rbm_and_data()
+    sampler = fit.ParallelTempering(rbm, num_replicas=5, beta_min=0.1,
+                                    adapt_rate=1.0)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    for _ in range(10):
+        sampler.update_negative_state(2)
+
+    assert sampler.betas[0] == 1.0
+    assert abs(sampler.betas[-1] - 0.1) < 1e-6
+    for r in range(len(sampler.betas) - 1):
+        assert sampler.betas[r] > sampler.betas[r+1], \
+        "temperature ladder is not ordered"
+    for rate in sampler.swap_rates:
+        assert 0 <= rate <= 1
+
+def test_parallel_tempering_swap_preserves_units():
+    rbm, vdata = rbm_and_data()
+    sampler = fit.ParallelTempering(rbm, num_replicas=3)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    sampler._swap()
+    for u in sampler.replica_state.units:
+        assert be.allclose(u * (1 - u), be.zeros_like(u)), \
+        "replica exchange produced non-binary units"
+
+
+def test_parallel_tempering_cold_marginals():
+    be.set_seed()
+    rbm = model.Model([layers.BernoulliLayer(3), layers.BernoulliLayer(2)])
+    rbm.weights[0].params.matrix[:] = 2 * be.randn((3, 2))
+    rbm.layers[0].params.loc[:] = be.randn((3,))
+    rbm.layers[1].params.loc[:] = be.randn((2,))
+
+    num_chains = 4000
+    sampler = fit.ParallelTempering(rbm, num_replicas=3, beta_min=0.05,
+                                    adapt_rate=0)
+    sampler.set_negative_state(model.State.from_model(num_chains, rbm))
+    sampler.update_negative_state(30)
+    assert numpy.allclose(be.mean(sampler.neg_state.units[0], axis=0),
+                          exact_visible_mean(rbm), atol=0.03), \
+    "replica exchange changed the distribution of the cold replica"
+
+def test_population_annealing_marginals():
+    be.set_seed()
+    rbm = model.Model([layers.BernoulliLayer(3), layers.BernoulliLayer(2)])
+    rbm.weights[0].params.matrix[:] = 2 * be.randn((3, 2))
+    rbm.layers[0].params.loc[:] = be.randn((3,))
+    rbm.layers[1].params.loc[:] = be.randn((2,))
+
+    sampler = fit.PopulationAnnealing(rbm)
+    sampler.set_negative_state(model.State.from_model(4000, rbm))
+    sampler.update_negative_state(1)
+    assert be.shape(sampler.neg_state.units[0]) == (4000, 3)
+    assert sampler.log_Z is not None
+    assert numpy.allclose(be.mean(sampler.neg_state.units[0], axis=0),
+                          exact_visible_mean(rbm), atol=0.03)
+
+# ----- PROCESS POOLS ----- #
+
+def test_sequential_mc_workers_match_serial():
+    rbm, vdata = rbm_and_data()
+    serial = fit.SequentialMC(rbm, method='deterministic')
+    serial.set_negative_state(model.State.from_visible(vdata, rbm))
+    pooled = fit.SequentialMC(rbm, method='deterministic', num_workers=2)
+    pooled.set_negative_state(model.State.from_visible(vdata, rbm))
+    pooled.neg_state.units[1] = serial.neg_state.units[1]
+
+    try:
+        for _ in range(2):
+            # parameter changes must be seen by the workers
+            rbm.weights[0].params.matrix[:] = be.randn((num_vis, num_hid))
+            serial.update_negative_state(3)
+            pooled.update_negative_state(3)
+            for i in range(rbm.num_layers):
+                assert be.allclose(serial.neg_state.units[i],
+                                   pooled.neg_state.units[i]), \
+                "process pool does not match serial sampling"
+    finally:
+        pooled.close()
+
+def test_driven_sequential_mc_workers():
+    rbm, vdata = rbm_and_data()
+    sampler = fit.DrivenSequentialMC(rbm, num_workers=2)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    try:
+        sampler.update_negative_state(2)
+        v = sampler.neg_state.units[0]
+        assert be.shape(v) == (num_samples, num_vis)
+        assert be.allclose(v * (1 - v), be.zeros_like(v))
+    finally:
+        sampler.close()
+
+def test_workers_after_fused_sampler():
+    # the fused kernel starts a thread pool, forking afterwards must not hang
+    rbm, vdata = rbm_and_data()
+    rbm.use_fused_sampler = True
+    serial = fit.SequentialMC(rbm)
+    serial.set_negative_state(model.State.from_visible(vdata, rbm))
+    serial.update_negative_state(2)
+    assert rbm.fused_sampler is not None
+
+    pooled = fit.SequentialMC(rbm, num_workers=2)
+    pooled.set_negative_state(model.State.from_visible(vdata, rbm))
+    try:
+        pooled.update_negative_state(2)
+        assert be.shape(pooled.neg_state.units[0]) == (num_samples, num_vis)
+    finally:
+        pooled.close()
+
+def test_sequential_mc_inplace_matches_copy():
+    rbm, vdata = rbm_and_data()
+    samplers = [fit.SequentialMC(rbm), fit.SequentialMC(rbm, inplace=True)]
+    for sampler in samplers:
+        sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+        be.set_seed(137)
+        for _ in range(3):
+            sampler.update_negative_state(2)
+    for i in range(rbm.num_layers):
+        assert be.allclose(samplers[0].neg_state.units[i],
+                           samplers[1].neg_state.units[i]), \
+        "in place updates change the samples"
+    assert any(samplers[1].neg_state is b for b in samplers[1].buffers)
+
+def _cached_arrays(model):
+    return set(parallel._worker_arrays)
+
+def test_pool_evicts_stale_buffers():
+    rbm, vdata = rbm_and_data()
+    with parallel.ModelPool(rbm, num_workers=2) as pool:
+        pool.advance('markov_chain', 1, model.State.from_visible(vdata, rbm))
+        # changing the number of particles reallocates the shared buffers
+        vsmall = vdata[:num_samples // 2]
+        pool.advance('markov_chain', 1, model.State.from_visible(vsmall, rbm))
+        live = pool._live_names()
+        for cached in pool.map(_cached_arrays, [()] * 2):
+            assert cached <= live, "workers keep stale shared memory"
+
+def test_pool_keeps_layer_precision():
+    rbm, vdata = rbm_and_data()
+    rbm.layers[0].set_precision('uint8')
+    rbm.layers[1].set_precision('float16')
+    with parallel.ModelPool(rbm, num_workers=2) as pool:
+        new_state = pool.advance('markov_chain', 2,
+                                 model.State.from_visible(vdata, rbm))
+        assert new_state.units[0].dtype == numpy.uint8
+        assert new_state.units[1].dtype == numpy.float16
+        # the values are still binary
+        assert set(numpy.unique(new_state.units[0])) <= {0, 1}
+
+def _worker_settings(model):
+    return parallel.sampler_settings(model)
+
+def test_pool_sampler_settings():
+    rbm, vdata = rbm_and_data()
+    rbm.use_fused_sampler = True
+    rbm.max_tile_rows = 3
+    with parallel.ModelPool(rbm, num_workers=2) as pool:
+        expected = parallel.sampler_settings(rbm)
+        assert set(expected) == set(parallel.SAMPLER_SETTINGS)
+        for settings in pool.map(_worker_settings, [()] * 2):
+            assert settings == expected
+        # later changes reach the workers
+        rbm.max_flip_fraction = 0.2
+        rbm.hidden_block_size = 1
+        expected = parallel.sampler_settings(rbm)
+        for settings in pool.map(_worker_settings, [()] * 2):
+            assert settings == expected
+        new_state = pool.advance('markov_chain', 2,
+                                 model.State.from_visible(vdata, rbm))
+        assert be.shape(new_state.units[0]) == (num_samples, num_vis)
+
+def _stream_draws(model, n):
+    return be.to_numpy_array(be.rand((n,)))
+
+def test_random_streams():
+    be.set_seed()
+    first = be.spawn_streams(2)
+    second = be.spawn_streams(2)
+    draws = [be.to_numpy_array(s.rand((100,))) for s in first + second]
+    for x, y in itertools.combinations(draws, 2):
+        assert not numpy.allclose(x, y), "child streams are not independent"
+    # the draws of a stream do not depend on the other streams
+    be.set_seed()
+    again = be.spawn_streams(2)
+    assert numpy.allclose(be.to_numpy_array(again[1].rand((100,))), draws[1])
+    assert numpy.allclose(be.to_numpy_array(again[0].rand((100,))), draws[0])
+
+def test_pool_streams_reproducible():
+    rbm, vdata = rbm_and_data()
+    with parallel.ModelPool(rbm, num_workers=2) as pool:
+        results = []
+        for _ in range(2):
+            be.set_seed()
+            results.append(pool.map(_stream_draws, [(5,)] * 4))
+    for x, y in zip(*results):
+        assert numpy.allclose(x, y), "pooled sampling is not reproducible"
+    for x, y in itertools.combinations(results[0], 2):
+        assert not numpy.allclose(x, y), "tasks share a random stream"
+
+class _OneBatch(object):
+    """Serves a single training minibatch per epoch."""
+    def __init__(self, vdata):
+        self.vdata = vdata
+        self.served = False
+
+    def get(self, mode):
+        if self.served:
+            self.served = False
+            raise StopIteration
+        self.served = True
+        return self.vdata
+
+def test_train_closes_pool():
+    rbm, vdata = rbm_and_data()
+    sampler = fit.SequentialMC(rbm, num_workers=2)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    trainer = fit.SGD(rbm, _OneBatch(vdata), optimizers.Gradient(), 1,
+                      method=fit.pcd, sampler=sampler, mcsteps=1)
+    try:
+        trainer.train()
+        assert sampler.pool is None, "training leaves the pool open"
+    finally:
+        sampler.close()
+
+def test_adaptive_steps_increase_for_frozen_chains():
+    rbm, vdata = rbm_and_data()
+    state = model.State.from_visible(vdata, rbm)
+    controller = fit.AdaptiveSteps(steps=2, max_steps=10)
+    for _ in range(10):
+        controller.update(rbm, state)
+    assert controller.flip_rate == 0
+    assert controller.steps == 10
+
+def test_adaptive_steps_decrease_for_independent_chains():
+    rbm, vdata = rbm_and_data()
+    controller = fit.AdaptiveSteps(steps=20, min_steps=2)
+    for _ in range(20):
+        controller.update(rbm, model.State.from_model(1000, rbm))
+    assert abs(controller.autocorrelation) < 0.1
+    assert controller.steps == 2
+
+def test_train_adaptive_steps():
+    rbm, vdata = rbm_and_data()
+    sampler = fit.SequentialMC(rbm)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    controller = fit.AdaptiveSteps(steps=1, max_steps=4)
+    trainer = fit.SGD(rbm, _OneBatch(vdata), optimizers.Gradient(), 3,
+                      method=fit.pcd, sampler=sampler, mcsteps=controller)
+    trainer.train()
+    assert controller.autocorrelation is not None
+    assert 1 <= controller.steps <= 4
+
+def test_chain_diagnostics_ar1():
+    # an AR(1) process x_t = phi x_(t-1) + noise has tau = (1 + phi) / (1 - phi)
+    phi = 0.6
+    num_chains = 500
+    diagnostics = fit.ChainDiagnostics(max_lag=30)
+    rng = numpy.random.RandomState(137)
+    x = rng.randn(num_chains) / math.sqrt(1 - phi ** 2)
+    units = numpy.zeros((num_chains, 2))
+    for t in range(400):
+        x = phi * x + rng.randn(num_chains)
+        units[:, t % 2] = 1 - units[:, t % 2]
+        diagnostics.add_sample(x, [units])
+    assert numpy.allclose(diagnostics.autocorrelation()[:3],
+                          [phi, phi ** 2, phi ** 3], atol=0.03)
+    tau = (1 + phi) / (1 - phi)
+    assert abs(diagnostics.integrated_autocorrelation_time() - tau) < 0.3
+    assert abs(diagnostics.effective_sample_size()
+               - num_chains * 400 / tau) < 0.1 * num_chains * 400 / tau
+    assert numpy.allclose(diagnostics.flip_rates(), [0.5])
+
+def test_sampler_diagnostics_in_progress_monitor():
+    rbm, vdata = rbm_and_data()
+    diagnostics = fit.ChainDiagnostics(max_lag=5)
+    sampler = fit.DrivenSequentialMC(rbm, diagnostics=diagnostics)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    for _ in range(4):
+        sampler.update_negative_state(1)
+    assert diagnostics.count == 4
+    monitor = fit.ProgressMonitor(_OneBatch(vdata), sampler=sampler)
+    metdict = monitor.check_progress(rbm)
+    assert metdict['IntegratedAutocorrelationTime'] >= 1
+    assert 0 <= metdict['VisibleFlipRate'] <= 1
+    assert 0 <= metdict['HiddenFlipRate'] <= 1
+    rates = diagnostics.flip_rates()
+    assert len(rates) == 2
+    assert metdict['HiddenFlipRate'] == rates[1]
+
+def test_progress_monitor_tiles():
+    rbm, vdata = rbm_and_data()
+    monitor = fit.ProgressMonitor(_OneBatch(vdata), max_tile_rows=3,
+                                  metrics=['ReconstructionError'])
+    tiles = list(monitor._tiles(vdata))
+    assert [be.shape(t)[0] for t in tiles] == [3, 3, 3, 1]
+    metdict = monitor.check_progress(rbm)
+    assert numpy.isfinite(metdict['ReconstructionError'])
+
+def test_particle_bank_round_robin():
+    rbm, vdata = rbm_and_data()
+    sampler = fit.ParticleBank(rbm, num_particles=25, num_active=num_samples,
+                               selection='round_robin')
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    assert be.shape(sampler.bank.units[0]) == (25, num_vis)
+    seen = []
+    for _ in range(3):
+        sampler.update_negative_state(1)
+        assert be.shape(sampler.neg_state.units[0]) == (num_samples, num_vis)
+        for i in range(rbm.num_layers):
+            assert be.allclose(sampler.bank.units[i][sampler.index],
+                               sampler.neg_state.units[i])
+        seen += list(sampler.index)
+    # every particle is advanced before any is repeated
+    assert sorted(seen[:25]) == list(range(25))
+
+def test_particle_bank_memmap(tmpdir):
+    rbm, vdata = rbm_and_data()
+    sampler = fit.ParticleBank(rbm, num_particles=40,
+                               filename=str(tmpdir.join('bank')))
+    sampler.set_positive_state(model.State.from_visible(vdata, rbm))
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    with sampler:
+        grad = fit.pcd(vdata, rbm, sampler, 2)
+        assert len(set(sampler.index)) == num_samples
+        assert be.shape(grad.weights[0].matrix) == (num_vis, num_hid)
+    saved = numpy.memmap(str(tmpdir.join('bank_0.dat')), dtype=numpy.float32,
+                         mode='r', shape=(40, num_vis))
+    assert numpy.allclose(saved[sampler.index],
+                          be.to_numpy_array(sampler.neg_state.units[0]))
+
+def test_particle_bank_reproducible_and_precision(tmpdir):
+    rbm, vdata = rbm_and_data()
+    rbm.layers[1].set_precision('uint8')
+    indices = []
+    for filename in [None, str(tmpdir.join('bank'))]:
+        sampler = fit.ParticleBank(rbm, num_particles=30, num_active=5,
+                                   filename=filename)
+        be.set_seed()
+        sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+        for _ in range(2):
+            sampler.update_negative_state(1)
+        assert sampler.bank.units[1].dtype == numpy.uint8
+        indices.append(be.to_numpy_array(sampler.index))
+        sampler.close()
+    # the selection draws from the backend random stream
+    assert numpy.array_equal(indices[0], indices[1])
+
+class _RecordingSampler(fit.SequentialMC):
+    """Records the weights seen by the negative phase."""
+    def update_negative_state(self, steps):
+        self.sampled_weights = \
+            be.to_numpy_array(self.model.weights[0].W()).copy()
+        super().update_negative_state(steps)
+
+def test_fpcd_fast_weights():
+    rbm, vdata = rbm_and_data()
+    sampler = _RecordingSampler(rbm)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    method = fit.fpcd(fast_stepsize=0.1, fast_decay=0.5)
+
+    weights = be.to_numpy_array(rbm.weights[0].W()).copy()
+    grad = method(vdata, rbm, sampler, 1)
+    # the first negative phase runs on the slow weights only
+    assert numpy.allclose(sampler.sampled_weights, weights)
+    fast = -0.1 * be.to_numpy_array(grad.weights[0].matrix)
+    assert numpy.allclose(be.to_numpy_array(method.fast_weights[0]), fast)
+
+    grad = method(vdata, rbm, sampler, 1)
+    assert numpy.allclose(sampler.sampled_weights, weights + fast, atol=1e-6)
+    assert numpy.allclose(be.to_numpy_array(rbm.weights[0].W()), weights,
+                          atol=1e-6), "the fast weights were not removed"
+    fast = 0.5 * fast - 0.1 * be.to_numpy_array(grad.weights[0].matrix)
+    assert numpy.allclose(be.to_numpy_array(method.fast_weights[0]), fast)
+
+def test_pipelined_pcd_uses_previous_chains():
+    rbm, vdata = rbm_and_data()
+    sampler = fit.SequentialMC(rbm)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    with fit.ppcd() as method:
+        method(vdata, rbm, sampler, 2)
+        for _ in range(3):
+            # the gradient uses the chains advanced during the last call
+            previous = model.State.from_state(sampler.neg_state)
+            grad = method(vdata, rbm, sampler, 2)
+            expected = rbm.gradient(model.State.from_visible(vdata, rbm),
+                                    previous)
+            assert be.allclose(grad.weights[0].matrix,
+                               expected.weights[0].matrix), \
+            "the gradient did not use the pipelined chains"
+            assert not be.allclose(sampler.neg_state.units[0],
+                                   previous.units[0])
+
+class _PlanSampler(fit.SequentialMC):
+    """Records the update plans of the model seen by each negative phase."""
+    def update_negative_state(self, steps):
+        self.plans = getattr(self, 'plans', [])
+        self.plans.append(set(self.model.update_plans))
+        super().update_negative_state(steps)
+
+def test_pipelined_pcd_builds_shared_state_first():
+    rbm, vdata = rbm_and_data()
+    rbm.use_fused_sampler = True
+    sampler = _PlanSampler(rbm)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    with fit.ppcd() as method:
+        method(vdata, rbm, sampler, 1)
+        plans = dict(rbm.update_plans)
+        engine = rbm.fused_sampler
+        assert engine is not None
+        for _ in range(3):
+            method(vdata, rbm, sampler, 1)
+        # the plan of the gradient exists before the phases overlap
+        assert all(('conditional_mean', (0,)) in keys
+                   for keys in sampler.plans[1:])
+        # the overlapping phases only read the plans and the engine
+        assert rbm.update_plans == plans
+        assert rbm.fused_sampler is engine
+
+class _HistorySampler(fit.SequentialMC):
+    """Records the weights seen by each negative phase."""
+    def update_negative_state(self, steps):
+        self.history = getattr(self, 'history', [])
+        self.history.append(
+            be.to_numpy_array(self.model.weights[0].W()).copy())
+        super().update_negative_state(steps)
+
+def test_pipelined_pcd_delay():
+    rbm, vdata = rbm_and_data()
+    sampler = _HistorySampler(rbm)
+    sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+    method = fit.ppcd()
+    trainer = fit.SGD(rbm, _OneBatch(vdata), optimizers.Gradient(), 2,
+                      method=method, sampler=sampler, mcsteps=1)
+    weights = be.to_numpy_array(rbm.weights[0].W()).copy()
+    trainer.train()
+    assert method.executor is None, "training leaves the thread running"
+    # the first update advances the chains twice with the initial weights,
+    # and the second update advances them with the updated weights
+    assert len(sampler.history) == 3
+    assert numpy.allclose(sampler.history[0], weights)
+    assert numpy.allclose(sampler.history[1], weights)
+    assert not numpy.allclose(sampler.history[2], weights)
+
+def test_sampler_context_closes_pool():
+    rbm, vdata = rbm_and_data()
+    with fit.SequentialMC(rbm, num_workers=2) as sampler:
+        sampler.set_negative_state(model.State.from_visible(vdata, rbm))
+        sampler.update_negative_state(1)
+        assert sampler.pool is not None
+    assert sampler.pool is None
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,75 @@
+import os
+import time
+import numpy
+import pandas
+
+from paysage import layers
+from paysage import generate
+from paysage.models import model
+from paysage import backends as be
+
+import pytest
+
+num_vis = 6
+num_hid = 3
+
+# ----- UTILITIES ----- #
+
+def small_rbm():
+    be.set_seed()
+    rbm = model.Model([layers.BernoulliLayer(num_vis),
+                       layers.BernoulliLayer(num_hid)])
+    rbm.weights[0].params.matrix[:] = be.randn((num_vis, num_hid))
+    return rbm
+
+
+# ----- TESTS ----- #
+
+def test_generate_memmap_resume(tmpdir):
+    rbm = small_rbm()
+    filename = str(tmpdir.join('samples.dat'))
+    with generate.SampleGenerator(rbm, filename, num_chains=7, burn_in=5,
+                                  thin=2, chunk_size=10) as gen:
+        assert gen.run(53) == 53
+    assert os.path.exists(filename + '.chains.npz')
+
+    # a new generator resumes the chains and appends the samples
+    with generate.SampleGenerator(rbm, filename, num_chains=7, burn_in=5,
+                                  thin=2, chunk_size=10) as gen:
+        gen.start(20)
+        gen.wait()
+    samples = generate.MemmapStore(filename, num_vis).read()
+    assert samples.shape == (73, num_vis)
+    assert numpy.all((samples == 0) | (samples == 1))
+
+def test_generate_hdf(tmpdir):
+    rbm = small_rbm()
+    filename = str(tmpdir.join('samples.h5'))
+    with generate.SampleGenerator(rbm, filename, num_chains=10, burn_in=5,
+                                  thin=1, chunk_size=25,
+                                  storage='hdf') as gen:
+        gen.run(60)
+        assert gen.store.num_rows() == 60
+    samples = pandas.read_hdf(filename, 'samples').values
+    assert samples.shape == (60, num_vis)
+    assert numpy.all((samples == 0) | (samples == 1))
+
+def test_generate_stop(tmpdir):
+    rbm = small_rbm()
+    filename = str(tmpdir.join('samples.dat'))
+    with generate.SampleGenerator(rbm, filename, num_chains=10,
+                                  burn_in=0, thin=1, chunk_size=10) as gen:
+        store = generate.MemmapStore(filename, num_vis)
+        gen.start(10 ** 9)
+        while store.num_rows() == 0:
+            time.sleep(0.01)
+        gen.stop()
+        assert not gen.running()
+    # the samples written before stopping are complete rows
+    num_rows = store.num_rows()
+    assert num_rows < 10 ** 9
+    assert os.path.getsize(filename) == 4 * num_vis * num_rows
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -96,6 +96,56 @@ def test_weights_energy():
     ly.energy(vis, hid)
 
 
+# ----- CONVOLUTIONAL WEIGHTS ----- #
+
+image_shape = (2, 6, 5)
+kernel_shape = (3, 2)
+
+def dense_convolution(ly):
+    # the rows of the weight matrix are the products with unit vectors
+    eye = be.identity(ly.num_visible)
+    return ly.W().product(eye)
+
+def test_convolutional_weights_shapes():
+    ly = layers.ConvolutionalWeights(image_shape, kernel_shape, 3, stride=2)
+    assert ly.output_shape == (3, 2, 2)
+    assert ly.num_visible == 60
+    assert ly.num_hidden == 12
+    assert be.shape(ly.W().product(be.randn((num_samples, 60)))) \
+           == (num_samples, 12)
+
+def test_convolutional_weights_build_from_config():
+    ly = layers.ConvolutionalWeights(image_shape, kernel_shape, 3, stride=2)
+    ly.add_penalty({'matrix': penalties.l2_penalty(0.37)})
+    ly_new = layers.Layer.from_config(ly.get_config())
+    assert ly_new.get_config() == ly.get_config()
+    assert be.shape(ly_new.params.matrix) == be.shape(ly.params.matrix)
+
+def test_convolutional_weights_transpose():
+    ly = layers.ConvolutionalWeights(image_shape, kernel_shape, 3)
+    W = dense_convolution(ly)
+    vis = be.randn((num_samples, ly.num_visible))
+    hid = be.randn((num_samples, ly.num_hidden))
+    assert be.allclose(ly.W().product(vis), be.dot(vis, W), atol=1e-5)
+    assert be.allclose(ly.W_T().product(hid), be.dot(hid, be.transpose(W)),
+                       atol=1e-5)
+    assert be.allclose(ly.energy(vis, hid),
+                       -be.batch_dot(vis, W, hid), atol=1e-4)
+
+def test_convolutional_weights_derivative():
+    ly = layers.ConvolutionalWeights(image_shape, kernel_shape, 3, stride=2)
+    vis = be.randn((num_samples, ly.num_visible))
+    hid = be.randn((num_samples, ly.num_hidden))
+    derivs = ly.derivatives(vis, hid)
+    # the energy is linear in the filters
+    filters = ly.params.matrix
+    for p, f in [(0, 0), (5, 1), (11, 2)]:
+        ly.params = layers.ParamsWeights(be.zeros_like(filters))
+        ly.params.matrix[p, f] = 1
+        assert be.allclose(be.mean(ly.energy(vis, hid)), derivs.matrix[p, f],
+                           atol=1e-5)
+
+
 # ----- Gaussian LAYER ----- #
 
 def test_gaussian_build_from_config():
@@ -271,6 +321,43 @@ def test_exponential_derivatives():
     beta = be.rand((num_samples, 1))
     ly.derivatives(vis, hid, weights, beta)
 
+def test_exponential_random_zero_uniform():
+    ly = layers.ExponentialLayer(num_vis)
+    ly.params.loc[:] = 1
+    # the float32 uniform numbers can be exactly 0 (but not 1),
+    # which is the smallest sample, not an extreme one
+    ly.rand = be.zeros
+    zeros = be.zeros((num_samples, num_vis))
+    assert be.allclose(ly.random((num_samples, num_vis)), zeros)
+    conditional = ly.conditional_sample(
+        [be.rand((num_samples, num_hid))],
+        [layers.Weights((num_hid, num_vis)).W()])
+    assert be.allclose(conditional, zeros)
+
+def test_bernoulli_uniform_buffer():
+    w = layers.Weights((num_vis, num_hid))
+    scaled_units = [be.randn((num_samples, num_hid))]
+    weights = [w.W_T()]
+    samples = []
+    for rand in [be.rand, be.UniformBuffer(), be.UniformBuffer(background=True)]:
+        ly = layers.BernoulliLayer(num_vis)
+        ly.rand = rand
+        be.set_seed()
+        samples.append([ly.conditional_sample(scaled_units, weights)
+                        for _ in range(3)])
+    # the background thread draws from its own stream
+    assert all(be.allclose(x, y) for x, y in zip(*samples[:2]))
+    for s in samples[2]:
+        assert be.shape(s) == (num_samples, num_vis)
+        assert be.allclose(s * (1 - s), be.zeros_like(s))
+    rand.close()
+
+def test_rand_float32():
+    r = be.rand((num_samples, num_vis))
+    assert r.dtype == be.float_tensor(r).dtype
+    buffer = be.zeros((num_samples, num_vis))
+    assert be.randn((num_samples, num_vis), out=buffer) is buffer
+
 
 if __name__ == "__main__":
     pytest.main([__file__])
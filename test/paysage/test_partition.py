@@ -0,0 +1,190 @@
+import itertools
+import math
+import numpy
+
+from paysage import layers
+from paysage import fit
+from paysage import metrics
+from paysage import partition
+from paysage.models import model
+from paysage import backends as be
+
+import pytest
+
+num_vis = 4
+num_hid = 3
+
+# ----- UTILITIES ----- #
+
+def small_rbm():
+    be.set_seed()
+    rbm = model.Model([layers.BernoulliLayer(num_vis),
+                       layers.BernoulliLayer(num_hid)])
+    rbm.weights[0].params.matrix[:] = be.randn((num_vis, num_hid))
+    rbm.layers[0].params.loc[:] = be.randn((num_vis,))
+    rbm.layers[1].params.loc[:] = be.randn((num_hid,))
+    return rbm
+
+def all_visible():
+    return be.float_tensor(numpy.array(
+        list(itertools.product([0, 1], repeat=num_vis)), dtype=numpy.float32))
+
+def exact_log_Z(rbm):
+    vis = model.State.from_visible(all_visible(), rbm)
+    log_weights = -be.to_numpy_array(rbm.marginal_free_energy(vis))
+    return numpy.logaddexp.reduce(log_weights.astype(numpy.float64))
+
+class _ValidationBatch(object):
+    """Serves a single validation minibatch per pass."""
+    def __init__(self, vdata):
+        self.vdata = vdata
+        self.served = False
+
+    def get(self, mode):
+        if self.served:
+            self.served = False
+            raise StopIteration
+        self.served = True
+        return self.vdata
+
+
+# ----- TESTS ----- #
+
+def test_schedules():
+    for schedule in [partition.linear_schedule(10),
+                     partition.sigmoid_schedule(10)]:
+        assert len(schedule) == 11
+        assert schedule[0] == 0 and schedule[-1] == 1
+        assert numpy.all(numpy.diff(schedule) > 0)
+
+def test_marginal_free_energy_beta():
+    rbm = small_rbm()
+    vis = model.State.from_visible(all_visible(), rbm)
+    beta = be.ones((2 ** num_vis, 1))
+    assert be.allclose(rbm.marginal_free_energy(vis),
+                       rbm.marginal_free_energy(vis, beta))
+    # at beta = 0 the hidden units do not depend on the visible units
+    free_energy = rbm.marginal_free_energy(vis, 0 * beta)
+    hidden = be.tsum(rbm.layers[1].log_partition_function(
+                     be.zeros((1, num_hid))))
+    assert be.allclose(free_energy,
+                       rbm.layers[0].energy(vis.units[0]) - hidden)
+
+def test_ais_log_Z():
+    rbm = small_rbm()
+    ais = partition.AIS(rbm, num_chains=500,
+                        schedule=partition.sigmoid_schedule(500))
+    log_Z, log_Z_std = ais.run()
+    assert log_Z_std < 0.05
+    assert abs(log_Z - exact_log_Z(rbm)) < 0.05, \
+    "AIS does not match the exact partition function"
+
+def test_ais_workers():
+    rbm = small_rbm()
+    with partition.AIS(rbm, num_chains=200, num_workers=2,
+                       schedule=partition.linear_schedule(200)) as ais:
+        log_Z, _ = ais.run()
+    assert len(ais.log_weights) == 200
+    assert abs(log_Z - exact_log_Z(rbm)) < 0.1
+
+def test_ais_log_likelihood():
+    rbm = small_rbm()
+    vdata = all_visible()
+    ais = partition.AIS(rbm, num_chains=500,
+                        schedule=partition.linear_schedule(500))
+    log_likelihood = ais.log_likelihood(_ValidationBatch(vdata))
+    # the probabilities of all visible configurations sum to one
+    vis = model.State.from_visible(vdata, rbm)
+    log_p = -be.to_numpy_array(rbm.marginal_free_energy(vis)) - ais.log_Z
+    assert abs(numpy.logaddexp.reduce(log_p)) < 0.1
+    assert math.isclose(log_likelihood, numpy.mean(log_p), abs_tol=1e-4)
+
+def test_log_likelihood_metric():
+    rbm = small_rbm()
+    vis = model.State.from_visible(all_visible(), rbm)
+    metric = metrics.LogLikelihood(num_chains=500, num_steps=500)
+    assert metric.value() is None
+    metric.update(metrics.MetricState(minibatch=vis, reconstructions=None,
+                                      random_samples=None, samples=None,
+                                      amodel=rbm))
+    exact = -be.mean(rbm.marginal_free_energy(vis)) - exact_log_Z(rbm)
+    assert abs(metric.value() - exact) < 0.1
+
+def exact_log_likelihood(rbm, vdata):
+    vis = model.State.from_visible(vdata, rbm)
+    return -be.mean(rbm.marginal_free_energy(vis)) - exact_log_Z(rbm)
+
+def test_exact_log_Z():
+    rbm = small_rbm()
+    for block_bits, num_threads in [(1, 1), (1, 3), (2, 2), (10, 1)]:
+        engine = partition.ExactPartition(rbm, block_bits, num_threads)
+        assert math.isclose(engine.log_partition_function(),
+                            exact_log_Z(rbm), abs_tol=1e-5), \
+        "enumeration does not match the sum over visible states"
+
+def test_exact_supports():
+    rbm = small_rbm()
+    assert partition.ExactPartition.supports(rbm)
+    big = model.Model([layers.BernoulliLayer(num_vis),
+                       layers.BernoulliLayer(partition.ExactPartition
+                                             .max_hidden + 1)])
+    assert not partition.ExactPartition.supports(big)
+    with pytest.raises(ValueError):
+        partition.ExactPartition(big)
+
+def test_exact_gradient():
+    rbm = small_rbm()
+    be.set_seed()
+    vdata = be.float_tensor(be.rand((20, num_vis)) < 0.5)
+    grad = fit.exact()(vdata, rbm)
+
+    # finite differences of the log-likelihood with respect to the weights
+    eps = 1e-2
+    W = rbm.weights[0].params.matrix
+    numerical = numpy.zeros((num_vis, num_hid))
+    for i in range(num_vis):
+        for j in range(num_hid):
+            W[i, j] += eps
+            up = exact_log_likelihood(rbm, vdata)
+            W[i, j] -= 2 * eps
+            down = exact_log_likelihood(rbm, vdata)
+            W[i, j] += eps
+            numerical[i, j] = (up - down) / (2 * eps)
+    # the optimizers descend the gradient of the negative log-likelihood
+    assert numpy.allclose(be.to_numpy_array(grad.weights[0].matrix),
+                          -numerical, atol=2e-3), \
+    "exact gradient does not match finite differences"
+
+def test_exact_gradient_reuses_engine():
+    rbm = small_rbm()
+    be.set_seed()
+    vdata = be.float_tensor(be.rand((20, num_vis)) < 0.5)
+    method = fit.exact(block_bits=1, num_threads=3)
+    grad = method(vdata, rbm)
+    engine = method.engine
+    assert engine.num_threads == 3
+    # the engine follows the parameters of the model
+    rbm.weights[0].params.matrix[:] *= 2
+    grad = method(vdata, rbm)
+    assert method.engine is engine
+    assert engine.executor is not None
+    expected = fit.exact()(vdata, rbm)
+    assert be.allclose(grad.weights[0].matrix, expected.weights[0].matrix,
+                       atol=1e-5)
+    method.close()
+    assert engine.executor is None
+
+def test_exact_log_likelihood_metric():
+    rbm = small_rbm()
+    vis = model.State.from_visible(all_visible(), rbm)
+    metric = metrics.ExactLogLikelihood()
+    metric.update(metrics.MetricState(minibatch=vis, reconstructions=None,
+                                      random_samples=None, samples=None,
+                                      amodel=rbm))
+    assert math.isclose(metric.value(),
+                        exact_log_likelihood(rbm, all_visible()),
+                        abs_tol=1e-4)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
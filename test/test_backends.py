@@ -271,6 +271,21 @@ def test_reshape():
 
     assert_close(py_new, torch_new, "reshape")
 
+def test_copy_inplace():
+    shape = (100,100)
+
+    py_rand.set_seed()
+    py_x = py_rand.randn(shape)
+    py_y = py_rand.randn(shape)
+
+    torch_x = torch_matrix.float_tensor(py_x)
+    torch_y = torch_matrix.float_tensor(py_y)
+
+    py_matrix.copy_inplace(py_x, py_y)
+    torch_matrix.copy_inplace(torch_x, torch_y)
+
+    assert_close(py_x, torch_x, "copy_inplace")
+
 def test_mix_inplace():
     shape = (100,100)
     torch_w = 0.1
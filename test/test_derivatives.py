@@ -457,5 +457,45 @@ def test_gaussian_derivatives():
     "derivative of weights wrong in gaussian-gaussian rbm"
 
 
+def test_bernoulli_joint_energy():
+    num_visible_units = 100
+    num_hidden_units = 50
+    batch_size = 25
+
+    # set a seed for the random number generator
+    be.set_seed()
+
+    # set up some layer and model objects
+    vis_layer = layers.BernoulliLayer(num_visible_units)
+    hid_layer = layers.BernoulliLayer(num_hidden_units)
+    rbm = model.Model([vis_layer, hid_layer])
+
+    # randomly set the intrinsic model parameters
+    a = be.randn((num_visible_units,))
+    b = be.randn((num_hidden_units,))
+    W = be.randn((num_visible_units, num_hidden_units))
+
+    rbm.layers[0].params.loc[:] = a
+    rbm.layers[1].params.loc[:] = b
+    rbm.weights[0].params.matrix[:] = W
+
+    # generate a random state and inverse temperatures
+    vdata = rbm.layers[0].random((batch_size, num_visible_units))
+    hdata = rbm.layers[1].random((batch_size, num_hidden_units))
+    state = model.State([vdata, hdata])
+    beta = be.rand((batch_size, 1))
+
+    # compute the energies directly
+    layer_energy = -be.dot(vdata, a) - be.dot(hdata, b)
+    weight_energy = -be.batch_dot(vdata, W, hdata)
+
+    assert be.allclose(layer_energy + weight_energy,
+                       rbm.joint_energy(state), rtol=1e-4, atol=1e-3), \
+    "joint energy wrong in bernoulli-bernoulli rbm"
+
+    assert be.allclose(layer_energy + be.flatten(beta) * weight_energy,
+                       rbm.joint_energy(state, beta), rtol=1e-4, atol=1e-3), \
+    "joint energy with beta wrong in bernoulli-bernoulli rbm"
+
 if __name__ == "__main__":
     pytest.main([__file__])